@@ -1,8 +1,54 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from .routes import chat_routes, auth_routes, messages_routes, assistant_routes
+from .routes import chat_routes, auth_routes, messages_routes, assistant_routes, files
+from .utils.database import init_db_pool, close_db_pool, get_pool_stats, run_background_migrations
+from .utils.message_writer import message_writer
+from .utils.loop_watchdog import loop_watchdog
+from .utils import metrics
+from .utils.auth import get_password_hash_stats, token_cache
+from .utils.assistant.cancellation import cancellation_stats
+from .utils.assistant.history_cache import history_cache
+from .utils.assistant.summarizer import summarizer
+from .utils.assistant.model_selector import llm_service
+from .utils.assistant.response_cache import response_cache
+from .utils.assistant.single_flight import single_flight
+from .utils.assistant.scheduler import llm_scheduler
+from .utils.assistant.hedging import hedging_stats
+from .utils.extract.file_extract import shutdown_extraction
+from .routes.files import get_upload_stats
+from .utils.assistant.retrieval import retriever
 
-app = FastAPI(title="Chatbot API", version="1.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Measure event-loop lag and sample whatever blocks the loop
+    loop_watchdog.start()
+    # Open the shared database pool before serving and close it on shutdown
+    await init_db_pool()
+    # Backfills and index builds too slow for startup run while the app serves
+    background_migrations = asyncio.create_task(run_background_migrations())
+    # Batched message inserts; flushed before the pool closes
+    message_writer.start()
+    # Preload the configured Ollama models in the background; startup does not wait for it
+    # (local Ollama hosts are probed from then on, or from the first request that uses them)
+    warm_up = asyncio.create_task(llm_service.warm_up())
+    try:
+        yield
+    finally:
+        warm_up.cancel()
+        background_migrations.cancel()
+        llm_service.stop_ollama_probes()
+        await summarizer.shutdown()
+        await retriever.shutdown()
+        await message_writer.close()
+        await close_db_pool()
+        shutdown_extraction()
+        await loop_watchdog.stop()
+
+
+app = FastAPI(title="Chatbot API", version="1.0", lifespan=lifespan)
 
 # Enable CORS to allow requests from any origin
 app.add_middleware(
@@ -18,6 +64,7 @@ app.include_router(auth_routes.auth_router, prefix="/api/auth", tags=["Authentic
 app.include_router(chat_routes.router, prefix="/api/chat", tags=["Chat Lists"])
 app.include_router(messages_routes.router, prefix='/api/message', tags=['Messages'])
 app.include_router(assistant_routes.router, prefix='/api/assistant', tags=['AI assistant'])
+app.include_router(files.router, prefix='/api', tags=['Documents'])
 
 # Health check route to show the server is live
 @app.get("/", tags=["Health Check"])
@@ -35,4 +82,43 @@ def read_root():
             "version": app.version,
             "description": "This is a chatbot API providing authentication, chat lists, and message handling."
         }
-    }
\ No newline at end of file
+    }
+
+
+@app.get("/api/stats", tags=["Health Check"])
+def read_stats():
+    """
+    Runtime statistics for the shared resources of this worker.
+
+    Returns:
+        dict: Usage counters keyed by subsystem.
+    """
+    return {
+        "event_loop": loop_watchdog.stats(),
+        "db_pool": get_pool_stats(),
+        "message_writer": message_writer.stats(),
+        "password_hashing": get_password_hash_stats(),
+        "token_cache": token_cache.stats(),
+        "generation_cancellation": cancellation_stats.stats(),
+        "history_cache": history_cache.stats(),
+        "summarizer": summarizer.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "ollama_hosts": llm_service.ollama_host_stats(),
+        "hedging": hedging_stats.stats(),
+        "document_uploads": get_upload_stats(),
+        "retrieval": retriever.stats(),
+    }
+
+
+@app.get("/metrics", tags=["Health Check"])
+def read_metrics():
+    """
+    Prometheus scrape endpoint for this worker: per-model stream latency and
+    throughput, database statement latency, pool utilisation and SSE streams in flight.
+
+    Returns:
+        Response: The metrics in the Prometheus text exposition format.
+    """
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -30,16 +30,18 @@ class Message(BaseModel):
     role: str = Field(default="user", pattern="^(user|assistant)$")
     content: str
     code: Optional[str] = None # Only populated for assistant messages when code is present
+    token_count: Optional[int] = None # Approximate tokens of content + code, stored at insert time
 
 
 class ChatRequest(BaseModel):
     """
     Schema for the incoming POST request to the /assistant/send endpoint.
     """
-    chat_id: str = Field(..., description="The unique ID of the current chat conversation.")
+    chat_id: int = Field(..., description="The unique ID of the current chat conversation.")
     message: str = Field(..., description="The user's message content.")
     model: str = Field(..., description="The model identifier (e.g., 'gemini:gemini-2.5-flash').")
     is_cloud: bool = Field(..., description="Boolean indicating if a cloud-hosted model should be used.")
+    use_cache: bool = Field(True, description="Set to false to always start a fresh generation, bypassing cached and shared answers.")
 
 
 class LLMConfig(BaseModel):
@@ -1,24 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import anyio
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse
-import json
 # Import necessary components
-from app.utils.database import get_db
+from app.utils.database import acquire_db
 from app.utils.auth import get_current_user
 from app.models.schemas import ChatRequest
 from app.utils.assistant.model_selector import llm_service
-from app.utils.assistant.chat_utils import get_chat_history, build_context_prompt
-from app.utils.assistant.parser import parse_llm_response
-from app.utils.assistant.stream_utils import get_ollama_stream, get_gemini_stream 
+from app.utils.assistant.chat_utils import (
+    get_chat_history, build_context_prompt, count_tokens, message_token_count, get_context_budget,
+    truncate_to_tokens, PROMPT_OVERHEAD_TOKENS, MESSAGE_FRAMING_TOKENS
+)
+from app.utils.assistant.history_cache import history_cache, CachedMessage, MIN_TRUNCATED_TOKENS
+from app.utils.assistant.summarizer import summarizer
+from app.utils.assistant.response_cache import response_cache, replay_text
+from app.utils.assistant.single_flight import single_flight, SINGLE_FLIGHT_ENABLED
+from app.utils.assistant.scheduler import llm_scheduler, holding_slot, QueueFullError
+from app.utils.assistant.retrieval import retriever, format_documents, RETRIEVAL_MAX_TOKENS
+from app.utils.assistant.hedging import hedged_stream, track_answering_model, fallback_for, first_token_deadline
+from app.utils.assistant.parser import StreamingMarkdownParser, parse_markdown, render_markdown
+from app.utils.assistant.stream_utils import stream_text
+from app.utils.assistant.sse import sse_event, markdown_sse_event, coalesce_chunks
+from app.utils.json_stream import dumps
+from app.utils.message_writer import message_writer
+from app.utils.metrics import sse_streams_in_flight
+from app.utils.assistant.cancellation import GenerationState, cancellation_stats, stop_on_disconnect
 
 router = APIRouter()
 
+# How often a queued request re-checks its queue position
+QUEUE_POSITION_INTERVAL_SECONDS = 1.0
+
 def authenticated_user():
     return Depends(get_current_user)
 
 @router.post("/send")
 async def send_chat_stream(
     request_data: ChatRequest, 
-    db=Depends(get_db), 
+    request: Request,
     user_id=authenticated_user()  # Dependency to ensure authentication
 ):
     """
@@ -33,88 +53,265 @@ async def send_chat_stream(
 
     if not user_message or not chat_id:
         raise HTTPException(status_code=400, detail="message and chat_id required")
+    if llm_service.backend_for(model_identifier, is_cloud) is None or not model_identifier.split(":", 1)[1]:
+        raise HTTPException(
+            status_code=400, detail=f"Unsupported model '{model_identifier}'. Expected 'ollama:<model>' or 'gemini:<model>'."
+        )
 
-    # 1. Save user message to DB
-    print(f"Saving user message to DB: chat_id={chat_id}, role=user, content={user_message}")
-    # Note: Use parameter binding ($1, $2, etc.) for SQL injection prevention
-    await db.execute(
-        """INSERT INTO messages (chat_id, role, content) VALUES ($1, $2, $3)""",
-        chat_id, "user", user_message
+    # 1. Retrieve the rolling summary, excerpts of the user's documents that match the
+    # question, and the recent history that fits the model's token budget, and build
+    # context prompt. This runs before the new message is stored, since the stream
+    # helpers add it themselves.
+    user_tokens = count_tokens(user_message)
+    context_budget = get_context_budget(model_identifier)
+    # The prompt's own wording and the question come first. A question longer than the budget
+    # is cut to fit for the model (the stored message stays whole).
+    question = truncate_to_tokens(
+        user_message, max(MIN_TRUNCATED_TOKENS, context_budget - PROMPT_OVERHEAD_TOKENS - MESSAGE_FRAMING_TOKENS)
     )
+    question_tokens = count_tokens(question)
+    if question != user_message:
+        print(f"Message of ~{user_tokens} tokens cut to ~{question_tokens} for the model's budget of {context_budget}")
+    available = max(0, context_budget - PROMPT_OVERHEAD_TOKENS - MESSAGE_FRAMING_TOKENS - question_tokens)
 
-    # 2. Retrieve history and build context prompt
-    # history will be used by the model stream helpers to build the full context
-    history = await get_chat_history(db, chat_id, limit=10)
+    # The connection goes back to the pool once these reads are done, not when the response
+    # ends, so queued and streaming answers do not hold pooled connections
+    async with acquire_db() as db:
+        chat_summary = await summarizer.get_summary(db, chat_id)
+        summary = chat_summary.summary if chat_summary else None
+        summary_tokens = chat_summary.token_count if chat_summary else 0
+        summarized_until_id = chat_summary.summarized_until_id if chat_summary else 0
+        # Document excerpts may take up to a third of what is left; history gets the rest
+        retrieved = await retriever.search(db, user_id, question, min(RETRIEVAL_MAX_TOKENS, available // 3))
+        documents = format_documents(retrieved) or None
+        document_tokens = sum(chunk.token_count for chunk in retrieved)
+        history_budget = max(0, available - summary_tokens - document_tokens)
+        history = await get_chat_history(db, chat_id, history_budget, after_id=summarized_until_id)
+    prompt_tokens = (
+        PROMPT_OVERHEAD_TOKENS + question_tokens + summary_tokens + document_tokens
+        + sum((msg.token_count or 0) + MESSAGE_FRAMING_TOKENS for msg in history) + MESSAGE_FRAMING_TOKENS
+    )
+    print(f"Context for chat_id={chat_id}: {len(history)} messages, {len(retrieved)} document excerpts, "
+          f"~{prompt_tokens} prompt tokens")
     # The build_context_prompt is not strictly needed here since the stream utilities will
     # handle building the context from the message history, but kept for future use if needed.
-    prompt = build_context_prompt(history, user_message) 
+    prompt = build_context_prompt(history, question, summary)
     print(f"Built context prompt (truncated for display): {prompt[:100]}...")
 
+    # 2. Save the user message through the batched writer and wait for the commit, so a
+    # deleted chat or a failed insert ends the request before any model time is spent
+    print(f"Saving user message to DB: chat_id={chat_id}, role=user, content={user_message}")
     try:
-        # 3. Get the correct LLM client
-        llm_client = llm_service.get_llm_client(model_identifier, is_cloud)
-        # Extract just the model name (e.g., "llama3" or "gemini-2.5-flash")
-        model_name = model_identifier.split(":")[1] 
+        message_id = await message_writer.submit(chat_id, "user", user_message, token_count=user_tokens)
+    except asyncpg.ForeignKeyViolationError:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    history_cache.append(chat_id, CachedMessage(message_id, "user", user_message, user_tokens))
 
-        # 4. Define the async generator for SSE
-        async def event_generator():
-            full_response_text = ""
-            
-            # --- Ollama Streaming Logic ---
-            if model_identifier.startswith("ollama:"):
-                print(f"Streaming from Ollama model: {model_name}")
-                # get_ollama_stream is assumed to handle history and return an async iterable of dicts
-                stream = await get_ollama_stream(
-                    llm_client, 
-                    model_name, # Ollama stream often takes just the model name
-                    history, # Pass the history for the stream utility to construct messages
-                    user_message # Pass the latest message
-                )
-                
-                async for chunk in stream:
-                    # Ollama chunks often contain the content under the 'content' key in the 'message' dict
-                    content_chunk = chunk.get("message", {}).get("content", "")
-                    if content_chunk:
-                        full_response_text += content_chunk
-                        # SSE format: data: <JSON object>\n\n
-                        yield f"data: {json.dumps({'content': content_chunk})}\n\n"
-                        
-            # --- Gemini Streaming Logic ---
-            elif model_identifier.startswith("gemini:"):
-                print(f"Streaming from Gemini model: {model_name}")
-                # get_gemini_stream is assumed to handle history and return an async iterable of Response objects
-                stream = await get_gemini_stream(
-                    llm_client,
-                    model_name,
-                    history, # Pass the history for the stream utility to construct contents
-                    user_message # Pass the latest message
-                )
-
-                async for chunk in stream:
-                    # Gemini chunks have the text content directly on the chunk object
-                    # We must check if the chunk.text exists, as some intermediate chunks may not
-                    content_chunk = getattr(chunk, 'text', '')
-                    if content_chunk:
-                        full_response_text += content_chunk
-                        # SSE format: data: <JSON object>\n\n
-                        yield f"data: {json.dumps({'content': content_chunk})}\n\n"
-                    
-            # 5. After the stream ends, parse and save the full assistant message
-            
-            # Use the markdown parser to separate content and code
-            content, code = parse_llm_response(full_response_text)
-            code_preview = code[:50] if code else None  # Check if code is not None before slicing
-            print(f"Parsed response: content={content[:50]}..., code={code_preview}...")
-            
-            # Save the full assistant response
-            print(f"Saving assistant response to DB: chat_id={chat_id}, role=assistant...")
-            await db.execute(
-                """INSERT INTO messages (chat_id, role, content, code) VALUES ($1, $2, $3, $4)""",
-                chat_id, "assistant", content, code
+    # 3. Identical prompts to the same model can be answered from the response cache,
+    # or share a generation that is already running for the same prompt
+    cache_key = None
+    cached_answer = None
+    share_generation = SINGLE_FLIGHT_ENABLED and request_data.use_cache
+    if share_generation or response_cache.enabled_for(model_identifier, request_data.use_cache):
+        cache_key = response_cache.make_key(model_identifier, history, question, summary, documents)
+    if response_cache.enabled_for(model_identifier, request_data.use_cache):
+        cached_answer = response_cache.get(cache_key)
+
+    # 4. Get the correct LLM client (not needed when replaying a cached answer). If the model
+    # has a fallback (see MODEL_FALLBACKS), a client error hands the request to the fallback.
+    llm_client = None
+    client_error = None
+    fallback = fallback_for(model_identifier, is_cloud)
+    if cached_answer is None:
+        try:
+            llm_client = llm_service.get_llm_client(model_identifier, is_cloud)
+        except Exception as e:
+            client_error = e
+
+    # 5. Take a place in the model's queue. Cached answers and requests joining a running
+    # generation do not call the model, so they skip the queue.
+    ticket = None
+    backend = llm_service.backend_for(model_identifier, is_cloud)
+    if llm_client is not None and not (share_generation and single_flight.is_running(cache_key)):
+        try:
+            ticket = llm_scheduler.reserve(backend, model_identifier, str(user_id))
+        except QueueFullError as e:
+            if fallback is None:
+                raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+            print(f"{e} Falling back to {fallback.model_identifier}")
+            llm_client = None
+
+    try:
+        if client_error is not None and fallback is None:
+            raise client_error
+        # Without a usable primary model the fallback answers right away
+        use_primary = llm_client is not None
+
+        async def fallback_text():
+            fallback_client = llm_service.get_llm_client(fallback.model_identifier, fallback.is_cloud)
+            fallback_backend = llm_service.backend_for(fallback.model_identifier, fallback.is_cloud)
+            async with llm_scheduler.slot(fallback_backend, fallback.model_identifier, str(user_id)):
+                async for chunk in stream_text(
+                    fallback_client, fallback.model_identifier, history, question, summary, documents
+                ):
+                    yield chunk
+
+        def start_generation():
+            # The primary model's stream takes over this request's slot and holds it for as long
+            # as it runs: under single flight that can outlive this request while others read
+            # along, and if the fallback wins the hedge, closing the primary gives the slot back.
+            nonlocal ticket
+            owned, ticket = ticket, None
+            if not use_primary:
+                if owned is not None:
+                    owned.release()
+                return hedged_stream(None, fallback, fallback_text, 0)
+            if owned is None:
+                # No slot was reserved because a shared generation was running, but it ended
+                # before this request could join it. The new generation queues for its own slot.
+                try:
+                    owned = llm_scheduler.reserve(backend, model_identifier, str(user_id))
+                except QueueFullError:
+                    if fallback is None:
+                        raise
+                    return hedged_stream(None, fallback, fallback_text, 0)
+            # The queue wait counts towards the first-token deadline
+            deadline = first_token_deadline(model_identifier) - owned.wait_ms / 1000
+            return hedged_stream(
+                lambda: holding_slot(
+                    owned, stream_text(llm_client, model_identifier, history, question, summary, documents)
+                ),
+                fallback,
+                fallback_text if fallback is not None else None,
+                deadline,
+            )
+
+        # 6. Define the async generator for SSE
+        async def save_assistant_message(
+            markdown: StreamingMarkdownParser, truncated: bool = False, answered_by: str = model_identifier
+        ):
+            # The parser already split the answer into prose and code blocks while it streamed
+            content, code = markdown.content, markdown.code
+            print(f"Parsed response: content={content[:50]}..., code_blocks={len(markdown.blocks)}")
+
+            # Save the full assistant response. messages.code keeps the first block,
+            # code_blocks all of them with their language and position in the content.
+            print(f"Saving assistant response to DB: chat_id={chat_id}, role=assistant, truncated={truncated}...")
+            token_count = message_token_count(content, "".join(block.code for block in markdown.blocks))
+            code_blocks = dumps([block._asdict() for block in markdown.blocks]).decode("utf-8")
+            message_id = await message_writer.submit(
+                chat_id, "assistant", content, code, code_blocks, truncated, token_count, answered_by
             )
-            
+            # Later turns see the answer with all of its code blocks, as the database rebuilds it
+            history_cache.append(
+                chat_id, CachedMessage(message_id, "assistant", render_markdown(content, markdown.blocks), token_count)
+            )
+            # Fold turns that fell out of the recent window into the summary, off the request path
+            summarizer.schedule(chat_id, model_identifier, is_cloud)
+
+        async def save_truncated(state: GenerationState):
+            # The client is gone: keep whatever was generated, marked as truncated.
+            # Shielded so the insert completes even while the response task is being cancelled.
+            cancellation_stats.record_cancelled(state)
+            with anyio.CancelScope(shield=True):
+                # Chunks still being coalesced never reached the live parser, so parse the whole text
+                try:
+                    await save_assistant_message(
+                        parse_markdown(state.text), truncated=True, answered_by=state.answered_by
+                    )
+                except Exception as e:
+                    print(f"Could not save truncated answer for chat_id={chat_id}: {e}")
+
+        async def stream_answer():
+            # The state collects the answer as it streams, including chunks still being coalesced
+            state = GenerationState(model_identifier)
+
+            if cached_answer is not None:
+                print(f"Replaying cached answer for chat_id={chat_id}")
+                text_stream = replay_text(cached_answer)
+            elif share_generation:
+                def mark_shared():
+                    print(f"Joining in-flight generation for chat_id={chat_id}")
+                    state.shared = True
+                    # Another request already holds the model slot for this generation
+                    if ticket is not None:
+                        ticket.release()
+
+                text_stream = single_flight.stream(cache_key, start_generation, on_join=mark_shared)
+            else:
+                text_stream = start_generation()
+            text_stream = track_answering_model(text_stream, state)
+            # Prose and code blocks are told apart as the answer streams
+            markdown = StreamingMarkdownParser()
+            try:
+                # Small upstream chunks are merged into fewer, larger frames (see SSE_COALESCE_*)
+                async for content_chunk in coalesce_chunks(stop_on_disconnect(request, text_stream, state)):
+                    for event in markdown.feed(content_chunk):
+                        yield markdown_sse_event(event)
+            except (asyncio.CancelledError, GeneratorExit):
+                # The server cancelled or closed the response because the client disconnected
+                await save_truncated(state)
+                raise
+
+            if state.disconnected:
+                await save_truncated(state)
+                return
+            for event in markdown.finish():
+                yield markdown_sse_event(event)
+            if cached_answer is None:
+                cancellation_stats.record_completed(state)
+                # Only answers of the requested model are reused for it
+                answered_as_requested = state.answered_by == model_identifier
+                if answered_as_requested and not state.shared and response_cache.enabled_for(model_identifier, request_data.use_cache):
+                    response_cache.put(cache_key, state.text)
+
+            # 7. After the stream ends, parse and save the full assistant message
+            try:
+                await save_assistant_message(markdown, answered_by=state.answered_by)
+            except Exception as e:
+                print(f"Saving the answer for chat_id={chat_id} failed: {e}")
+                yield sse_event({'content': '[DONE]', 'db_saved': False, 'error': str(e)})
+                return
+
             # Send a 'done' message to the client
-            yield f"data: {json.dumps({'content': '[DONE]', 'db_saved': True, 'has_code': bool(code)})}\n\n"
+            yield sse_event({
+                'content': '[DONE]', 'db_saved': True, 'has_code': bool(markdown.blocks),
+                'code_blocks': len(markdown.blocks),
+                'prompt_tokens': prompt_tokens, 'cached': cached_answer is not None,
+                'shared': state.shared, 'model': state.answered_by
+            })
+
+        async def event_generator():
+            nonlocal use_primary
+            sse_streams_in_flight.labels().inc()
+            try:
+                # Tell a queued client where it stands until the model has a free slot.
+                # A model with a fallback only waits until its first-token deadline.
+                if ticket is not None and not ticket.granted:
+                    deadline = first_token_deadline(model_identifier) if fallback is not None else None
+                    position = ticket.position
+                    yield sse_event({'event': 'queued', 'position': position})
+                    while True:
+                        timeout = QUEUE_POSITION_INTERVAL_SECONDS
+                        if deadline is not None:
+                            timeout = max(0.0, min(timeout, deadline - ticket.wait_ms / 1000))
+                        if await ticket.wait(timeout=timeout):
+                            break
+                        if deadline is not None and ticket.wait_ms / 1000 >= deadline:
+                            print(f"Queue wait for {model_identifier} passed the deadline, falling back to {fallback.model_identifier}")
+                            ticket.release()
+                            use_primary = False
+                            break
+                        if ticket.position != position:
+                            position = ticket.position
+                            yield sse_event({'event': 'queued', 'position': position})
+                    yield sse_event({'event': 'started', 'queue_wait_ms': round(ticket.wait_ms)})
+                async for event in stream_answer():
+                    yield event
+            finally:
+                sse_streams_in_flight.labels().dec()
+                if ticket is not None:
+                    ticket.release()
 
         # Return the StreamingResponse
         return StreamingResponse(
@@ -123,15 +320,15 @@ async def send_chat_stream(
         )
 
     except Exception as e:
+        if ticket is not None:
+            ticket.release()
         import traceback
         traceback.print_exc()
         print(f"Error processing chat request: {e}")
         # Send an error message to the client before raising the HTTP exception
         return StreamingResponse(
-            (f"data: {json.dumps({'content': 'An error occurred during streaming.', 'error': str(e)})}\n\n",
-             f"data: {json.dumps({'content': '[DONE]', 'db_saved': False})}\n\n"),
+            (sse_event({'content': 'An error occurred during streaming.', 'error': str(e)}),
+             sse_event({'content': '[DONE]', 'db_saved': False})),
             media_type="text/event-stream",
             status_code=500
-        )     
-        
-    
\ No newline at end of file
+        )
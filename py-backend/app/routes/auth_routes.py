@@ -1,76 +1,73 @@
 from fastapi import APIRouter, Depends, HTTPException
 from app.models.schemas import UserCreate, UserLogin, Token, User
 from app.utils.database import get_db
-from app.utils.auth import hash_password, create_access_token, verify_password, get_current_user
+from app.utils.auth import (
+    hash_password_async, create_access_token, verify_password_async, get_current_user,
+    oauth2_scheme, token_cache
+)
 
 
 # Authentication routes
 auth_router = APIRouter()
 
 @auth_router.post("/register", response_model=Token, status_code=201)
-def register_user(user: UserCreate, db=Depends(get_db)):
-    cur = db.cursor()
-
+async def register_user(user: UserCreate, db=Depends(get_db)):
     # Check if user exists
-    cur.execute("SELECT id FROM users WHERE username=%s", (user.username,))
-    exists = cur.fetchone()
+    exists = await db.fetchval("SELECT id FROM users WHERE username=$1", user.username)
     if exists:
         raise HTTPException(status_code=400, detail="Username already taken")
 
-    hashed_pw = hash_password(user.password)
+    hashed_pw = await hash_password_async(user.password)
 
     # Insert user
-    cur.execute(
-        "INSERT INTO users (username, password, email, imageurl) VALUES (%s, %s, %s, %s) RETURNING id",
-        (user.username, hashed_pw, user.email, user.imageurl)
+    user_id = await db.fetchval(
+        "INSERT INTO users (username, password, email, imageurl) VALUES ($1, $2, $3, $4) RETURNING id",
+        user.username, hashed_pw, user.email, user.imageurl
     )
-    user_id = cur.fetchone()[0]
-    db.commit()
 
     # Create JWT
     token = create_access_token({"sub": str(user_id)})
     return Token(access_token=token)
 
 @auth_router.post("/login", response_model=Token)
-def login(user: UserLogin, db=Depends(get_db)):
-    cur = db.cursor()
-
+async def login(user: UserLogin, db=Depends(get_db)):
     # Find user
-    cur.execute("SELECT id, password FROM users WHERE email=%s", (user.email,))
-    record = cur.fetchone()
+    record = await db.fetchrow("SELECT id, password FROM users WHERE email=$1", user.email)
 
     if not record:
         raise HTTPException(status_code=400, detail="Invalid email or password")
 
     user_id, password = record
 
-    if not verify_password(user.password, password):
+    matches, new_hash = await verify_password_async(user.password, password)
+    if not matches:
         raise HTTPException(status_code=400, detail="Invalid email or password")
 
+    # Transparently upgrade hashes made with an older bcrypt cost factor
+    if new_hash:
+        await db.execute("UPDATE users SET password=$1 WHERE id=$2", new_hash, user_id)
+
     token = create_access_token({"sub": str(user_id)})
     return Token(access_token=token)
 
 @auth_router.get('/me', response_model=User)
-def get_user_details(current_user: str = Depends(get_current_user), db=Depends(get_db)):
-    cur = db.cursor()
-    cur.execute("SELECT username, email, imageurl FROM users WHERE id=%s", (current_user,))
-    user = cur.fetchone()
+async def get_user_details(current_user: str = Depends(get_current_user), db=Depends(get_db)):
+    user = await db.fetchrow("SELECT username, email, imageurl FROM users WHERE id=$1", int(current_user))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return User(username=user[0], email=user[1], imageurl=user[2])
 
 
 @auth_router.put('/me', response_model=User)
-def update_user_username(new_username: str, current_user: str = Depends(get_current_user), db=Depends(get_db)):
-    cur = db.cursor()
-    cur.execute("SELECT id FROM users WHERE username=%s", (new_username,))
-    exists = cur.fetchone()
+async def update_user_username(new_username: str, current_user: str = Depends(get_current_user), db=Depends(get_db)):
+    exists = await db.fetchval("SELECT id FROM users WHERE username=$1", new_username)
     if exists:
         raise HTTPException(status_code=400, detail="Username already taken")
     
-    cur.execute("UPDATE users SET username=%s WHERE id=%s RETURNING username, email, imageurl", (new_username, current_user))
-    user = cur.fetchone()
-    db.commit()
+    user = await db.fetchrow(
+        "UPDATE users SET username=$1 WHERE id=$2 RETURNING username, email, imageurl",
+        new_username, int(current_user)
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return User(username=user[0], email=user[1], imageurl=user[2])
@@ -78,10 +75,14 @@ def update_user_username(new_username: str, current_user: str = Depends(get_curr
 
 
 @auth_router.delete('/me', status_code=204)
-def delete_user(current_user: str = Depends(get_current_user), db=Depends(get_db)):
-    cur = db.cursor()
-    cur.execute("DELETE FROM users WHERE id=%s RETURNING id", (current_user,))
-    deleted_user = cur.fetchone()
-    db.commit()
+async def delete_user(
+    current_user: str = Depends(get_current_user),
+    token: str = Depends(oauth2_scheme),
+    db=Depends(get_db)
+):
+    deleted_user = await db.fetchval("DELETE FROM users WHERE id=$1 RETURNING id", int(current_user))
     if not deleted_user:
-        raise HTTPException(status_code=404, detail="User not found")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="User not found")
+    # The account is gone, so none of its tokens may be served from the cache any more
+    token_cache.revoke_user(current_user)
+    token_cache.revoke_token(token)
\ No newline at end of file
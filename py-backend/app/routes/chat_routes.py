@@ -1,10 +1,15 @@
 from fastapi import Depends, HTTPException, Query, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import asyncpg
 import os
 from app.utils.database import get_db
 from app.models.schemas import Chat
 from app.utils.auth import get_current_user
+from app.utils.search import iter_search_rows, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
+from app.utils.pagination import decode_cursor, PageTracker, CHAT_PAGE_SIZE, CHAT_MAX_PAGE_SIZE
+from app.utils.json_stream import iter_rows, streaming_json_response
+from app.utils.assistant.history_cache import history_cache
+from app.utils.assistant.summarizer import summarizer
 
 router = APIRouter()
 
@@ -14,45 +19,70 @@ def authenticated_user():
 
 
 @router.get("/search")
-async def search_chat(query: str = Query(..., min_length=1), db=Depends(get_db), user_id=authenticated_user()):
+async def search_chat(
+    query: str = Query(..., min_length=1),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    db=Depends(get_db),
+    user_id=authenticated_user()
+):
     """
-    Search for chats based on the query parameter.
+    Search chats by title, message content and code, best matches first.
+    Each result carries a snippet of the matching message.
     """
     if not query or query.strip() == "":
         raise HTTPException(status_code=400, detail="Query parameter is required.")
     
-    search_term = f"%{query}%"
-    query = """
-        SELECT DISTINCT c.id, c.title, c.created_at
-        FROM chats c
-        LEFT JOIN messages m ON m.chat_id = c.id
-        WHERE 
-              c.title ILIKE $1
-           OR m.content ILIKE $1
-           OR m.code ILIKE $1
-        ORDER BY c.created_at DESC;
-    """
-    result = await db.fetch(query, search_term)
-    return JSONResponse(content=[dict(row) for row in result])
+    page = PageTracker(limit)
+    return streaming_json_response(
+        "results",
+        page.rows(iter_search_rows(db, query, limit, offset)),
+        lambda: {"limit": limit, "offset": offset, "has_more": page.has_more},
+    )
 
 
 @router.get("/")
-async def get_chats(q: str = None, limit: int = 50, offset: int = 0, db=Depends(get_db), user_id=authenticated_user()):
+async def get_chats(
+    q: str = None,
+    limit: int = Query(CHAT_PAGE_SIZE, ge=1, le=CHAT_MAX_PAGE_SIZE),
+    cursor: str = None,
+    db=Depends(get_db),
+    user_id=authenticated_user()
+):
     """
-    Retrieve a list of chats with optional query parameters for filtering and pagination.
+    Retrieve chats newest first, optionally filtered by title.
+    Pass the returned next_cursor back as `cursor` to fetch the following page.
     """
-    query = "SELECT id, title, created_at FROM chats"
+    query = """
+        SELECT id, title, created_at,
+               row_number() OVER (ORDER BY created_at DESC, id DESC) AS rn
+        FROM chats
+    """
+    conditions = []
     params = []
     
     if q:
         params.append(f"%{q}%")
-        query += " WHERE title ILIKE $1"
-    
-    params.extend([limit, offset])
-    query += f" ORDER BY created_at DESC LIMIT ${len(params)} OFFSET ${len(params) + 1}"
+        conditions.append(f"title ILIKE ${len(params)}")
+
+    if cursor:
+        created_at, chat_id = decode_cursor(cursor)
+        params.extend([created_at, chat_id])
+        conditions.append(f"(created_at, id) < (${len(params) - 1}, ${len(params)})")
+
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    # Fetch one extra row to learn whether another page exists
+    params.append(limit + 1)
+    query += f" ORDER BY created_at DESC, id DESC LIMIT ${len(params)}"
     
-    result = await db.fetch(query, *params)
-    return JSONResponse(content=[dict(row) for row in result])
+    page = PageTracker(limit)
+    return streaming_json_response(
+        "chats",
+        page.rows(iter_rows(db, query, *params)),
+        lambda: {"next_cursor": page.next_cursor},
+    )
 
 
 
@@ -63,7 +93,7 @@ async def save_chat(chat: Chat, db=Depends(get_db), user_id=authenticated_user()
     """
     query = "INSERT INTO chats (title) VALUES ($1) RETURNING id, title, created_at"
     result = await db.fetchrow(query, chat.title)
-    return JSONResponse(content=dict(result), status_code=201)
+    return ORJSONResponse(content=dict(result), status_code=201)
 
 
 
@@ -81,7 +111,7 @@ async def update_chat(chat_id: int, chat: Chat, db=Depends(get_db), user_id=auth
     if not result:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    return JSONResponse(content=dict(result))
+    return ORJSONResponse(content=dict(result))
 
 
 
@@ -96,5 +126,8 @@ async def delete_chat(chat_id: int, db=Depends(get_db), user_id=authenticated_us
         
         if not result:
             raise HTTPException(status_code=404, detail="Chat not found")
+
+    history_cache.invalidate(chat_id)
+    summarizer.invalidate(chat_id)
     
-    return JSONResponse(content={"message": "Chat deleted", "chat": dict(result)})
\ No newline at end of file
+    return ORJSONResponse(content={"message": "Chat deleted", "chat": dict(result)})
\ No newline at end of file
@@ -1,191 +1,196 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse
-import json
-# Import necessary components (assuming these are available in your project structure)
-from app.utils.database import get_db
+import asyncio
+import tempfile
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+# Import necessary components
+from app.utils.database import acquire_db
 from app.utils.auth import get_current_user
-from app.models.schemas import ChatRequest
-from app.utils.assistant.model_selector import llm_service
-from app.utils.assistant.stream_utils import get_ollama_stream, get_gemini_stream
-from app.utils.assistant.chat_utils import get_chat_history, build_context_prompt
-from app.utils.assistant.parser import parse_llm_response
-from app.utils.extract.file_extract import extract_text_from_file
+from app.utils.extract.file_extract import (
+    spool_upload, remove_spooled, iter_document_pages, ExtractionTimeout, EXTRACT_TIMEOUT_SECONDS, SpooledUpload,
+    UPLOAD_SPOOL_DIR
+)
+from app.utils.assistant.retrieval import retriever
 import uuid # For generating unique file IDs
-import os # For local file operations
 
 router = APIRouter(prefix="/assistant", tags=["assistant"])
 
-# --- Helper function for text extraction (Placeholder for complexity) ---
+# Pages are written to the pages file and copied into the database in batches of this many
+DOCUMENT_PAGE_BATCH_SIZE = 32
+DOCUMENT_PAGES_TABLE = "document_pages"
+DOCUMENT_PAGE_COLUMNS = ("content_hash", "page_number", "content")
+
+# Deduplication counters, reported through get_upload_stats()
+_stats = {
+    "uploads": 0,
+    "deduplicated": 0,
+    "extracted": 0,
+}
+
 
 def authenticated_user():
     return Depends(get_current_user)
 
-@router.post("/upload-document")
+
+def get_upload_stats() -> dict:
+    return dict(_stats)
+
+
+async def _find_content(db, content_hash: str):
+    return await db.fetchrow(
+        "SELECT page_count, character_count FROM document_contents WHERE content_hash = $1", content_hash
+    )
+
+
+def _write_pages(pages_file, pages: list[str]):
+    # One JSON string per line; runs in a thread
+    pages_file.write(b"".join(orjson.dumps(text) + b"\n" for text in pages))
+
+
+def _read_pages(pages_file, count: int) -> list[str]:
+    pages = []
+    for _ in range(count):
+        line = pages_file.readline()
+        if not line:
+            break
+        pages.append(orjson.loads(line))
+    return pages
+
+
+async def _extract_pages(spooled: SpooledUpload, pages_file) -> tuple[int, int]:
+    """
+    Extracts a file not seen before into pages_file, before any database work, so a
+    slow parse never holds a pooled connection or a transaction.
+
+    Returns the (page_count, character_count) of the content.
+    """
+    pages = 0
+    characters = 0
+    batch = []
+    async for text in iter_document_pages(spooled):
+        pages += 1
+        characters += len(text)
+        batch.append(text)
+        if len(batch) >= DOCUMENT_PAGE_BATCH_SIZE:
+            await asyncio.to_thread(_write_pages, pages_file, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(_write_pages, pages_file, batch)
+    return pages, characters
+
+
+async def _store_content(db, spooled: SpooledUpload, pages_file, pages: int, characters: int) -> bool:
+    """
+    Stores extracted content under its hash. Must run in a transaction. If a concurrent
+    upload of the same file stored it first, its content is kept and False is returned.
+    """
+    stored = await db.fetchval(
+        """
+        INSERT INTO document_contents (content_hash, size, content_type, page_count, character_count)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (content_hash) DO NOTHING
+        RETURNING content_hash
+        """,
+        spooled.sha256, spooled.size, spooled.content_type, pages, characters
+    )
+    if stored is None:
+        return False
+    pages_file.seek(0)
+    page_number = 0
+    while batch := await asyncio.to_thread(_read_pages, pages_file, DOCUMENT_PAGE_BATCH_SIZE):
+        records = [(spooled.sha256, page_number + index, text) for index, text in enumerate(batch, start=1)]
+        page_number += len(batch)
+        await db.copy_records_to_table(DOCUMENT_PAGES_TABLE, records=records, columns=DOCUMENT_PAGE_COLUMNS)
+    return True
+
+
+# The body is parsed by spool_upload rather than declared as a File parameter, so the
+# upload is documented here
+UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"file": {"type": "string", "format": "binary"}},
+                "required": ["file"],
+            }
+        }
+    },
+}
+
+
+@router.post("/upload-document", openapi_extra={"requestBody": UPLOAD_REQUEST_BODY})
 async def upload_document(
-    file: UploadFile = File(...), # The uploaded file
-    db=Depends(get_db),
+    request: Request, # Multipart body with the uploaded file in the 'file' field
     user_id=authenticated_user() # Dependency to ensure authentication
 ):
     """
-    Handles file upload, extracts text content, saves document metadata/content 
-    to the database, and returns the unique document ID.
+    Handles file upload, extracts text content page by page, saves the document
+    and its pages to the database, and returns the unique document ID.
+
+    The upload is streamed to disk straight from the request body, with the size
+    limit applied as it arrives, and parsed in worker processes, so neither the
+    file nor its full text is ever held in memory at once. Content is stored once
+    per distinct file: uploading a file whose bytes were seen before skips
+    extraction and only adds a documents row pointing at the stored pages.
+    A database connection is only borrowed for the lookup and the final inserts,
+    never while the file is parsed.
     """
     print(f"Processing document upload for user: {user_id}")
-    
+    _stats["uploads"] += 1
+
+    # 1. Spool the upload to disk and hash it (413 if it is over the size limit)
+    spooled = await spool_upload(request)
     try:
-        # 1. Extract Text Content
-        extracted_content = await extract_text_from_file(file)
-        
         # 2. Generate a unique ID for the document entry
         document_id = str(uuid.uuid4())
-        
-        # 3. Save Document Metadata/Content to DB (using user_id, file_name, and content)
-        # Assuming the 'documents' table exists with columns: id, user_id, file_name, content
-        # If your table has a file_path, you would save the file to a cloud storage (S3/GCS) 
-        # or local disk and save the path here. For now, we save content directly.
-        
-        # NOTE: Your schema requested user_id, file_name, file_path.
-        # We'll use the 'content' column to hold the extracted text for simplicity.
-        # If you must stick to file_path, you'd save the file locally here:
-        
-        # --- Local File Saving Placeholder (if needed to match your requested schema) ---
-        # file_location = f"./uploaded_files/{user_id}_{document_id}_{file.filename}"
-        # os.makedirs(os.path.dirname(file_location), exist_ok=True)
-        # with open(file_location, "wb") as f:
-        #     f.write(await file.read())
-        # file_path = file_location 
-        
-        # For this example, let's use the extracted text as the main stored data:
-        file_path = f"Text content saved: {len(extracted_content)} bytes." # Placeholder for path
-        
-        await db.execute(
-            """
-            INSERT INTO documents (id, user_id, file_name, file_path, content) 
-            VALUES ($1, $2, $3, $4, $5)
-            """,
-            document_id, user_id, file.filename, file_path, extracted_content
-        )
-        
-        print(f"Document saved with ID: {document_id}")
-        
-        return {"document_id": document_id, "file_name": file.filename}
 
-    except Exception as e:
-        print(f"Error during file upload: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to process file upload: {str(e)}")
-
-@router.post("/send")
-async def send_chat_stream(
-    request_data: ChatRequest, 
-    db=Depends(get_db), 
-    user_id=authenticated_user()  # Dependency to ensure authentication
-):
-    """
-    Endpoint for streaming AI responses via Server-Sent Events (SSE).
-    (Existing streaming logic)
-    """
-    print("Processing chat request")
-    chat_id = request_data.chat_id
-    user_message = request_data.message
-    model_identifier = request_data.model
-    is_cloud = request_data.is_cloud
-
-    if not user_message or not chat_id:
-        raise HTTPException(status_code=400, detail="message and chat_id required")
-
-    # 1. Save user message to DB
-    print(f"Saving user message to DB: chat_id={chat_id}, role=user, content={user_message}")
-    # Note: Use parameter binding ($1, $2, etc.) for SQL injection prevention
-    await db.execute(
-        """INSERT INTO messages (chat_id, role, content) VALUES ($1, $2, $3)""",
-        chat_id, "user", user_message
-    )
-
-    # 2. Retrieve history and build context prompt
-    # history will be used by the model stream helpers to build the full context
-    history = await get_chat_history(db, chat_id, limit=10)
-    prompt = build_context_prompt(history, user_message)
-    print(f"Built context prompt (truncated for display): {prompt[:100]}...")
-
-    try:
-        # 3. Get the correct LLM client
-        llm_client = llm_service.get_llm_client(model_identifier, is_cloud)
-        # Extract just the model name (e.g., "llama3" or "gemini-2.5-flash")
-        model_name = model_identifier.split(":")[1] 
-
-        # 4. Define the async generator for SSE
-        async def event_generator():
-            full_response_text = ""
-            
-            # --- Ollama Streaming Logic ---
-            if model_identifier.startswith("ollama:"):
-                print(f"Streaming from Ollama model: {model_name}")
-                # get_ollama_stream is assumed to handle history and return an async iterable of dicts
-                stream = await get_ollama_stream(
-                    llm_client, 
-                    model_name, # Ollama stream often takes just the model name
-                    history, # Pass the history for the stream utility to construct messages
-                    user_message # Pass the latest message
-                )
-                
-                async for chunk in stream:
-                    # Ollama chunks often contain the content under the 'content' key in the 'message' dict
-                    content_chunk = chunk.get("message", {}).get("content", "")
-                    if content_chunk:
-                        full_response_text += content_chunk
-                        # SSE format: data: <JSON object>\n\n
-                        yield f"data: {json.dumps({'content': content_chunk})}\n\n"
-                    
-            # --- Gemini Streaming Logic ---
-            elif model_identifier.startswith("gemini:"):
-                print(f"Streaming from Gemini model: {model_name}")
-                # get_gemini_stream is assumed to handle history and return an async iterable of Response objects
-                stream = await get_gemini_stream(
-                    llm_client,
-                    model_name,
-                    history, # Pass the history for the stream utility to construct contents
-                    user_message # Pass the latest message
+        # 3. Look the content up by hash. New content is extracted to a temporary pages
+        # file first, without holding a connection; only the inserts below use one.
+        async with acquire_db() as db:
+            existing = await _find_content(db, spooled.sha256)
+        with tempfile.TemporaryFile(dir=UPLOAD_SPOOL_DIR) as pages_file:
+            if existing is not None:
+                pages, characters = existing["page_count"], existing["character_count"]
+            else:
+                pages, characters = await _extract_pages(spooled, pages_file)
+
+            # 4. Store the content if it is new and add the documents row that references it.
+            # documents.content stays NULL.
+            async with acquire_db() as db, db.transaction():
+                extracted = existing is None and await _store_content(db, spooled, pages_file, pages, characters)
+                await db.execute(
+                    """
+                    INSERT INTO documents (id, user_id, file_name, file_path, content, content_hash)
+                    VALUES ($1, $2, $3, $4, NULL, $5)
+                    """,
+                    document_id, user_id, spooled.filename, f"Text content saved in {DOCUMENT_PAGES_TABLE}.", spooled.sha256
                 )
 
-                async for chunk in stream:
-                 # Gemini chunks may not always contain 'text'
-                    content_chunk = getattr(chunk, "text", "") or ""
-
-                    if content_chunk:
-                        full_response_text += content_chunk
-
-                        # SSE format: data: <JSON object>\n\n
-                        yield f"data: {json.dumps({'content': content_chunk})}\n\n"
-
-                            
-            # 5. After the stream ends, parse and save the full assistant message
-            
-            # Use the markdown parser to separate content and code
-            content, code = parse_llm_response(full_response_text)
-            print(f"Parsed response: content={content[:50]}..., code={code[:50]}...")
-            
-            # Save the full assistant response
-            print(f"Saving assistant response to DB: chat_id={chat_id}, role=assistant...")
-            await db.execute(
-                """INSERT INTO messages (chat_id, role, content, code) VALUES ($1, $2, $3, $4)""",
-                chat_id, "assistant", content, code
-            )
-            
-            # Send a 'done' message to the client
-            yield f"data: {json.dumps({'content': '[DONE]', 'db_saved': True, 'has_code': bool(code)})}\n\n"
-
-        # Return the StreamingResponse
-        return StreamingResponse(
-            event_generator(),
-            media_type="text/event-stream"
+        _stats["extracted" if extracted else "deduplicated"] += 1
+        # 5. Make the document searchable for the assistant, in the background
+        retriever.schedule(user_id, spooled.sha256)
+        print(f"Document saved with ID: {document_id} ({spooled.size} bytes, {pages} pages, "
+              f"{'extracted' if extracted else 'already stored'})")
+
+        # Whether the content was stored already stays out of the response: content is shared
+        # across users, so it would tell anyone whether someone else uploaded the same file
+        return {
+            "document_id": document_id,
+            "file_name": spooled.filename,
+            "pages": pages,
+            "characters": characters,
+        }
+
+    except HTTPException:
+        raise
+    except ExtractionTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Document could not be parsed within {EXTRACT_TIMEOUT_SECONDS:g} seconds."
         )
-
     except Exception as e:
-        print(f"Error processing chat request: {e}")
-        # Send an error message to the client before raising the HTTP exception
-        return StreamingResponse(
-            (f"data: {json.dumps({'content': 'An error occurred during streaming.', 'error': str(e)})}\n\n",
-             f"data: {json.dumps({'content': '[DONE]', 'db_saved': False})}\n\n"),
-            media_type="text/event-stream",
-            status_code=500
-        )
\ No newline at end of file
+        print(f"Error during file upload: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to process file upload: {str(e)}")
+    finally:
+        remove_spooled(spooled.path)
@@ -1,9 +1,11 @@
-from fastapi import Depends, HTTPException, APIRouter
-from fastapi.responses import JSONResponse
+from typing import Literal
+from fastapi import Depends, HTTPException, APIRouter, Query
 import os
 from app.utils.database import get_db
 from app.models.schemas import Message
 from app.utils.auth import get_current_user
+from app.utils.pagination import decode_cursor, PageTracker, MESSAGE_PAGE_SIZE, MESSAGE_MAX_PAGE_SIZE
+from app.utils.json_stream import iter_rows, streaming_json_response
 
 router = APIRouter()
 
@@ -12,17 +14,48 @@ def authenticated_user():
     return Depends(get_current_user)
 
 @router.get("/messages/{chat_id}")
-async def get_messages(chat_id: int, db=Depends(get_db), user_id=authenticated_user()):
+async def get_messages(
+    chat_id: int,
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MESSAGE_MAX_PAGE_SIZE),
+    cursor: str = None,
+    direction: Literal["older", "newer"] = "older",
+    db=Depends(get_db),
+    user_id=authenticated_user()
+):
     """
-    Retrieve all messages for a specific chat.
-    """
-    query = """
-        SELECT id, chat_id, role, content, created_at
-        FROM messages
-        WHERE chat_id = $1
-        ORDER BY created_at ASC
-    """
-    result = await db.fetch(query, chat_id)
-    return JSONResponse(content=[dict(row) for row in result])
+    Retrieve one page of messages for a specific chat, in chronological order.
 
+    Without a cursor this returns the most recent messages. To load older
+    messages pass the returned next_cursor with direction=older; direction=newer
+    walks forward from a cursor instead.
+    """
+    params = [chat_id]
+    keyset = ""
+    if cursor:
+        created_at, message_id = decode_cursor(cursor)
+        params.extend([created_at, message_id])
+        comparison = "<" if direction == "older" else ">"
+        keyset = f"AND (created_at, id) {comparison} ($2, $3)"
 
+    # Fetch one extra row to learn whether another page exists. Rows are numbered
+    # in keyset order and always come back oldest first for the chat view.
+    params.append(limit + 1)
+    keyset_order = "DESC" if direction == "older" else "ASC"
+    query = f"""
+        SELECT id, chat_id, role, content, created_at, rn
+        FROM (
+            SELECT id, chat_id, role, content, created_at,
+                   row_number() OVER (ORDER BY created_at {keyset_order}, id {keyset_order}) AS rn
+            FROM messages
+            WHERE chat_id = $1 {keyset}
+            ORDER BY created_at {keyset_order}, id {keyset_order}
+            LIMIT ${len(params)}
+        ) page
+        ORDER BY created_at ASC, id ASC
+    """
+    page = PageTracker(limit)
+    return streaming_json_response(
+        "messages",
+        page.rows(iter_rows(db, query, *params)),
+        lambda: {"next_cursor": page.next_cursor, "direction": direction},
+    )
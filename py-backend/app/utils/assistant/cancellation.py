@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+from typing import AsyncIterator
+from fastapi import Request
+
+# How often the client connection is checked while waiting on the model
+DISCONNECT_POLL_INTERVAL_MS = float(os.getenv("DISCONNECT_POLL_INTERVAL_MS", "250"))
+
+# Weight of the newest completed answer in the per-model running averages
+_AVERAGE_WEIGHT = 0.1
+
+
+class GenerationState:
+    """
+    Tracks one upstream generation: when it started, the text it produced so far
+    and whether it was cut short because the client went away.
+    """
+    def __init__(self, model_identifier: str):
+        self.model_identifier = model_identifier
+        self.started_at = time.perf_counter()
+        # Chunks are collected in a list and joined once, keeping accumulation linear
+        self.parts: list[str] = []
+        self.disconnected = False
+        # Set when the chunks came from a generation started by another, identical request
+        self.shared = False
+        # The model that actually answered; differs from model_identifier after a fallback
+        self.answered_by = model_identifier
+
+    @property
+    def chunks(self) -> int:
+        return len(self.parts)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+class CancellationStats:
+    """
+    Counts cancelled generations and estimates the work cancellation saved.
+
+    The length of an answer that never finished is unknown, so savings are
+    estimated from the running average duration and chunk count of completed
+    answers of the same model. Ollama streams roughly one token per chunk.
+    """
+    def __init__(self):
+        self._averages: dict[str, tuple[float, float]] = {}
+        self.cancelled = 0
+        self.completed = 0
+        self.generation_seconds_spent = 0.0
+        self.generation_seconds_saved = 0.0
+        self.chunks_saved = 0.0
+
+    def record_completed(self, state: GenerationState):
+        self.completed += 1
+        duration, chunks = state.elapsed, float(state.chunks)
+        previous = self._averages.get(state.model_identifier)
+        if previous is not None:
+            duration = previous[0] + _AVERAGE_WEIGHT * (duration - previous[0])
+            chunks = previous[1] + _AVERAGE_WEIGHT * (chunks - previous[1])
+        self._averages[state.model_identifier] = (duration, chunks)
+
+    def record_cancelled(self, state: GenerationState):
+        self.cancelled += 1
+        elapsed = state.elapsed
+        self.generation_seconds_spent += elapsed
+        average = self._averages.get(state.model_identifier)
+        if average is not None:
+            self.generation_seconds_saved += max(0.0, average[0] - elapsed)
+            self.chunks_saved += max(0.0, average[1] - state.chunks)
+
+    def stats(self) -> dict:
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "generation_seconds_spent_before_cancel": self.generation_seconds_spent,
+            "estimated_generation_seconds_saved": self.generation_seconds_saved,
+            "estimated_chunks_saved": self.chunks_saved,
+        }
+
+
+cancellation_stats = CancellationStats()
+
+
+async def _wait_for_disconnect(request: Request):
+    interval = DISCONNECT_POLL_INTERVAL_MS / 1000
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+
+
+async def stop_on_disconnect(
+    request: Request,
+    chunks: AsyncIterator[str],
+    state: GenerationState,
+) -> AsyncIterator[str]:
+    """
+    Passes chunks through until the client disconnects, then cancels the pending
+    upstream read and closes the upstream stream, which aborts the model request.
+    Sets state.disconnected when that happens and records every chunk that passes.
+
+    Servers that cancel the response task on disconnect make this end with
+    CancelledError instead; the watcher covers servers that only notice the
+    disconnect on the next write, which may be long after the model went quiet.
+    """
+    iterator = chunks.__aiter__()
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    pending: asyncio.Future | None = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait({pending, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                state.disconnected = True
+                print(f"Client disconnected, cancelling generation of {state.model_identifier}")
+                break
+            finished, pending = pending, None
+            try:
+                chunk = finished.result()
+            except StopAsyncIteration:
+                break
+            state.parts.append(chunk)
+            yield chunk
+    finally:
+        watcher.cancel()
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -1,4 +1,26 @@
+import os
+from typing import Optional
+from orjson import loads
 from app.models.schemas import Message
+from app.utils.assistant.parser import CodeBlock, render_markdown
+from app.utils.assistant.history_cache import history_cache, CachedMessage, take_within_budget
+from app.utils.assistant.tokens import CHARS_PER_TOKEN, MESSAGE_FRAMING_TOKENS, count_tokens, truncate_to_tokens
+
+# Tokens of chat history sent to the model per turn, unless MODEL_CONTEXT_BUDGETS says otherwise
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Per-model overrides, e.g. "ollama:llama3=6000,gemini:gemini-2.5-flash=24000"
+MODEL_CONTEXT_BUDGETS = {
+    model.strip(): int(budget)
+    for model, budget in (
+        entry.rsplit("=", 1) for entry in os.getenv("MODEL_CONTEXT_BUDGETS", "").split(",") if "=" in entry
+    )
+}
+# Hard cap on history rows per turn, however small they are
+MAX_HISTORY_MESSAGES = 200
+# Budget kept free for the wording around the summary and document excerpts, which the
+# token counts of the texts themselves do not cover (each message's framing is counted
+# with the message, see MESSAGE_FRAMING_TOKENS)
+PROMPT_OVERHEAD_TOKENS = 64
 
 SYSTEM_PROMPT = """
 You are a helpful and concise assistant. Your task is to respond to the user's latest question.
@@ -6,7 +28,7 @@ Use the provided chat history as context to determine if the user's question is
 If related, use the context for a more informed and appropriate answer.
 If your response contains code, you MUST format it in a Markdown fenced code block (e.g., ```python ... ```).
 
-Chat History:
+{summary_context}Chat History:
 ---
 {history_context}
 ---
@@ -14,35 +36,98 @@ Chat History:
 User's current question: "{current_message}"
 """
 
-async def get_chat_history(db, chat_id: int, limit: int = 10) -> list[Message]:
-    """Retrieves the last N messages for a chat."""
-    print(f"Fetching chat history for chat_id: {chat_id}, limit: {limit}")
-    query = """
-        SELECT role, content, code
-        FROM messages
-        WHERE chat_id = $1
-        ORDER BY created_at DESC
-        LIMIT $2
+def message_token_count(content: str, code: Optional[str] = None) -> int:
+    """Token count stored with a message, covering its text and code."""
+    return count_tokens(content) + count_tokens(code)
+
+
+def history_text(content: str, code: Optional[str] = None, code_blocks: Optional[str] = None) -> str:
+    """
+    The text of a stored message as it goes back to the model: the content with every
+    code block of messages.code_blocks fenced in place. Rows written before code_blocks
+    existed only have their first block, in messages.code, which goes after the content.
     """
-    rows = await db.fetch(query, chat_id, limit)
-    print(f"Retrieved {len(rows)} messages from the database")
-    # Reverse to maintain chronological order for the prompt
-    return [Message(**dict(row)) for row in reversed(rows)]
+    if code_blocks:
+        return render_markdown(content, [CodeBlock(**block) for block in loads(code_blocks)])
+    if code:
+        return f"{content}\n```\n{code}\n```"
+    return content
+
+
+def get_context_budget(model_identifier: str) -> int:
+    """Returns the prompt token budget for a model identifier (see MODEL_CONTEXT_BUDGETS)."""
+    return MODEL_CONTEXT_BUDGETS.get(model_identifier, CONTEXT_TOKEN_BUDGET)
+
 
-def build_context_prompt(history: list[Message], current_message: str) -> str:
-    """Formats the history into a single context string for the prompt."""
+async def get_chat_history(
+    db, chat_id: int, token_budget: int = CONTEXT_TOKEN_BUDGET, after_id: int = 0
+) -> list[Message]:
+    """
+    Retrieves the most recent messages of a chat whose stored token counts (plus
+    MESSAGE_FRAMING_TOKENS each) fit in token_budget, walking from newest to oldest;
+    the message that crosses the budget is cut to fit (see take_within_budget).
+    Messages up to after_id are skipped; they are already covered by the chat's
+    rolling summary.
+    Served from the history cache when the chat is warm, otherwise loaded from the database.
+    """
+    cached = history_cache.get(chat_id, token_budget, after_id)
+    if cached is None:
+        print(f"Fetching chat history for chat_id: {chat_id}, token budget: {token_budget}")
+        # The running total lets the database stop after the first row that no longer fits.
+        # Rows written before token counts were stored fall back to the same estimate in SQL.
+        query = f"""
+            SELECT id, role, content, code, code_blocks, tokens
+            FROM (
+                SELECT id, role, content, code, code_blocks, created_at, tokens,
+                       SUM(tokens + {MESSAGE_FRAMING_TOKENS}) OVER (ORDER BY created_at DESC, id DESC) AS running
+                FROM (
+                    SELECT id, role, content, code, code_blocks, created_at,
+                           COALESCE(
+                               token_count,
+                               length(content) / {CHARS_PER_TOKEN} + 1
+                                 + COALESCE(length(code) / {CHARS_PER_TOKEN} + 1, 0)
+                           ) AS tokens
+                    FROM messages
+                    WHERE chat_id = $1 AND id > $4
+                ) counted
+            ) totals
+            WHERE running - tokens - {MESSAGE_FRAMING_TOKENS} <= $2
+            ORDER BY created_at DESC, id DESC
+            LIMIT $3
+        """
+        rows = await db.fetch(query, chat_id, token_budget, MAX_HISTORY_MESSAGES, after_id)
+        print(f"Retrieved {len(rows)} messages from the database")
+        # Reverse to maintain chronological order for the prompt
+        messages = [
+            CachedMessage(id, role, history_text(content, code, code_blocks), tokens)
+            for id, role, content, code, code_blocks, tokens in reversed(rows)
+        ]
+        cached, exhausted = take_within_budget(messages, token_budget)
+        complete = not exhausted and len(rows) < MAX_HISTORY_MESSAGES
+        history_cache.fill(chat_id, messages, complete=complete, after_id=after_id)
+
+    # Rows come from our own table, so skip re-validating them
+    return [
+        Message.model_construct(
+            chat_id=chat_id, role=m.role, content=m.content, token_count=m.token_count
+        )
+        for m in cached
+    ]
+
+def build_context_prompt(history: list[Message], current_message: str, summary: Optional[str] = None) -> str:
+    """
+    Formats the history into a single context string for the prompt.
+    A summary of older turns, if any, is placed before the recent history.
+    """
     print("Building context prompt")
     history_context = ""
     for msg in history:
-        # Format the message for the model context
-        content = msg.content
-        if msg.role == "assistant" and msg.code:
-            # Include code for context if it was an assistant message
-            content += f"\n```\n{msg.code}\n```"
-        
-        history_context += f"- **{msg.role.capitalize()}**: {content}\n"
+        # Assistant answers already carry their code blocks (see history_text)
+        history_context += f"- **{msg.role.capitalize()}**: {msg.content}\n"
 
+    summary_context = f"Summary of earlier conversation:\n---\n{summary}\n---\n\n" if summary else ""
     return SYSTEM_PROMPT.format(
+        summary_context=summary_context,
         history_context=history_context.strip() or "No previous context.",
         current_message=current_message
     )
\ No newline at end of file
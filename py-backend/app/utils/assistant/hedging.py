@@ -0,0 +1,187 @@
+import os
+import asyncio
+from typing import Any, AsyncIterator, Callable, NamedTuple, Optional
+from app.utils.assistant.cancellation import GenerationState
+from app.utils.assistant.model_selector import llm_service
+
+# Model to fall back to per model, e.g. "ollama:llama3=gemini:gemini-2.5-flash,gemini:gemini-2.5-flash=ollama:llama3".
+# An Ollama fallback runs on the same Ollama backend as the requested Ollama model, and locally
+# for other models; if that backend is not in LLM_BACKENDS, on the other one.
+MODEL_FALLBACKS = {
+    model.strip(): fallback.strip()
+    for model, fallback in (
+        entry.split("=", 1) for entry in os.getenv("MODEL_FALLBACKS", "").split(",") if "=" in entry
+    )
+}
+# How long to wait for the first chunk before also asking the fallback model
+HEDGE_FIRST_TOKEN_DEADLINE_MS = float(os.getenv("HEDGE_FIRST_TOKEN_DEADLINE_MS", "4000"))
+# Per-model deadlines, e.g. "ollama:llama3=2500"
+MODEL_HEDGE_DEADLINES_MS = {
+    model.strip(): float(deadline)
+    for model, deadline in (
+        entry.rsplit("=", 1) for entry in os.getenv("MODEL_HEDGE_DEADLINES_MS", "").split(",") if "=" in entry
+    )
+}
+
+
+class ModelChoice(NamedTuple):
+    model_identifier: str
+    is_cloud: bool
+
+
+class AnsweredBy(NamedTuple):
+    """Marker passed down a text stream when another model than the requested one answers."""
+    model_identifier: str
+
+
+def fallback_for(model_identifier: str, is_cloud: bool) -> Optional[ModelChoice]:
+    """
+    Returns the configured fallback of a model (see MODEL_FALLBACKS), or None if it has
+    none or no enabled backend serves it.
+    """
+    fallback = MODEL_FALLBACKS.get(model_identifier)
+    if not fallback or fallback == model_identifier:
+        return None
+    prefer_cloud = is_cloud and model_identifier.startswith("ollama:")
+    for cloud in (prefer_cloud, not prefer_cloud):
+        backend = llm_service.backend_for(fallback, cloud)
+        if backend in llm_service.backends:
+            return ModelChoice(fallback, backend != "ollama_local")
+    return None
+
+
+def first_token_deadline(model_identifier: str) -> float:
+    """Seconds to wait for the first chunk of a model before hedging."""
+    return MODEL_HEDGE_DEADLINES_MS.get(model_identifier, HEDGE_FIRST_TOKEN_DEADLINE_MS) / 1000
+
+
+class HedgingStats:
+    def __init__(self):
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def stats(self) -> dict:
+        return {
+            "fallbacks_configured": len(MODEL_FALLBACKS),
+            "hedged": self.hedged,
+            "fallback_won_race": self.hedge_wins,
+            "failovers": self.failovers,
+        }
+
+
+hedging_stats = HedgingStats()
+
+
+class _Attempt:
+    """One model generating an answer, with its first read already in flight."""
+    def __init__(self, model_identifier: Optional[str], chunks: AsyncIterator[str]):
+        self.model_identifier = model_identifier
+        self.iterator = chunks.__aiter__()
+        self.next = asyncio.ensure_future(self.iterator.__anext__())
+
+    async def close(self):
+        self.next.cancel()
+        await asyncio.wait({self.next})
+        aclose = getattr(self.iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+async def hedged_stream(
+    primary: Optional[Callable[[], AsyncIterator[str]]],
+    fallback: Optional[ModelChoice],
+    start_fallback: Optional[Callable[[], AsyncIterator[str]]],
+    deadline: float,
+) -> AsyncIterator[Any]:
+    """
+    Streams the primary model's answer. If its first chunk has not arrived within
+    deadline seconds, the fallback is started too, and whichever produces a chunk
+    first answers while the other is cancelled. If the primary fails before its
+    first chunk, the fallback takes over at once. Without a primary (its client could
+    not be created or its queue is full), the fallback answers directly.
+
+    When the fallback answers, an AnsweredBy marker precedes its chunks
+    (see track_answering_model).
+    """
+    if primary is None:
+        hedging_stats.failovers += 1
+        yield AnsweredBy(fallback.model_identifier)
+        async for chunk in start_fallback():
+            yield chunk
+        return
+    if start_fallback is None:
+        async for chunk in primary():
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + max(0.0, deadline)
+    attempts = [_Attempt(None, primary())]
+    fallback_started = False
+    raced = False
+    winner: Optional[_Attempt] = None
+    first: Optional[str] = None
+
+    def start_fallback_attempt():
+        nonlocal fallback_started
+        fallback_started = True
+        attempts.append(_Attempt(fallback.model_identifier, start_fallback()))
+
+    try:
+        while winner is None:
+            pending = {attempt.next: attempt for attempt in attempts}
+            timeout = None if fallback_started else max(0.0, give_up_at - loop.time())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                print(f"No first chunk within {deadline:.1f}s, also asking {fallback.model_identifier}")
+                hedging_stats.hedged += 1
+                raced = True
+                start_fallback_attempt()
+                continue
+            for future in done:
+                attempt = pending[future]
+                try:
+                    first = future.result()
+                except StopAsyncIteration:
+                    # An empty answer is still an answer
+                    first = None
+                except Exception as e:
+                    attempts.remove(attempt)
+                    await attempt.close()
+                    if attempts:
+                        continue
+                    if fallback_started:
+                        raise
+                    print(f"Generation failed before the first chunk ({e}), falling back to {fallback.model_identifier}")
+                    hedging_stats.failovers += 1
+                    start_fallback_attempt()
+                    continue
+                winner = attempt
+                break
+    finally:
+        for attempt in attempts:
+            if attempt is not winner:
+                await attempt.close()
+
+    try:
+        if winner.model_identifier is not None:
+            if raced:
+                hedging_stats.hedge_wins += 1
+            yield AnsweredBy(winner.model_identifier)
+        if first is None:
+            return
+        yield first
+        async for chunk in winner.iterator:
+            yield chunk
+    finally:
+        await winner.close()
+
+
+async def track_answering_model(chunks: AsyncIterator[Any], state: GenerationState) -> AsyncIterator[str]:
+    """Drops AnsweredBy markers from a text stream, recording the model in state.answered_by."""
+    async for chunk in chunks:
+        if isinstance(chunk, AnsweredBy):
+            state.answered_by = chunk.model_identifier
+            continue
+        yield chunk
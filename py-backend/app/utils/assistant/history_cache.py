@@ -0,0 +1,160 @@
+import os
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+from app.utils.assistant.tokens import MESSAGE_FRAMING_TOKENS, count_tokens, truncate_to_tokens
+
+# Number of active chats whose recent turns are kept in memory
+HISTORY_CACHE_MAX_CHATS = int(os.getenv("HISTORY_CACHE_MAX_CHATS", "1000"))
+# Most recent messages kept per chat; contexts that need older turns go to the database
+HISTORY_CACHE_MAX_MESSAGES = int(os.getenv("HISTORY_CACHE_MAX_MESSAGES", "50"))
+# Upper bound for the text held by the cache across all chats
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Rough per-message overhead of the tuple and its fields, on top of the text itself
+_MESSAGE_OVERHEAD_BYTES = 200
+# The message that crosses a token budget is cut to fit, unless less than this is left for it
+MIN_TRUNCATED_TOKENS = 32
+
+
+class CachedMessage(NamedTuple):
+    """
+    Compact, immutable form of a stored message. For assistant answers, content is the
+    text as the model wrote it, with every code block fenced where it was (render_markdown).
+    """
+    id: int
+    role: str
+    content: str
+    token_count: int
+
+
+def _message_size(message: CachedMessage) -> int:
+    return _MESSAGE_OVERHEAD_BYTES + len(message.content)
+
+
+def _truncate(message: CachedMessage, max_tokens: int) -> CachedMessage:
+    """The message cut to max_tokens."""
+    content = truncate_to_tokens(message.content, max_tokens)
+    return message._replace(content=content, token_count=count_tokens(content))
+
+
+def take_within_budget(messages: list[CachedMessage], token_budget: int) -> tuple[list[CachedMessage], bool]:
+    """
+    Takes messages from newest to oldest while their token counts, plus
+    MESSAGE_FRAMING_TOKENS each, fit the budget.
+    The first one that does not fit is cut to the rest of the budget and ends the
+    selection, so one long message does not leave the model without any history.
+    `messages` is in chronological order. Returns (selected messages oldest first,
+    whether the budget ran out before the messages did).
+    """
+    used = 0
+    start = len(messages)
+    while start > 0:
+        tokens = messages[start - 1].token_count + MESSAGE_FRAMING_TOKENS
+        if used + tokens > token_budget:
+            selected = messages[start:]
+            left = token_budget - used - MESSAGE_FRAMING_TOKENS
+            if left >= MIN_TRUNCATED_TOKENS:
+                selected.insert(0, _truncate(messages[start - 1], left))
+            return selected, True
+        used += tokens
+        start -= 1
+    return messages, False
+
+
+class _ChatEntry:
+    __slots__ = ("messages", "complete", "after_id", "size")
+
+    def __init__(self, messages, complete: bool, after_id: int):
+        self.messages: deque[CachedMessage] = deque(messages, maxlen=HISTORY_CACHE_MAX_MESSAGES)
+        # True while the entry holds every message of the chat with an id above after_id
+        self.complete = complete
+        self.after_id = after_id
+        self.size = sum(_message_size(m) for m in self.messages)
+
+
+class ChatHistoryCache:
+    """
+    Write-through LRU of the most recent messages of active chats.
+
+    Filled from the database on the first history request for a chat, then kept
+    current by append() as send_chat_stream stores new messages, so warm turns
+    need no history query. delete_chat drops the entry through invalidate().
+    """
+    def __init__(self):
+        self._chats: "OrderedDict[int, _ChatEntry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chat_id: int, token_budget: int, after_id: int = 0) -> Optional[list[CachedMessage]]:
+        """
+        Returns the most recent messages with an id above after_id that fit in
+        token_budget, oldest first, or None on a miss: either the chat is not
+        cached or the budget reaches further back than the cached turns do.
+        """
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            messages = [m for m in entry.messages if m.id > after_id]
+            selected, exhausted = take_within_budget(messages, token_budget)
+            covered = entry.complete and entry.after_id <= after_id
+            if exhausted or covered or len(messages) < len(entry.messages):
+                self._chats.move_to_end(chat_id)
+                self.hits += 1
+                return selected
+        self.misses += 1
+        return None
+
+    def fill(self, chat_id: int, messages: list[CachedMessage], complete: bool, after_id: int = 0):
+        """
+        Stores the most recent messages of a chat (oldest first) as loaded from the database.
+        complete says whether they are all the messages with an id above after_id.
+        """
+        self.invalidate(chat_id)
+        entry = _ChatEntry(messages, complete and len(messages) <= HISTORY_CACHE_MAX_MESSAGES, after_id)
+        self._chats[chat_id] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def append(self, chat_id: int, message: CachedMessage):
+        """Adds a newly stored message to a cached chat. Chats not in the cache are left alone."""
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return
+        if len(entry.messages) == entry.messages.maxlen:
+            dropped = entry.messages[0]
+            entry.size -= _message_size(dropped)
+            self._bytes -= _message_size(dropped)
+            entry.complete = False
+        entry.messages.append(message)
+        entry.size += _message_size(message)
+        self._bytes += _message_size(message)
+        self._chats.move_to_end(chat_id)
+        self._evict()
+
+    def invalidate(self, chat_id: int):
+        entry = self._chats.pop(chat_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        while self._chats and (len(self._chats) > HISTORY_CACHE_MAX_CHATS or self._bytes > HISTORY_CACHE_MAX_BYTES):
+            _, entry = self._chats.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "chats": len(self._chats),
+            "messages": sum(len(entry.messages) for entry in self._chats.values()),
+            "approx_bytes": self._bytes,
+            "max_bytes": HISTORY_CACHE_MAX_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+history_cache = ChatHistoryCache()
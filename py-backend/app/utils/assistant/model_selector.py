@@ -1,11 +1,19 @@
 import os
+import time
+import asyncio
 from ollama import AsyncClient as OllamaAsyncClient
-from google import genai  
+from app.utils.assistant.ollama_pool import OllamaHostPool
 # The Ollama cloud models use the Ollama API, but require authentication and a specific host.
+# The Gemini SDK is imported only when its client is first needed (see _create_gemini).
 
 # --- Configuration Constants ---
 # Ollama Local: Standard default host
 OLLAMA_LOCAL_HOST = "http://localhost:11434"
+# Several self-hosted Ollama servers, comma separated. Requests are spread over them
+# by OllamaHostPool; defaults to the single standard host.
+OLLAMA_LOCAL_HOSTS = [
+    url.strip() for url in os.environ.get("OLLAMA_LOCAL_HOSTS", OLLAMA_LOCAL_HOST).split(",") if url.strip()
+]
 
 # Ollama Cloud: Official host for their hosted models (requires API key)
 OLLAMA_CLOUD_HOST = "https://ollama.com" 
@@ -13,43 +21,105 @@ OLLAMA_CLOUD_API_KEY = os.environ.get("OLLAMA_CLOUD_API_KEY")
 
 # Gemini: Uses the official SDK and requires the API key
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+# Overrides the Gemini API endpoint, e.g. for a proxy or a local test server
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL") or None
+# HTTP timeout of Gemini requests: connecting, and waiting for each read of a stream
+GEMINI_HTTP_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_HTTP_TIMEOUT_SECONDS", "60"))
+# Gemini streams must produce their first chunk, and every chunk after it, within these limits
+GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS", "30"))
+GEMINI_CHUNK_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_CHUNK_TIMEOUT_SECONDS", "30"))
+# Retries of transient failures (rate limits, 5xx, dropped connections) before the first chunk,
+# waiting GEMINI_RETRY_BASE_DELAY_SECONDS, then twice that, and so on (with jitter)
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "2"))
+GEMINI_RETRY_BASE_DELAY_SECONDS = float(os.environ.get("GEMINI_RETRY_BASE_DELAY_SECONDS", "0.5"))
+
+# Backends this deployment uses. Clients are only ever created for these, on first use.
+LLM_BACKENDS = [
+    name.strip() for name in os.environ.get("LLM_BACKENDS", "ollama_local,ollama_cloud,gemini").split(",")
+    if name.strip()
+]
+
+# How long Ollama keeps a model loaded after a request (Ollama duration string, e.g. "30m").
+# None leaves the server default in place.
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE") or None
+# Local Ollama models to load at startup, comma separated (e.g. "llama3,qwen2.5-coder")
+OLLAMA_WARMUP_MODELS = [
+    name.strip() for name in os.environ.get("OLLAMA_WARMUP_MODELS", "").split(",") if name.strip()
+]
 
 class LLMService:
     """
     A service class to manage different LLM clients (local Ollama, cloud Ollama, Gemini).
     
-    This handles proper authentication setup for each service.
+    This handles proper authentication setup for each service. Clients are created
+    lazily on first use and only for the backends listed in LLM_BACKENDS.
     """
-    def __init__(self):
-        # 1. Initialize Ollama Local Client (no auth needed, typically)
-        self.ollama_local_client = OllamaAsyncClient(host=OLLAMA_LOCAL_HOST)
-        print(f"Ollama Local Client initialized for host: {OLLAMA_LOCAL_HOST}")
+    def __init__(self, backends: list[str] = LLM_BACKENDS):
+        self.backends = backends
+        self._clients = {}
+        # Health and model-inventory probes of the local Ollama hosts (see _create_ollama_local)
+        self._ollama_probes: asyncio.Task | None = None
+        self._factories = {
+            "ollama_local": self._create_ollama_local,
+            "ollama_cloud": self._create_ollama_cloud,
+            "gemini": self._create_gemini,
+        }
+        unknown = [name for name in backends if name not in self._factories]
+        if unknown:
+            raise ValueError(f"Unknown LLM backends in LLM_BACKENDS: {', '.join(unknown)}")
+        print(f"LLM backends enabled: {', '.join(backends) or 'none'}")
+
+    def _client(self, backend: str):
+        """Returns the client of a backend, creating it on first use."""
+        if backend not in self.backends:
+            raise ValueError(f"LLM backend '{backend}' is not enabled. Add it to the LLM_BACKENDS environment variable.")
+        client = self._clients.get(backend)
+        if client is None:
+            client = self._clients[backend] = self._factories[backend]()
+        return client
+
+    def _create_ollama_local(self):
+        # Initialize the pool of self-hosted Ollama servers (no auth needed, typically)
+        client = OllamaHostPool(OLLAMA_LOCAL_HOSTS)
+        print(f"Ollama Local Client initialized for hosts: {', '.join(OLLAMA_LOCAL_HOSTS)}")
+        # Probing starts with the pool, so a deployment that never sends a request to local
+        # Ollama (and has no warm-up models configured) never polls its hosts
+        self._ollama_probes = asyncio.get_running_loop().create_task(client.run_probes())
+        return client
 
-        # 2. Initialize Ollama Cloud Client (requires API key and specific host)
+    def _create_ollama_cloud(self):
+        # Initialize Ollama Cloud Client (requires API key and specific host)
         ollama_cloud_headers = {}
         if OLLAMA_CLOUD_API_KEY:
             # For the official Ollama Cloud API, authentication is via a Bearer token
             ollama_cloud_headers['Authorization'] = f'Bearer {OLLAMA_CLOUD_API_KEY}'
         
-        # NOTE: The client will still be initialized even if the key is missing, 
-        # but API calls will fail, which is handled in the get_llm_client method.
-        self.ollama_cloud_client = OllamaAsyncClient(
+        client = OllamaAsyncClient(
             host=OLLAMA_CLOUD_HOST, 
             headers=ollama_cloud_headers
         )
-        if OLLAMA_CLOUD_API_KEY:
-             print(f"Ollama Cloud Client initialized for host: {OLLAMA_CLOUD_HOST} (Authenticated)")
-        else:
-             print(f"Ollama Cloud Client initialized for host: {OLLAMA_CLOUD_HOST} (API Key MISSING)")
-
+        print(f"Ollama Cloud Client initialized for host: {OLLAMA_CLOUD_HOST} (Authenticated)")
+        return client
 
-        # 3. Initialize the Gemini client
-        if not GEMINI_API_KEY:
-            print("WARNING: GEMINI_API_KEY environment variable is missing.")
-
-        self.gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+    def _create_gemini(self):
+        # The SDK is slow to import, so only deployments that use Gemini pay for it
+        from google import genai
+        from google.genai import types
+        # Requests go through client.aio (see stream_utils.get_gemini_stream), whose async
+        # HTTP client keeps connections open between requests
+        http_options = types.HttpOptions(timeout=int(GEMINI_HTTP_TIMEOUT_SECONDS * 1000), base_url=GEMINI_BASE_URL)
+        client = genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
         print("Gemini Client initialized.")
+        return client
 
+    @staticmethod
+    def backend_for(model_identifier: str, is_cloud: bool) -> str | None:
+        """Returns the backend that serves a model identifier, or None for an unknown prefix."""
+        if model_identifier.startswith("ollama:"):
+            return "ollama_cloud" if is_cloud else "ollama_local"
+        if model_identifier.startswith("gemini:"):
+            return "gemini"
+        return None
 
     def get_llm_client(self, model_identifier: str, is_cloud: bool):
         """Returns the appropriate LLM client based on model and configuration."""
@@ -63,10 +133,10 @@ class LLMService:
                         "Ollama Cloud API Key is missing. Set the OLLAMA_CLOUD_API_KEY environment variable."
                     )
                 print("Returning authenticated Ollama Cloud client.")
-                return self.ollama_cloud_client 
+                return self._client("ollama_cloud")
             else:
                 print("Returning local Ollama client.")
-                return self.ollama_local_client
+                return self._client("ollama_local")
 
         # 2. Gemini Models
         elif model_identifier.startswith("gemini:"):
@@ -75,12 +145,40 @@ class LLMService:
                     "Gemini API Key is missing. Set the GEMINI_API_KEY environment variable."
                 )
             print("Returning Gemini client.")
-            return self.gemini_client
+            return self._client("gemini")
         
         # 3. Handle unknown models
         else:
             raise ValueError(f"Unknown model identifier prefix: {model_identifier}. Must start with 'ollama:' or 'gemini:'.")
 
+    async def warm_up(self, models: list[str] = OLLAMA_WARMUP_MODELS):
+        """
+        Loads the given local Ollama models ahead of the first real request, so users
+        do not wait for the model load. An empty prompt makes Ollama load the model
+        and keep it resident for OLLAMA_KEEP_ALIVE without generating anything.
+        """
+        if not models or "ollama_local" not in self.backends:
+            return
+        client = self._client("ollama_local")
+
+        async def load(model: str):
+            started = time.perf_counter()
+            try:
+                await client.generate(model=model, prompt="", keep_alive=OLLAMA_KEEP_ALIVE)
+                print(f"Warmed up Ollama model {model} in {time.perf_counter() - started:.1f}s")
+            except Exception as e:
+                print(f"Warm-up of Ollama model {model} failed: {e}")
+
+        await asyncio.gather(*(load(model) for model in models))
+
+    def stop_ollama_probes(self):
+        if self._ollama_probes is not None:
+            self._ollama_probes.cancel()
+
+    def ollama_host_stats(self) -> dict | None:
+        pool = self._clients.get("ollama_local")
+        return pool.stats() if pool is not None else None
+
 llm_service = LLMService()
 
 # Example Usage (You would typically run these asynchronously)
@@ -96,4 +194,4 @@ llm_service = LLMService()
 #     gemini = llm_service.get_llm_client("gemini:gemini-2.5-flash", is_cloud=True)
 
 # except ValueError as e:
-#     print(f"ERROR: {e}")
\ No newline at end of file
+#     print(f"ERROR: {e}")
@@ -0,0 +1,196 @@
+import os
+import time
+import asyncio
+from typing import Any, AsyncIterator, Optional
+from ollama import AsyncClient as OllamaAsyncClient
+
+# Seconds between health and model-inventory probes of every host
+OLLAMA_PROBE_INTERVAL_SECONDS = float(os.getenv("OLLAMA_PROBE_INTERVAL_SECONDS", "15"))
+# A probe that takes longer than this marks the host unhealthy
+OLLAMA_PROBE_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_PROBE_TIMEOUT_SECONDS", "3"))
+
+
+def _model_key(model: str) -> str:
+    # Ollama reports 'llama3' as 'llama3:latest'
+    return model if ":" in model else f"{model}:latest"
+
+
+class OllamaHost:
+    """One Ollama server: its client, health and what it has loaded and installed."""
+    def __init__(self, url: str):
+        self.url = url
+        self.client = OllamaAsyncClient(host=url)
+        self.healthy = True
+        # Models resident in memory (/api/ps) and installed on disk (/api/tags).
+        # None until the first successful probe.
+        self.loaded: Optional[set[str]] = None
+        self.installed: Optional[set[str]] = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_probe: Optional[float] = None
+
+    def mark_failed(self, error: Exception):
+        self.failures += 1
+        if self.healthy:
+            print(f"Ollama host {self.url} marked unhealthy: {error}")
+        self.healthy = False
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "loaded": sorted(self.loaded) if self.loaded is not None else None,
+            "seconds_since_probe": time.monotonic() - self.last_probe if self.last_probe is not None else None,
+        }
+
+
+class OllamaHostPool:
+    """
+    Spreads Ollama requests over several hosts.
+
+    Exposes the chat(), generate() and embed() calls the rest of the app makes on an Ollama
+    AsyncClient. Each request goes to the healthy host with the fewest outstanding
+    requests among those that already have the model loaded, then those that have
+    it installed, then any other. A host that fails before producing anything is
+    marked unhealthy and the request moves on to the next candidate; probes bring
+    hosts back once they answer again.
+    """
+    def __init__(self, urls: list[str]):
+        if not urls:
+            raise ValueError("OllamaHostPool needs at least one host")
+        self.hosts = [OllamaHost(url) for url in urls]
+        self.failovers = 0
+
+    def candidates(self, model: str) -> list[OllamaHost]:
+        """Hosts in the order a request for model should try them."""
+        key = _model_key(model)
+
+        def rank(item: tuple[int, OllamaHost]):
+            index, host = item
+            loaded = host.loaded is not None and key in host.loaded
+            # Hosts whose inventory is unknown may well have the model
+            installed = host.installed is None or key in host.installed
+            return (not host.healthy, not loaded, not installed, host.outstanding, index)
+
+        return [host for _, host in sorted(enumerate(self.hosts), key=rank)]
+
+    async def chat(self, model: str, messages: list, stream: bool = False, **kwargs) -> Any:
+        if stream:
+            return self._stream("chat", model, messages=messages, **kwargs)
+        return await self._call("chat", model, messages=messages, stream=False, **kwargs)
+
+    async def generate(self, model: str, prompt: str = "", stream: bool = False, **kwargs) -> Any:
+        if stream:
+            return self._stream("generate", model, prompt=prompt, **kwargs)
+        return await self._call("generate", model, prompt=prompt, stream=False, **kwargs)
+
+    async def embed(self, model: str, input: Any, **kwargs) -> Any:
+        return await self._call("embed", model, input=input, **kwargs)
+
+    async def _call(self, method: str, model: str, **kwargs) -> Any:
+        last_error: Optional[Exception] = None
+        for attempt, host in enumerate(self.candidates(model)):
+            if attempt:
+                self.failovers += 1
+            host.outstanding += 1
+            host.requests += 1
+            try:
+                response = await getattr(host.client, method)(model=model, **kwargs)
+            except Exception as e:
+                if not self._should_fail_over(host, model, e):
+                    raise
+                last_error = e
+                continue
+            finally:
+                host.outstanding -= 1
+            self._mark_loaded(host, model)
+            return response
+        raise last_error
+
+    async def _stream(self, method: str, model: str, **kwargs) -> AsyncIterator[Any]:
+        last_error: Optional[Exception] = None
+        for attempt, host in enumerate(self.candidates(model)):
+            if attempt:
+                self.failovers += 1
+            host.outstanding += 1
+            host.requests += 1
+            started = False
+            stream = None
+            try:
+                stream = await getattr(host.client, method)(model=model, stream=True, **kwargs)
+                async for chunk in stream:
+                    if not started:
+                        started = True
+                        self._mark_loaded(host, model)
+                    yield chunk
+                return
+            except Exception as e:
+                # Once text has reached the client, retrying elsewhere would repeat it
+                if started or not self._should_fail_over(host, model, e):
+                    raise
+                last_error = e
+            finally:
+                host.outstanding -= 1
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+        raise last_error
+
+    @staticmethod
+    def _should_fail_over(host: OllamaHost, model: str, error: Exception) -> bool:
+        """
+        Decides whether a failed request should move to the next host. Connection
+        errors, timeouts and 5xx mark the host unhealthy; a 404 means only that this
+        host lacks the model. Other errors are about the request itself.
+        """
+        status_code = getattr(error, "status_code", -1)
+        if status_code == 404:
+            if host.installed is not None:
+                host.installed.discard(_model_key(model))
+            return True
+        if status_code == -1 or status_code >= 500:
+            host.mark_failed(error)
+            return True
+        return False
+
+    @staticmethod
+    def _mark_loaded(host: OllamaHost, model: str):
+        host.healthy = True
+        if host.loaded is not None:
+            host.loaded.add(_model_key(model))
+
+    async def probe(self):
+        """Refreshes health and the loaded/installed models of every host."""
+        await asyncio.gather(*(self._probe_host(host) for host in self.hosts))
+
+    async def _probe_host(self, host: OllamaHost):
+        try:
+            running, installed = await asyncio.wait_for(
+                asyncio.gather(host.client.ps(), host.client.list()),
+                timeout=OLLAMA_PROBE_TIMEOUT_SECONDS,
+            )
+        except Exception as e:
+            host.mark_failed(e)
+            return
+        if not host.healthy:
+            print(f"Ollama host {host.url} is healthy again")
+        host.healthy = True
+        host.loaded = {model.model for model in running.models if model.model}
+        host.installed = {model.model for model in installed.models if model.model}
+        host.last_probe = time.monotonic()
+
+    async def run_probes(self, interval: float = OLLAMA_PROBE_INTERVAL_SECONDS):
+        """Probes all hosts every interval seconds until cancelled."""
+        while True:
+            await self.probe()
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "hosts": {host.url: host.stats() for host in self.hosts},
+        }
+
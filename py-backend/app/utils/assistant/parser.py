@@ -1,35 +1,204 @@
 import re
-from typing import Optional, Tuple
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+FENCE = "```"
+# Language reported for fenced blocks that do not name one
+DEFAULT_LANGUAGE = "text"
+_BACKTICK_RUN = re.compile(r"`{3,}")
+
+
+class CodeBlock(NamedTuple):
+    language: str
+    code: str
+    # Offset in the parsed content where the block stood
+    position: int
+
+
+class MarkdownEvent(NamedTuple):
+    """
+    One piece of a parsed answer: 'text' (prose, in data), 'code_start' (language in
+    data), 'code_delta' (code in data) or 'code_end'. index is the code block number.
+    """
+    kind: str
+    data: str = ""
+    index: int = 0
+
+
+def _fence_indent_ok(line: str) -> bool:
+    # Markdown allows up to three spaces before a fence
+    return len(line) - len(line.lstrip(" ")) <= 3
+
+
+class StreamingMarkdownParser:
+    """
+    Splits a streamed answer into prose and fenced code blocks as the chunks arrive.
+
+    feed() returns the events a chunk completes. Text is passed on as soon as it can
+    no longer be the start of a fence line; only a possible fence is held back until
+    its line ends. The newline before a closing fence is not part of the code.
+    After finish(), content holds the prose and blocks every code block.
+    """
+    def __init__(self):
+        self._buffer = ""
+        # The buffer continues a line whose start was already emitted, so it cannot be a fence
+        self._mid_line = False
+        self._in_code = False
+        self._pending_newline = False
+        self._content: list[str] = []
+        self._content_length = 0
+        self._code: list[str] = []
+        self._language = DEFAULT_LANGUAGE
+        self._fence_length = len(FENCE)
+        self._position = 0
+        self._finished = False
+        self.blocks: list[CodeBlock] = []
+
+    def feed(self, chunk: str) -> list[MarkdownEvent]:
+        events: list[MarkdownEvent] = []
+        buffer = self._buffer + chunk
+        self._buffer = ""
+        # Walked with an offset rather than re-sliced per line, so one large chunk stays linear
+        start = 0
+        while start < len(buffer):
+            newline = buffer.find("\n", start)
+            if newline == -1:
+                rest = buffer[start:]
+                if not self._mid_line and self._could_be_fence(rest):
+                    self._buffer = rest
+                    break
+                self._emit(rest, events)
+                self._mid_line = True
+                break
+            line = buffer[start:newline]
+            start = newline + 1
+            if self._mid_line or not self._handle_fence(line, events):
+                self._emit(line, events)
+                self._end_line(events)
+            self._mid_line = False
+        return events
+
+    def finish(self) -> list[MarkdownEvent]:
+        """Flushes held-back text and closes a code block the answer left open."""
+        events: list[MarkdownEvent] = []
+        if self._finished:
+            return events
+        self._finished = True
+        if self._buffer:
+            if self._mid_line or not self._handle_fence(self._buffer, events):
+                self._emit(self._buffer, events)
+            self._buffer = ""
+        if self._in_code:
+            self._close_block(events)
+        # Positions are offsets into the stripped content
+        raw = "".join(self._content)
+        leading = len(raw) - len(raw.lstrip())
+        length = len(raw.strip())
+        self.blocks = [
+            block._replace(position=min(max(block.position - leading, 0), length)) for block in self.blocks
+        ]
+        return events
+
+    def _could_be_fence(self, partial_line: str) -> bool:
+        if not _fence_indent_ok(partial_line):
+            return False
+        stripped = partial_line.lstrip(" ")
+        if self._in_code:
+            return set(stripped.rstrip(" ")) <= {"`"}
+        return stripped.startswith(FENCE) or FENCE.startswith(stripped)
+
+    def _handle_fence(self, line: str, events: list[MarkdownEvent]) -> bool:
+        if not _fence_indent_ok(line):
+            return False
+        stripped = line.strip()
+        if self._in_code:
+            if len(stripped) >= self._fence_length and set(stripped) == {"`"}:
+                self._close_block(events)
+                return True
+            return False
+        info = stripped.lstrip("`")
+        fence_length = len(stripped) - len(info)
+        # Backticks in the info string mean inline code, not a fence
+        if fence_length < len(FENCE) or "`" in info:
+            return False
+        self._in_code = True
+        self._fence_length = fence_length
+        self._language = info.strip() or DEFAULT_LANGUAGE
+        self._position = self._content_length
+        self._code = []
+        self._pending_newline = False
+        events.append(MarkdownEvent("code_start", self._language, len(self.blocks)))
+        return True
+
+    def _close_block(self, events: list[MarkdownEvent]):
+        index = len(self.blocks)
+        self.blocks.append(CodeBlock(self._language, "".join(self._code), self._position))
+        self._in_code = False
+        self._pending_newline = False
+        events.append(MarkdownEvent("code_end", "", index))
+
+    def _emit(self, text: str, events: list[MarkdownEvent]):
+        if self._in_code:
+            if self._pending_newline:
+                text = "\n" + text
+                self._pending_newline = False
+            if text:
+                self._code.append(text)
+                events.append(MarkdownEvent("code_delta", text, len(self.blocks)))
+        elif text:
+            self._content.append(text)
+            self._content_length += len(text)
+            events.append(MarkdownEvent("text", text))
+
+    def _end_line(self, events: list[MarkdownEvent]):
+        if self._in_code:
+            # Held back until the next line shows whether the block goes on
+            self._pending_newline = True
+        else:
+            self._emit("\n", events)
+
+    @property
+    def content(self) -> str:
+        return "".join(self._content).strip()
+
+    @property
+    def code(self) -> Optional[str]:
+        """The first code block, as stored in messages.code."""
+        return self.blocks[0].code if self.blocks else None
+
+
+def render_markdown(content: str, blocks: Iterable[CodeBlock]) -> str:
+    """
+    Puts code blocks back into parsed content as fenced blocks, at the positions the
+    parser recorded, which gives back the answer as the model wrote it.
+    """
+    parts = []
+    offset = 0
+    for block in sorted(blocks, key=lambda block: block.position):
+        parts.append(content[offset:block.position])
+        if parts[-1] and not parts[-1].endswith("\n"):
+            parts.append("\n")
+        # A fence longer than any backtick run in the code, so the code cannot close it
+        fence = "`" * max(len(FENCE), max(map(len, _BACKTICK_RUN.findall(block.code)), default=0) + 1)
+        language = "" if block.language == DEFAULT_LANGUAGE else block.language
+        parts.append(f"{fence}{language}\n{block.code}\n{fence}\n")
+        offset = block.position
+    parts.append(content[offset:])
+    return "".join(parts).rstrip("\n")
+
+
+def parse_markdown(text: str) -> StreamingMarkdownParser:
+    """Parses a complete answer in one go."""
+    parser = StreamingMarkdownParser()
+    parser.feed(text)
+    parser.finish()
+    return parser
 
-CODE_BLOCK_RE = re.compile(
-    r'```(?P<language>\w+)?\n(?P<code>.*?)\n```', 
-    re.DOTALL | re.MULTILINE
-)
 
 def parse_llm_response(text: str) -> Tuple[str, Optional[str]]:
     """
     Parses the LLM response to separate the main content and the code block.
-    
-    Returns: (main_content, code_block_content)
-    """
-    print(f"Parsing LLM response: {text}")
-    match = CODE_BLOCK_RE.search(text)
-    
-    if match:
-        # Extract language and code content
-        language = match.group('language') or 'text'
-        code_content = match.group('code').strip()
-
-        # The full code block, including backticks and language, to be removed from content
-        full_code_block = match.group(0)
-        
-        # Remove the code block from the main content
-        main_content = text.replace(full_code_block, '').strip()
-
-        # For saving to DB, we just save the code itself.
-        print(f"Extracted code block: {code_content}")
-        return main_content, code_content
-    else:
-        # No code block found
-        print("No code block found in response")
-        return text.strip(), None
\ No newline at end of file
+
+    Returns: (main_content, code_block_content) where the code is the first block.
+    """
+    parser = parse_markdown(text)
+    return parser.content, parser.code
@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import hashlib
+from collections import OrderedDict
+from typing import AsyncIterator, NamedTuple, Optional
+import orjson
+from app.models.schemas import Message
+from app.utils.assistant.chat_utils import count_tokens
+
+# The response cache is opt-in: identical prompts only share answers when enabled
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Model identifiers that never use the cache, comma separated
+RESPONSE_CACHE_BYPASS_MODELS = {
+    name.strip() for name in os.getenv("RESPONSE_CACHE_BYPASS_MODELS", "").split(",") if name.strip()
+}
+# Size of the chunks a cached answer is replayed in; coalescing merges them as usual
+REPLAY_CHUNK_CHARS = 256
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _normalize(text: Optional[str]) -> str:
+    return _WHITESPACE_RE.sub(" ", text or "").strip()
+
+
+class _CachedResponse(NamedTuple):
+    text: str
+    token_count: int
+    size: int
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    Exact-match cache of complete assistant answers.
+
+    The key is the model identifier plus the normalized message list the model
+    would see (summary, history and the new message), so a hit is an answer to the
+    very same prompt. Entries expire after a TTL and the cache is bounded by entry
+    count and by bytes, evicting least recently used entries first.
+    """
+    def __init__(self):
+        self._entries: "OrderedDict[str, _CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.tokens_saved = 0
+
+    @staticmethod
+    def enabled_for(model_identifier: str, use_cache: bool) -> bool:
+        return RESPONSE_CACHE_ENABLED and use_cache and model_identifier not in RESPONSE_CACHE_BYPASS_MODELS
+
+    @staticmethod
+    def make_key(
+        model_identifier: str,
+        history: list[Message],
+        user_message: str,
+        summary: Optional[str],
+        documents: Optional[list[str]] = None,
+    ) -> str:
+        messages = [[msg.role, _normalize(msg.content)] for msg in history]
+        payload = [model_identifier, _normalize(summary), messages, _normalize(user_message)]
+        if documents:
+            # Retrieved excerpts are part of the prompt, so they are part of the key
+            payload.append(documents)
+        payload = orjson.dumps(payload)
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached answer text for a key, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.tokens_saved += entry.token_count
+        return entry.text
+
+    def put(self, key: str, text: str):
+        """Stores a complete answer. Answers larger than a tenth of the byte cap are not cached."""
+        size = len(text.encode("utf-8"))
+        if not text or size > RESPONSE_CACHE_MAX_BYTES // 10:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = _CachedResponse(
+            text, count_tokens(text), size, time.monotonic() + RESPONSE_CACHE_TTL_SECONDS
+        )
+        self._bytes += size
+        self.stores += 1
+        while len(self._entries) > RESPONSE_CACHE_MAX_ENTRIES or self._bytes > RESPONSE_CACHE_MAX_BYTES:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": RESPONSE_CACHE_MAX_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+async def replay_text(text: str) -> AsyncIterator[str]:
+    """Replays a cached answer as a stream of text chunks, like an upstream model would."""
+    for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+        yield text[start:start + REPLAY_CHUNK_CHARS]
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,498 @@
+import io
+import os
+import re
+import time
+import zlib
+import asyncio
+import fcntl
+import tempfile
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import numpy as np
+import orjson
+from app.utils.database import get_pool
+from app.utils.assistant.model_selector import llm_service
+from app.utils.assistant.chat_utils import count_tokens
+
+# Ollama embedding model, e.g. "ollama:nomic-embed-text". Without one, a local hashing
+# embedder is used: deterministic and dependency free, but it only matches shared words.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "")
+EMBEDDING_MODEL_IS_CLOUD = os.getenv("EMBEDDING_MODEL_IS_CLOUD", "false").lower() == "true"
+HASH_EMBEDDING_DIM = int(os.getenv("HASH_EMBEDDING_DIM", "512"))
+# Document retrieval is on when an embedding model is configured. RETRIEVAL_ENABLED=true
+# turns it on with the hashing embedder as well, RETRIEVAL_ENABLED=false turns it off.
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true" if EMBEDDING_MODEL else "false").lower() == "true"
+# Vector files live here, one directory per embedder (see UserIndex). A relative path is
+# taken from the backend directory, not from wherever the server was started.
+_BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+RETRIEVAL_INDEX_DIR = os.path.join(_BACKEND_DIR, os.getenv("RETRIEVAL_INDEX_DIR", os.path.join("data", "vector_index")))
+# Document text is cut into chunks of about this many characters, overlapping by CHUNK_OVERLAP_CHARS
+CHUNK_CHARS = int(os.getenv("CHUNK_CHARS", "1200"))
+CHUNK_OVERLAP_CHARS = int(os.getenv("CHUNK_OVERLAP_CHARS", "150"))
+# Best chunks added to the context, the least similarity they need (by default the
+# embedder's own threshold) and the tokens they may use
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE")) if os.getenv("RETRIEVAL_MIN_SCORE") else None
+RETRIEVAL_MAX_TOKENS = int(os.getenv("RETRIEVAL_MAX_TOKENS", "800"))
+# Chunks embedded per call, and user indexes kept open
+EMBED_BATCH_SIZE = 32
+RETRIEVAL_OPEN_INDEXES = int(os.getenv("RETRIEVAL_OPEN_INDEXES", "64"))
+# Rows scored per step of a search; bounds the memory a search needs on large indexes
+SEARCH_BLOCK_ROWS = 65536
+# Pages read from the database per round-trip while a document is chunked
+CHUNK_PAGE_BATCH = 64
+
+_WORD = re.compile(r"\w+")
+# Words too common to say anything about what a chunk is about; numbers are skipped too
+_STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from get got has have how i if in is it its
+many much my not of on or our so that the their there these they this to was we what when
+where which who why will with you your
+""".split())
+
+
+class Chunk(NamedTuple):
+    page_number: int
+    text: str
+
+
+class RetrievedChunk(NamedTuple):
+    file_name: str
+    page_number: int
+    text: str
+    score: float
+    token_count: int
+
+
+def chunk_page(page_number: int, text: str) -> list[Chunk]:
+    """Cuts one page into overlapping chunks, ending them at whitespace where possible."""
+    chunks = []
+    start = 0
+    text = text.strip()
+    while start < len(text):
+        end = min(start + CHUNK_CHARS, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + CHUNK_CHARS // 2, end)
+            if space != -1:
+                end = space
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(Chunk(page_number, chunk))
+        if end >= len(text):
+            break
+        # The next chunk repeats the end of this one, starting on a word boundary
+        start = max(end - CHUNK_OVERLAP_CHARS, start + 1)
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return chunks
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class HashingEmbedder:
+    """
+    Feature-hashing embedder: words are hashed (crc32) into a fixed number
+    of signed buckets. Needs no model and gives the same vectors on every machine, so it
+    serves when retrieval is turned on without a model; similarity reflects shared words only.
+    """
+    # A short question sharing no words with a chunk still scores up to about 0.2 through
+    # hash collisions; one asking about the chunk's subject scores around 0.3
+    min_score = 0.25
+
+    def __init__(self, dim: int = HASH_EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hash-{dim}"
+
+    def _vector(self, text: str) -> np.ndarray:
+        # Plurals fold into the singular, so 'days' matches 'day'
+        words = [
+            word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+            for word in _WORD.findall(text.lower()) if word not in _STOPWORDS and not word.isdigit()
+        ]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if not words:
+            return vector
+        hashes = np.fromiter((zlib.crc32(word.encode()) for word in words), dtype=np.uint32, count=len(words))
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, hashes % self.dim, signs)
+        # Damp repeated words so long chunks are not dominated by a few terms
+        return np.sign(vector) * np.log1p(np.abs(vector))
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return await asyncio.to_thread(lambda: _normalize_rows(np.stack([self._vector(text) for text in texts])))
+
+
+class OllamaEmbedder:
+    """Embeds through the configured Ollama backend (see EMBEDDING_MODEL)."""
+    min_score = 0.3
+
+    def __init__(self, model_identifier: str, is_cloud: bool):
+        self.model_identifier = model_identifier
+        self.is_cloud = is_cloud
+        self.model_name = model_identifier.split(":", 1)[1]
+        self.name = re.sub(r"[^\w.-]", "_", self.model_name)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        client = llm_service.get_llm_client(self.model_identifier, self.is_cloud)
+        response = await client.embed(model=self.model_name, input=texts)
+        return _normalize_rows(response["embeddings"])
+
+
+def _create_embedder():
+    if EMBEDDING_MODEL:
+        return OllamaEmbedder(EMBEDDING_MODEL, EMBEDDING_MODEL_IS_CLOUD)
+    return HashingEmbedder()
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _npy_bytes(matrix: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, matrix)
+    return buffer.getvalue()
+
+
+class UserIndex:
+    """
+    The vectors of every document a user uploaded, as one float32 matrix on disk.
+
+    vectors.f32 holds the rows back to back and is memory-mapped for searches, so
+    the index costs no heap memory and the OS page cache keeps hot indexes resident.
+    segments.json holds the vector size and the content hash and chunk count of each
+    document in row order. Documents are appended by writing their rows first and the
+    segment list after, so a crash in between leaves rows that are simply ignored.
+    Appends take a file lock and searches reload a changed segment list, so several
+    app workers can share the index directory.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.segments_path = os.path.join(directory, "segments.json")
+        self.lock_path = os.path.join(directory, ".lock")
+        self.dim = 0
+        self._loaded_mtime = None
+        self.segments: list[tuple[str, int]] = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self._matrix: Optional[np.ndarray] = None
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the segment list if another worker or process changed it."""
+        try:
+            mtime = os.stat(self.segments_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._loaded_mtime and self._matrix is not None:
+            return
+        self._loaded_mtime = mtime
+        if mtime is not None:
+            with open(self.segments_path, "rb") as f:
+                saved = orjson.loads(f.read())
+            self.dim = saved["dim"]
+            self.segments = [tuple(segment) for segment in saved["segments"]]
+        self.offsets = np.concatenate(([0], np.cumsum([count for _, count in self.segments], dtype=np.int64)))
+        rows = int(self.offsets[-1])
+        self._matrix = (
+            np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+        )
+
+    @property
+    def rows(self) -> int:
+        return int(self.offsets[-1])
+
+    def contains(self, content_hash: str) -> bool:
+        return any(segment_hash == content_hash for segment_hash, _ in self.segments)
+
+    def append(self, content_hash: str, vectors: np.ndarray) -> bool:
+        """
+        Adds a document's chunk vectors unless the index already has them. Returns
+        whether it did. Runs in a worker thread.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.refresh()
+            if self.contains(content_hash):
+                return False
+            if self.dim and vectors.shape[1] != self.dim:
+                raise ValueError(f"Vectors have {vectors.shape[1]} dimensions, the index {self.dim}")
+            with open(self.vectors_path, "ab") as f:
+                # Rows past the last segment are left over from an interrupted append
+                f.truncate(self.rows * self.dim * 4)
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            segments = self.segments + [(content_hash, len(vectors))]
+            _write_atomic(self.segments_path, orjson.dumps({"dim": int(vectors.shape[1]), "segments": segments}))
+            self.refresh()
+        return True
+
+    def search(self, query: np.ndarray, k: int) -> list[tuple[float, str, int]]:
+        """
+        Returns the k rows with the highest cosine similarity to query (a unit vector)
+        as (score, content_hash, row within that document), best first. Runs in a worker thread.
+        """
+        matrix = self._matrix
+        if matrix is None or k <= 0:
+            return []
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        # Scored a block at a time, keeping only the running top k
+        for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+            scores = matrix[start:start + SEARCH_BLOCK_ROWS] @ query
+            if len(scores) > k:
+                top = np.argpartition(scores, -k)[-k:]
+            else:
+                top = np.arange(len(scores))
+            best_scores = np.concatenate((best_scores, scores[top]))
+            best_rows = np.concatenate((best_rows, top + start))
+            if len(best_scores) > k:
+                keep = np.argpartition(best_scores, -k)[-k:]
+                best_scores, best_rows = best_scores[keep], best_rows[keep]
+        order = np.argsort(-best_scores)
+        results = []
+        for score, row in zip(best_scores[order], best_rows[order]):
+            segment = int(np.searchsorted(self.offsets, row, side="right")) - 1
+            content_hash = self.segments[segment][0]
+            results.append((float(score), content_hash, int(row - self.offsets[segment])))
+        return results
+
+
+class DocumentRetriever:
+    """
+    Retrieval over the documents a user uploaded.
+
+    index_document() runs in the background after an upload: the document's pages
+    are cut into chunks and embedded once per distinct content (chunk texts go to
+    document_chunks, vectors to contents/<hash>.npy), then appended to the
+    uploading user's index. search() embeds the question and returns the best
+    chunks of that user's documents for the prompt.
+    """
+    def __init__(self):
+        self.embedder = _create_embedder()
+        self._indexes: "OrderedDict[str, UserIndex]" = OrderedDict()
+        self._user_locks: dict[str, asyncio.Lock] = {}
+        # Per content: its lock and the number of calls holding or waiting for it
+        self._content_locks: dict[str, list] = {}
+        self._jobs: set[asyncio.Task] = set()
+        self.documents_indexed = 0
+        self.contents_embedded = 0
+        self.chunks_embedded = 0
+        self.index_failures = 0
+        self.searches = 0
+        self.search_failures = 0
+        self.search_seconds_total = 0.0
+        self.chunks_returned = 0
+
+    @property
+    def _root(self) -> str:
+        return os.path.join(RETRIEVAL_INDEX_DIR, self.embedder.name)
+
+    async def _user_index(self, user_id: str) -> UserIndex:
+        """
+        The user's index, opened if it is not yet. Opening reads the segment list and maps
+        the vector file, so it runs in a worker thread.
+        """
+        index = self._indexes.get(user_id)
+        if index is None:
+            opened = await asyncio.to_thread(UserIndex, os.path.join(self._root, "users", user_id))
+            # Another call may have opened it meanwhile; keep the one already shared
+            index = self._indexes.setdefault(user_id, opened)
+            while len(self._indexes) > RETRIEVAL_OPEN_INDEXES:
+                self._indexes.popitem(last=False)
+        self._indexes.move_to_end(user_id)
+        return index
+
+    def schedule(self, user_id: str, content_hash: str):
+        """Queues a document for indexing after an upload. Returns immediately."""
+        if not RETRIEVAL_ENABLED:
+            return
+        task = asyncio.create_task(self.index_document(str(user_id), content_hash))
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+
+    async def index_document(self, user_id: str, content_hash: str):
+        try:
+            vectors = await self._content_vectors(content_hash)
+            if vectors is None:
+                return
+            lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+            async with lock:
+                index = await self._user_index(user_id)
+                added = await asyncio.to_thread(index.append, content_hash, vectors)
+            if not added:
+                return
+            self.documents_indexed += 1
+            print(f"Indexed document {content_hash[:12]} for user {user_id} ({len(vectors)} chunks)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.index_failures += 1
+            print(f"Indexing document {content_hash[:12]} for user {user_id} failed: {e}")
+
+    async def _content_vectors(self, content_hash: str) -> Optional[np.ndarray]:
+        """Chunks and embeds a content the first time it is seen; later calls read the stored vectors."""
+        path = os.path.join(self._root, "contents", f"{content_hash}.npy")
+        entry = self._content_locks.setdefault(content_hash, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if os.path.exists(path):
+                    return await asyncio.to_thread(np.load, path)
+                chunks = await self._chunk_content(content_hash)
+                if not chunks:
+                    return None
+                vectors = []
+                for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+                    vectors.append(await self.embedder.embed(chunks[start:start + EMBED_BATCH_SIZE]))
+                matrix = np.concatenate(vectors)
+                await asyncio.to_thread(_write_atomic, path, _npy_bytes(matrix))
+                self.contents_embedded += 1
+                self.chunks_embedded += len(chunks)
+                return matrix
+        finally:
+            # Dropped with the last user, so a caller still waiting never gets a lock
+            # that a newer caller has already replaced
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._content_locks[content_hash]
+
+    async def _chunk_content(self, content_hash: str) -> list[str]:
+        """
+        Returns the chunk texts of a content in order, cutting them from its pages
+        and storing them in document_chunks if that has not happened yet.
+        """
+        async with get_pool().acquire() as db:
+            async with db.transaction():
+                # Another worker may be chunking the same content
+                await db.execute("SELECT pg_advisory_xact_lock(hashtext('chunks:' || $1))", content_hash)
+                rows = await db.fetch(
+                    "SELECT content FROM document_chunks WHERE content_hash = $1 ORDER BY chunk_number", content_hash
+                )
+                if rows:
+                    return [row["content"] for row in rows]
+                texts = []
+                records = []
+                # Pages are read a batch at a time so large documents are never loaded whole
+                async for page in self._iter_pages(db, content_hash):
+                    for chunk in chunk_page(page["page_number"], page["content"]):
+                        texts.append(chunk.text)
+                        records.append((content_hash, len(records) + 1, chunk.page_number, chunk.text))
+                if records:
+                    await db.copy_records_to_table(
+                        "document_chunks", records=records,
+                        columns=("content_hash", "chunk_number", "page_number", "content"),
+                    )
+                return texts
+
+    @staticmethod
+    async def _iter_pages(db, content_hash: str):
+        cursor = await db.cursor(
+            "SELECT page_number, content FROM document_pages WHERE content_hash = $1 ORDER BY page_number",
+            content_hash,
+        )
+        while pages := await cursor.fetch(CHUNK_PAGE_BATCH):
+            for page in pages:
+                yield page
+
+    async def search(self, db, user_id: str, question: str, max_tokens: int = RETRIEVAL_MAX_TOKENS) -> list[RetrievedChunk]:
+        """
+        Returns the chunks of the user's documents most similar to the question, best
+        first, as many of the top RETRIEVAL_TOP_K as fit in max_tokens.
+        """
+        user_id = str(user_id)
+        if not RETRIEVAL_ENABLED or max_tokens <= 0 or not question.strip():
+            return []
+        index = await self._user_index(user_id)
+        await asyncio.to_thread(index.refresh)
+        if index.rows == 0:
+            return []
+        started = time.perf_counter()
+        min_score = RETRIEVAL_MIN_SCORE if RETRIEVAL_MIN_SCORE is not None else self.embedder.min_score
+        try:
+            query = (await self.embedder.embed([question]))[0]
+            hits = [
+                hit for hit in await asyncio.to_thread(index.search, query, RETRIEVAL_TOP_K)
+                if hit[0] >= min_score
+            ]
+        except Exception as e:
+            # The answer goes ahead without excerpts rather than failing
+            self.search_failures += 1
+            print(f"Document search for user {user_id} failed: {e}")
+            return []
+        results: list[RetrievedChunk] = []
+        if hits:
+            rows = await db.fetch(
+                """
+                SELECT c.content_hash, c.chunk_number, c.page_number, c.content,
+                       (SELECT d.file_name FROM documents d
+                        WHERE d.content_hash = c.content_hash AND d.user_id = $3 LIMIT 1) AS file_name
+                FROM document_chunks c
+                JOIN unnest($1::text[], $2::int[]) AS wanted(content_hash, chunk_number)
+                  ON c.content_hash = wanted.content_hash AND c.chunk_number = wanted.chunk_number
+                """,
+                [content_hash for _, content_hash, _ in hits],
+                # Index rows count from 0, chunk numbers from 1
+                [row + 1 for _, _, row in hits],
+                user_id,
+            )
+            found = {(row["content_hash"], row["chunk_number"]): row for row in rows}
+            tokens = 0
+            for score, content_hash, row_number in hits:
+                row = found.get((content_hash, row_number + 1))
+                if row is None:
+                    continue
+                token_count = count_tokens(row["content"])
+                if tokens + token_count > max_tokens:
+                    break
+                tokens += token_count
+                results.append(RetrievedChunk(
+                    row["file_name"] or "document", row["page_number"], row["content"], score, token_count
+                ))
+        self.searches += 1
+        self.search_seconds_total += time.perf_counter() - started
+        self.chunks_returned += len(results)
+        return results
+
+    async def shutdown(self):
+        """Cancels running indexing jobs; documents are indexed again on their next upload."""
+        tasks = list(self._jobs)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": RETRIEVAL_ENABLED,
+            "embedder": self.embedder.name,
+            "indexing": len(self._jobs),
+            "documents_indexed": self.documents_indexed,
+            "contents_embedded": self.contents_embedded,
+            "chunks_embedded": self.chunks_embedded,
+            "index_failures": self.index_failures,
+            "open_indexes": len(self._indexes),
+            "searches": self.searches,
+            "search_failures": self.search_failures,
+            "avg_search_ms": self.search_seconds_total / self.searches * 1000 if self.searches else 0.0,
+            "chunks_returned": self.chunks_returned,
+        }
+
+
+def format_documents(chunks: list[RetrievedChunk]) -> list[str]:
+    """The retrieved chunks as they are handed to the model, each headed by its source."""
+    return [f"[{chunk.file_name}, page {chunk.page_number}]\n{chunk.text}" for chunk in chunks]
+
+
+retriever = DocumentRetriever()
@@ -0,0 +1,250 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+
+def _parse_limits(value: str) -> dict[str, int]:
+    return {
+        name.strip(): int(limit)
+        for name, limit in (entry.rsplit("=", 1) for entry in value.split(",") if "=" in entry)
+    }
+
+
+# Concurrent generations allowed per backend, across all of its models.
+# The single local Ollama thrashes well before the hosted backends do.
+LLM_BACKEND_MAX_IN_FLIGHT = {
+    "ollama_local": 2, "ollama_cloud": 16, "gemini": 16,
+    **_parse_limits(os.getenv("LLM_BACKEND_MAX_IN_FLIGHT", "")),
+}
+# Per-model limits within a backend, e.g. "ollama:llama3=1". Defaults to the backend limit.
+LLM_MODEL_MAX_IN_FLIGHT = _parse_limits(os.getenv("LLM_MODEL_MAX_IN_FLIGHT", ""))
+# Requests allowed to wait per model; more are rejected right away with a 429
+LLM_QUEUE_MAX_DEPTH = int(os.getenv("LLM_QUEUE_MAX_DEPTH", "32"))
+
+
+class QueueFullError(Exception):
+    """Raised by LLMScheduler.reserve when the model's wait queue is full."""
+
+
+class LLMTicket:
+    """A place in the scheduler for one generation: queued first, then granted a slot."""
+    def __init__(self, scheduler: "LLMScheduler", lane: "_Lane", backend: str, model_identifier: str, user_id: str):
+        self._scheduler = scheduler
+        self._lane = lane
+        self.backend = backend
+        self.model_identifier = model_identifier
+        self.user_id = user_id
+        self.enqueued_at = time.perf_counter()
+        self.granted_at: Optional[float] = None
+        self.released = False
+        self._granted = asyncio.get_running_loop().create_future()
+
+    @property
+    def granted(self) -> bool:
+        return self.granted_at is not None
+
+    @property
+    def wait_ms(self) -> float:
+        end = self.granted_at if self.granted_at is not None else time.perf_counter()
+        return (end - self.enqueued_at) * 1000
+
+    @property
+    def position(self) -> int:
+        """Requests for the same model queued ahead of this one (0 once granted)."""
+        return self._scheduler._position(self)
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the ticket is granted a slot. Returns False if the timeout ran out
+        first or the ticket was released before it got one.
+        """
+        await asyncio.wait({self._granted}, timeout=timeout)
+        return self._granted.done() and not self._granted.cancelled()
+
+    def release(self):
+        """Gives the slot back, or leaves the queue. Safe to call more than once."""
+        self._scheduler._release(self)
+
+
+class _Lane:
+    """Waiting and running generations of one (backend, model)."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        # One FIFO per user; users take turns, so a heavy user only delays their own requests
+        self.queues: "OrderedDict[str, deque[LLMTicket]]" = OrderedDict()
+        self.waiting = 0
+
+    def head(self) -> Optional[LLMTicket]:
+        if not self.queues:
+            return None
+        return next(iter(self.queues.values()))[0]
+
+    def pop(self) -> LLMTicket:
+        user_id, queue = next(iter(self.queues.items()))
+        ticket = queue.popleft()
+        if queue:
+            self.queues.move_to_end(user_id)
+        else:
+            del self.queues[user_id]
+        self.waiting -= 1
+        return ticket
+
+    def remove(self, ticket: LLMTicket):
+        queue = self.queues.get(ticket.user_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[ticket.user_id]
+
+
+class LLMScheduler:
+    """
+    Limits concurrent LLM generations per backend and per model.
+
+    Requests over the limit wait in a per-model queue that serves users round-robin,
+    and are rejected once the queue holds LLM_QUEUE_MAX_DEPTH requests. A model's
+    lane only exists while it has generations running or waiting, since model
+    identifiers come from the request.
+    """
+    def __init__(self):
+        self._lanes: dict[tuple[str, str], _Lane] = {}
+        self._backend_active: dict[str, int] = {}
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.queue_wait_ms_total = 0.0
+        self.queue_wait_ms_max = 0.0
+
+    def _lane(self, backend: str, model_identifier: str) -> _Lane:
+        lane = self._lanes.get((backend, model_identifier))
+        if lane is None:
+            limit = LLM_MODEL_MAX_IN_FLIGHT.get(model_identifier, LLM_BACKEND_MAX_IN_FLIGHT.get(backend, 1))
+            lane = self._lanes[(backend, model_identifier)] = _Lane(max(1, limit))
+        return lane
+
+    def _has_capacity(self, backend: str, lane: _Lane) -> bool:
+        backend_limit = max(1, LLM_BACKEND_MAX_IN_FLIGHT.get(backend, 1))
+        return lane.active < lane.limit and self._backend_active.get(backend, 0) < backend_limit
+
+    def reserve(self, backend: str, model_identifier: str, user_id: str) -> LLMTicket:
+        """
+        Returns a ticket for one generation. It is granted immediately when a slot
+        is free, otherwise it joins the queue. Raises QueueFullError if the queue is full.
+        """
+        lane = self._lane(backend, model_identifier)
+        ticket = LLMTicket(self, lane, backend, model_identifier, user_id)
+        if lane.waiting == 0 and self._has_capacity(backend, lane):
+            self._grant(lane, ticket)
+            return ticket
+        if lane.waiting >= LLM_QUEUE_MAX_DEPTH:
+            self.rejected += 1
+            if lane.active == 0 and lane.waiting == 0:
+                self._drop_lane(backend, model_identifier, lane)
+            raise QueueFullError(f"Too many requests waiting for {model_identifier}, please retry shortly.")
+        lane.queues.setdefault(user_id, deque()).append(ticket)
+        lane.waiting += 1
+        self.queued += 1
+        return ticket
+
+    @asynccontextmanager
+    async def slot(self, backend: str, model_identifier: str, user_id: str):
+        """Holds a slot for the duration of the block, waiting for one if needed."""
+        ticket = self.reserve(backend, model_identifier, user_id)
+        try:
+            await ticket.wait()
+            yield ticket
+        finally:
+            ticket.release()
+
+    def _grant(self, lane: _Lane, ticket: LLMTicket):
+        lane.active += 1
+        self._backend_active[ticket.backend] = self._backend_active.get(ticket.backend, 0) + 1
+        ticket.granted_at = time.perf_counter()
+        ticket._granted.set_result(None)
+        self.granted += 1
+        wait_ms = ticket.wait_ms
+        self.queue_wait_ms_total += wait_ms
+        self.queue_wait_ms_max = max(self.queue_wait_ms_max, wait_ms)
+
+    def _release(self, ticket: LLMTicket):
+        if ticket.released:
+            return
+        ticket.released = True
+        lane = ticket._lane
+        if not ticket.granted:
+            lane.remove(ticket)
+            ticket._granted.cancel()
+        else:
+            lane.active -= 1
+            self._backend_active[ticket.backend] -= 1
+            self._dispatch(ticket.backend)
+        if lane.active == 0 and lane.waiting == 0:
+            self._drop_lane(ticket.backend, ticket.model_identifier, lane)
+
+    def _drop_lane(self, backend: str, model_identifier: str, lane: _Lane):
+        # An idle lane holds no state worth keeping; it is recreated on the next request
+        if self._lanes.get((backend, model_identifier)) is lane:
+            del self._lanes[(backend, model_identifier)]
+
+    def _dispatch(self, backend: str):
+        # Hand free slots to the lane whose next waiter has waited longest
+        while True:
+            ready = [
+                lane for (lane_backend, _), lane in self._lanes.items()
+                if lane_backend == backend and lane.waiting and self._has_capacity(backend, lane)
+            ]
+            if not ready:
+                return
+            lane = min(ready, key=lambda candidate: candidate.head().enqueued_at)
+            self._grant(lane, lane.pop())
+
+    def _position(self, ticket: LLMTicket) -> int:
+        if ticket.granted or ticket.released:
+            return 0
+        lane = ticket._lane
+        # Users take turns, so a ticket is behind every user's earlier tickets up to its own round
+        queue = lane.queues[ticket.user_id]
+        user_index = list(lane.queues).index(ticket.user_id)
+        round_index = queue.index(ticket)
+        return sum(
+            min(len(other), round_index + (1 if index < user_index else 0))
+            for index, other in enumerate(lane.queues.values())
+        )
+
+    def stats(self) -> dict:
+        return {
+            "granted": self.granted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "queue_wait_ms_avg": self.queue_wait_ms_total / self.granted if self.granted else 0.0,
+            "queue_wait_ms_max": self.queue_wait_ms_max,
+            "backends": dict(self._backend_active),
+            "models": {
+                f"{backend}/{model}": {"limit": lane.limit, "active": lane.active, "waiting": lane.waiting}
+                for (backend, model), lane in self._lanes.items()
+            },
+        }
+
+
+async def holding_slot(ticket: LLMTicket, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Streams chunks while holding the ticket's slot: waits until it is granted before
+    the first read and releases it when the stream ends or is closed. The slot thus
+    lives exactly as long as the generation, whoever is reading it.
+    """
+    try:
+        if not await ticket.wait():
+            # Released while still queued: the generation must not run without a slot
+            return
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        ticket.release()
+
+
+llm_scheduler = LLMScheduler()
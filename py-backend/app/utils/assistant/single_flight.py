@@ -0,0 +1,121 @@
+import os
+import asyncio
+from typing import AsyncIterator, Callable, Optional
+
+# Concurrent identical requests share one upstream generation when enabled
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+
+class _Flight:
+    """One running upstream generation and the chunks it has produced so far."""
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # Replaced every time something happens, so waiters never miss a wake-up
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """
+    Registry of in-flight generations keyed by prompt (see ResponseCache.make_key).
+
+    The first request for a key starts the upstream stream in a background task;
+    identical requests arriving while it runs attach to it instead of starting their
+    own. Every subscriber receives all chunks from the beginning, so late joiners
+    catch up first. The upstream is cancelled once its last subscriber goes away.
+    """
+    def __init__(self):
+        self._flights: dict[str, _Flight] = {}
+        self.started = 0
+        self.joined = 0
+        self.upstream_cancelled = 0
+
+    def is_running(self, key: str) -> bool:
+        return key in self._flights
+
+    async def stream(
+        self,
+        key: str,
+        start: Callable[[], AsyncIterator[str]],
+        on_join: Optional[Callable[[], None]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Yields the chunks of the generation for key, starting it with start() if none
+        is running. start() must return a stream that holds its own model slot (see
+        scheduler.holding_slot), since whoever starts a flight may leave before it ends.
+        on_join is called when this request attached to an existing one.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            # Started before the flight is registered, so a start() that raises leaves nothing behind
+            chunks = start()
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, chunks))
+            self.started += 1
+        else:
+            self.joined += 1
+            if on_join is not None:
+                on_join()
+
+        flight.subscribers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(flight.chunks):
+                    chunk = flight.chunks[position]
+                    position += 1
+                    yield chunk
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is listening any more: stop the model instead of finishing for no one
+                self._forget(key, flight)
+                flight.task.cancel()
+                self.upstream_cancelled += 1
+
+    async def _run(self, key: str, flight: _Flight, chunks: AsyncIterator[str]):
+        try:
+            async for chunk in chunks:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("Shared generation was cancelled")
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            # Finished flights leave the registry; repeats are the response cache's job
+            self._forget(key, flight)
+            flight.notify()
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": SINGLE_FLIGHT_ENABLED,
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "joined": self.joined,
+            "upstream_cancelled": self.upstream_cancelled,
+        }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,106 @@
+import os
+import asyncio
+from typing import AsyncIterator
+import orjson
+from app.utils.assistant.parser import MarkdownEvent
+
+# Upstream chunks are merged into one SSE frame until the frame reaches this many
+# bytes or the oldest buffered chunk has waited SSE_COALESCE_MAX_DELAY_MS.
+# The first chunk of an answer is always sent on its own, so time to first token
+# is unaffected. Set SSE_COALESCE_MAX_BYTES=0 to send every chunk as its own frame.
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "512"))
+SSE_COALESCE_MAX_DELAY_MS = float(os.getenv("SSE_COALESCE_MAX_DELAY_MS", "50"))
+
+
+def sse_event(payload: dict) -> str:
+    """Formats a payload as a Server-Sent Events frame: data: <JSON object>\\n\\n"""
+    return f"data: {orjson.dumps(payload).decode('utf-8')}\n\n"
+
+
+def markdown_sse_event(event: MarkdownEvent) -> str:
+    """
+    Formats a parser event as an SSE frame. Prose keeps the plain {'content': ...}
+    frame; code blocks arrive as code_start, code_delta and code_end events.
+    """
+    if event.kind == "text":
+        return sse_event({'content': event.data})
+    if event.kind == "code_start":
+        return sse_event({'event': 'code_start', 'index': event.index, 'language': event.data})
+    if event.kind == "code_delta":
+        return sse_event({'event': 'code_delta', 'index': event.index, 'code': event.data})
+    return sse_event({'event': 'code_end', 'index': event.index})
+
+
+async def coalesce_chunks(
+    chunks: AsyncIterator[str],
+    max_bytes: int = SSE_COALESCE_MAX_BYTES,
+    max_delay_ms: float = SSE_COALESCE_MAX_DELAY_MS,
+) -> AsyncIterator[str]:
+    """
+    Merges small text chunks into larger ones, flushing when the buffer holds
+    max_bytes or when max_delay_ms has passed since the first buffered chunk,
+    whichever comes first. The deadline is honoured even while upstream is idle.
+    """
+    iterator = chunks.__aiter__()
+    loop = asyncio.get_running_loop()
+    max_delay = max_delay_ms / 1000
+    buffer: list[str] = []
+    buffered_bytes = 0
+    deadline = 0.0
+    pending: asyncio.Future | None = None
+
+    try:
+        # The first chunk goes out immediately
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        yield first
+
+        while True:
+            if not buffer and pending is None:
+                # Nothing to flush, so there is no deadline to race against
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(0.0, deadline - loop.time()) if buffer else None
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    # Deadline reached while upstream is still thinking; keep waiting on the same chunk
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered_bytes = 0
+                    continue
+                finished, pending = pending, None
+                try:
+                    chunk = finished.result()
+                except StopAsyncIteration:
+                    break
+
+            if max_bytes <= 0:
+                yield chunk
+                continue
+
+            if not buffer:
+                deadline = loop.time() + max_delay
+            buffer.append(chunk)
+            buffered_bytes += len(chunk.encode("utf-8"))
+            if buffered_bytes >= max_bytes:
+                yield "".join(buffer)
+                buffer.clear()
+                buffered_bytes = 0
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            # Let the cancelled read unwind before closing the upstream iterator
+            pending.cancel()
+            await asyncio.wait({pending})
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -1,10 +1,21 @@
-from typing import List, Dict, Any, AsyncGenerator, TYPE_CHECKING
+import asyncio
+import random
+from typing import List, Dict, Any, AsyncGenerator, Optional, TYPE_CHECKING
+import httpx
 from app.models.schemas import Message
+from app.utils.metrics import StreamTimer
+from app.utils.assistant.model_selector import (
+    OLLAMA_KEEP_ALIVE,
+    GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS,
+    GEMINI_CHUNK_TIMEOUT_SECONDS,
+    GEMINI_MAX_RETRIES,
+    GEMINI_RETRY_BASE_DELAY_SECONDS,
+)
 # Import the actual types for type checking
 if TYPE_CHECKING:
     from ollama import AsyncClient as OllamaAsyncClient
     from google import genai
-    from google.genai.types import Content, Part, GenerateContentResponse
+    from google.genai.types import Content, GenerateContentResponse
 
 # Import for runtime
 try:
@@ -13,28 +24,56 @@ except ImportError:
     # Use a dummy class as a placeholder type for environments without ollama
     class OllamaAsyncClient: pass
 
-try:
-    from google import genai
-    from google.genai.types import Content, Part, GenerateContentResponse
-    
-except ImportError:
-    # Use a dummy class as a placeholder type for environments without google-genai
-    genai = None
-    class Content: pass
-    class Part: pass
-    class GenerateContentResponse: pass
+
+def _genai_types():
+    """
+    Imports the Gemini SDK types on first use. The SDK takes about a second to
+    import, so deployments that only use Ollama never pay for it.
+    """
+    try:
+        from google.genai import types
+    except ImportError:
+        raise ImportError("google-genai library not found. Please install it.")
+    return types
 
 # Type hint for a message as stored in the database
 DbMessage = Dict[str, Any]
 
 # --- Helper Functions for Message Conversion ---
 
-def _to_ollama_messages(history: List[Message], user_message: str) -> List[Dict[str, str]]:
+def _summary_instruction(summary: str) -> str:
+    """Wording used to hand the rolling conversation summary to either backend."""
+    return f"Summary of the earlier part of this conversation:\n{summary}"
+
+
+def _documents_instruction(documents: List[str]) -> str:
+    """Wording used to hand excerpts of the user's documents to either backend."""
+    excerpts = "\n\n".join(documents)
+    return f"Excerpts from the user's documents that may help with the answer:\n{excerpts}"
+
+
+def _system_instruction(summary: Optional[str], documents: Optional[List[str]]) -> Optional[str]:
+    parts = []
+    if summary:
+        parts.append(_summary_instruction(summary))
+    if documents:
+        parts.append(_documents_instruction(documents))
+    return "\n\n".join(parts) or None
+
+
+def _to_ollama_messages(
+    history: List[Message], user_message: str, summary: Optional[str] = None, documents: Optional[List[str]] = None
+) -> List[Dict[str, str]]:
     """
     Converts database history and the new user message into Ollama's message format.
     Ollama expects a list of dictionaries with 'role' and 'content' keys.
+    A summary of older turns and retrieved document excerpts, if any, go first as a
+    system message.
     """
     ollama_messages = []
+    system = _system_instruction(summary, documents)
+    if system:
+        ollama_messages.append({'role': 'system', 'content': system})
     for msg in history:
         # Ollama supports 'user' and 'assistant' roles for chat history
         role = msg.role
@@ -47,13 +86,13 @@ def _to_ollama_messages(history: List[Message], user_message: str) -> List[Dict[
     return ollama_messages
 
 
-def _to_gemini_contents(history: List[Message], user_message: str) -> List[Content]:
+def _to_gemini_contents(history: List[Message], user_message: str) -> List["Content"]:
     """
     Converts database history and the new user message into Gemini's Content format.
     Gemini expects a list of Content objects, alternating 'user' and 'model' roles.
     """
-    if genai is None:
-        raise RuntimeError("Google GenAI SDK is not installed or configured.")
+    types = _genai_types()
+    Content, Part = types.Content, types.Part
 
     gemini_contents = []
     for msg in history:
@@ -67,7 +106,7 @@ def _to_gemini_contents(history: List[Message], user_message: str) -> List[Conte
             gemini_contents.append(
                 Content(
                     role=gemini_role,
-                    parts=[Part.from_text(content)]
+                    parts=[Part.from_text(text=content)]
                 )
             )
 
@@ -75,7 +114,7 @@ def _to_gemini_contents(history: List[Message], user_message: str) -> List[Conte
     gemini_contents.append(
         Content(
             role='user',
-            parts=[Part.from_text(user_message)]
+            parts=[Part.from_text(text=user_message)]
         )
     )
     return gemini_contents
@@ -86,18 +125,22 @@ async def get_ollama_stream(
     llm_client: OllamaAsyncClient, 
     model_name: str, 
     history: List[DbMessage], 
-    user_message: str
+    user_message: str,
+    summary: Optional[str] = None,
+    documents: Optional[List[str]] = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
     Generates an asynchronous stream of response chunks from the Ollama model.
     This function is exported and used by assistant_routes.py.
     """
-    messages = _to_ollama_messages(history, user_message)
+    messages = _to_ollama_messages(history, user_message, summary, documents)
     
     stream = await llm_client.chat(
         model=model_name,
         messages=messages,
-        stream=True
+        stream=True,
+        # Keep the model loaded between turns instead of paying the load cost again
+        keep_alive=OLLAMA_KEEP_ALIVE
     )
     
     async for chunk in stream:
@@ -108,24 +151,129 @@ async def get_gemini_stream(
     llm_client: "genai.Client", 
     model_name: str, 
     history: List[Message], 
-    user_message: str
+    user_message: str,
+    summary: Optional[str] = None,
+    documents: Optional[List[str]] = None
 ) -> AsyncGenerator["genai.types.GenerateContentResponse", None]:
     """
     Generates an asynchronous stream of response chunks from the Gemini model.
     This function is exported and used by assistant_routes.py.
+
+    Uses the SDK's async client (llm_client.aio), so waiting on Gemini never blocks
+    the event loop. Transient failures before the first chunk are retried with
+    backoff; once text has been yielded a failure ends the stream, since retrying
+    would repeat it. asyncio.TimeoutError is raised when the first chunk or a later
+    one does not arrive in time (see GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS).
     """
-    if genai is None:
-        # Raise if genai client is used without the library installed
-        raise ImportError("google-genai library not found. Please install it.")
-        
+    types = _genai_types()
     contents = _to_gemini_contents(history, user_message)
-    
-    stream = await llm_client.models.generate_content_stream(
-        model=model_name,
-        contents=contents,
-    )
+    # Gemini takes the summary of older turns and document excerpts as a system instruction
+    system = _system_instruction(summary, documents)
+    config = types.GenerateContentConfig(system_instruction=system) if system else None
+
+    attempt = 0
+    while True:
+        stream = None
+        try:
+            stream = await asyncio.wait_for(
+                llm_client.aio.models.generate_content_stream(model=model_name, contents=contents, config=config),
+                timeout=GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS,
+            )
+            first = await asyncio.wait_for(anext(stream), timeout=GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS)
+            break
+        except StopAsyncIteration:
+            return
+        except Exception as e:
+            await _aclose(stream)
+            if attempt >= GEMINI_MAX_RETRIES or not _is_transient_gemini_error(e):
+                raise
+            delay = GEMINI_RETRY_BASE_DELAY_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            print(f"Gemini request failed ({e!r}), retry {attempt}/{GEMINI_MAX_RETRIES} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    try:
+        yield first
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(stream), timeout=GEMINI_CHUNK_TIMEOUT_SECONDS)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        await _aclose(stream)
+
+
+def _is_transient_gemini_error(error: Exception) -> bool:
+    """Rate limits, server errors and dropped connections are worth another try; slow models are not."""
+    from google.genai import errors
+    if isinstance(error, errors.APIError):
+        return error.code in (408, 429, 500, 502, 503, 504)
+    return isinstance(error, (httpx.TransportError, ConnectionError))
+
+
+async def _aclose(stream: Any):
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
 
-    # The stream itself is an async iterator
-    async for chunk in stream:
-        yield chunk
 
+async def stream_text(
+    llm_client: Any,
+    model_identifier: str,
+    history: List[Message],
+    user_message: str,
+    summary: Optional[str] = None,
+    documents: Optional[List[str]] = None
+) -> AsyncGenerator[str, None]:
+    """
+    Streams the answer of either backend as plain text chunks, skipping empty ones.
+    model_identifier is the full '<backend>:<model>' string from the request.
+    """
+    if not model_identifier.startswith(("ollama:", "gemini:")):
+        raise ValueError(f"Unknown model identifier prefix: {model_identifier}. Must start with 'ollama:' or 'gemini:'.")
+
+    # Model names may contain ':' themselves (e.g. 'ollama:gpt-oss:120b-cloud')
+    model_name = model_identifier.split(":", 1)[1]
+
+    # Time to first chunk, throughput and outcome of the stream, per model (see app.utils.metrics)
+    timer = StreamTimer(model_identifier)
+    try:
+        if model_identifier.startswith("ollama:"):
+            print(f"Streaming from Ollama model: {model_name}")
+            async for chunk in get_ollama_stream(llm_client, model_name, history, user_message, summary, documents):
+                # Ollama chunks contain the content under the 'content' key in the 'message' dict
+                content_chunk = chunk.get("message", {}).get("content", "")
+                # The last chunk carries the number of generated tokens
+                timer.tokens = chunk.get("eval_count") or timer.tokens
+                if content_chunk:
+                    timer.chunk(content_chunk)
+                    yield content_chunk
+
+        else:
+            print(f"Streaming from Gemini model: {model_name}")
+            async for chunk in get_gemini_stream(llm_client, model_name, history, user_message, summary, documents):
+                # Gemini chunks may not always contain 'text'
+                content_chunk = getattr(chunk, "text", "") or ""
+                usage = getattr(chunk, "usage_metadata", None)
+                timer.tokens = getattr(usage, "candidates_token_count", None) or timer.tokens
+                if content_chunk:
+                    timer.chunk(content_chunk)
+                    yield content_chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        # The reader stopped early: the client left, or a hedged request was decided
+        timer.finish("cancelled")
+        raise
+    except Exception:
+        timer.finish("error")
+        raise
+    timer.finish("completed")
+
+
+async def generate_text(llm_client: Any, model_identifier: str, prompt: str) -> str:
+    """
+    Runs a single prompt without chat history and returns the complete answer.
+    Used for background jobs such as conversation summaries.
+    """
+    parts = [chunk async for chunk in stream_text(llm_client, model_identifier, [], prompt)]
+    return "".join(parts)
@@ -0,0 +1,258 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from app.utils.database import get_pool
+from app.utils.assistant.model_selector import llm_service
+from app.utils.assistant.stream_utils import generate_text
+from app.utils.assistant.scheduler import llm_scheduler
+from app.utils.assistant.chat_utils import CONTEXT_TOKEN_BUDGET, CHARS_PER_TOKEN, count_tokens, history_text
+
+# Turn rolling summaries off entirely with SUMMARY_ENABLED=false
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() == "true"
+# Model used for summaries; by default the model that produced the latest answer
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL")
+SUMMARY_MODEL_IS_CLOUD = os.getenv("SUMMARY_MODEL_IS_CLOUD", "false").lower() == "true"
+# The newest turns worth this many tokens are always sent verbatim and never summarized
+SUMMARY_KEEP_RECENT_TOKENS = int(os.getenv("SUMMARY_KEEP_RECENT_TOKENS", str(CONTEXT_TOKEN_BUDGET // 2)))
+# Older turns are only folded into the summary once at least this many tokens are waiting
+SUMMARY_MIN_NEW_TOKENS = int(os.getenv("SUMMARY_MIN_NEW_TOKENS", "500"))
+# Tokens of older turns folded into the summary per job
+SUMMARY_MAX_INPUT_TOKENS = int(os.getenv("SUMMARY_MAX_INPUT_TOKENS", "6000"))
+# At most one summary job per chat in this interval, and at most this many jobs at once
+SUMMARY_MIN_INTERVAL_SECONDS = float(os.getenv("SUMMARY_MIN_INTERVAL_SECONDS", "60"))
+SUMMARY_MAX_CONCURRENT_JOBS = int(os.getenv("SUMMARY_MAX_CONCURRENT_JOBS", "2"))
+# Summaries kept in memory for active chats
+SUMMARY_CACHE_MAX_CHATS = int(os.getenv("SUMMARY_CACHE_MAX_CHATS", "1000"))
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and an assistant.
+Update the existing summary with the new turns below. Keep facts, decisions, names,
+requirements and any code the user is working on; drop greetings and filler.
+Answer with the updated summary only, in at most 250 words.
+
+Existing summary:
+---
+{summary}
+---
+
+New turns:
+---
+{turns}
+---
+"""
+
+# Messages after the summary boundary, newest first with a running token total,
+# returning the ones that fall outside the recent window that is always sent verbatim.
+PENDING_TURNS_SQL = f"""
+    SELECT id, role, content, code, code_blocks, tokens
+    FROM (
+        SELECT id, role, content, code, code_blocks, created_at, tokens,
+               SUM(tokens) OVER (ORDER BY created_at DESC, id DESC) AS running
+        FROM (
+            SELECT id, role, content, code, code_blocks, created_at,
+                   COALESCE(
+                       token_count,
+                       length(content) / {CHARS_PER_TOKEN} + 1
+                         + COALESCE(length(code) / {CHARS_PER_TOKEN} + 1, 0)
+                   ) AS tokens
+            FROM messages
+            WHERE chat_id = $1 AND id > $2
+        ) counted
+    ) totals
+    WHERE running > $3
+    ORDER BY created_at ASC, id ASC
+"""
+
+
+class ChatSummary(NamedTuple):
+    """The stored summary of a chat and the id of the last message it covers."""
+    summary: str
+    summarized_until_id: int
+    token_count: int
+
+
+class ConversationSummarizer:
+    """
+    Folds turns that fell out of the recent window into a stored per-chat summary.
+
+    Jobs run in the background after an assistant reply, never on the request path.
+    A chat has at most one job running; a reply arriving meanwhile marks the chat
+    so it runs once more afterwards. Jobs of a chat start at least
+    SUMMARY_MIN_INTERVAL_SECONDS apart: a reply within the interval defers the job
+    to its end rather than dropping it. The number of jobs running at once is capped.
+    """
+    def __init__(self):
+        self._jobs: dict[int, asyncio.Task] = {}
+        # The latest (model, is_cloud) of chats owed a job once the running or deferred one allows
+        self._rerun: dict[int, tuple[str, bool]] = {}
+        self._deferred: dict[int, asyncio.TimerHandle] = {}
+        self._last_started: dict[int, float] = {}
+        self._summaries: "OrderedDict[int, Optional[ChatSummary]]" = OrderedDict()
+        self._semaphore = asyncio.Semaphore(SUMMARY_MAX_CONCURRENT_JOBS)
+        self.completed = 0
+        self.skipped = 0
+        self.deduplicated = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    async def get_summary(self, db, chat_id: int) -> Optional[ChatSummary]:
+        """Returns the stored summary of a chat, from memory when possible."""
+        if chat_id in self._summaries:
+            self._summaries.move_to_end(chat_id)
+            return self._summaries[chat_id]
+        row = await db.fetchrow(
+            "SELECT summary, summarized_until_id, token_count FROM chat_summaries WHERE chat_id = $1",
+            chat_id
+        )
+        summary = ChatSummary(*row) if row else None
+        self._remember(chat_id, summary)
+        return summary
+
+    def _remember(self, chat_id: int, summary: Optional[ChatSummary]):
+        self._summaries[chat_id] = summary
+        self._summaries.move_to_end(chat_id)
+        while len(self._summaries) > SUMMARY_CACHE_MAX_CHATS:
+            self._summaries.popitem(last=False)
+
+    def invalidate(self, chat_id: int):
+        """Forgets a chat, e.g. after delete_chat. Its database row goes with the chat."""
+        self._summaries.pop(chat_id, None)
+        self._last_started.pop(chat_id, None)
+        self._rerun.pop(chat_id, None)
+        deferred = self._deferred.pop(chat_id, None)
+        if deferred is not None:
+            deferred.cancel()
+
+    def schedule(self, chat_id: int, model_identifier: str, is_cloud: bool):
+        """Queues a summary job for a chat after an assistant reply. Returns immediately."""
+        if not SUMMARY_ENABLED:
+            return
+        if SUMMARY_MODEL:
+            model_identifier, is_cloud = SUMMARY_MODEL, SUMMARY_MODEL_IS_CLOUD
+
+        if chat_id in self._jobs or chat_id in self._deferred:
+            # Already running or due to start; one more job afterwards picks up this reply too
+            self._rerun[chat_id] = (model_identifier, is_cloud)
+            self.deduplicated += 1
+            return
+
+        last_started = self._last_started.get(chat_id)
+        wait = 0.0 if last_started is None else last_started + SUMMARY_MIN_INTERVAL_SECONDS - time.monotonic()
+        if wait > 0:
+            # Too soon after the last job: start when the interval is over
+            self._rerun[chat_id] = (model_identifier, is_cloud)
+            self._deferred[chat_id] = asyncio.get_running_loop().call_later(wait, self._start_deferred, chat_id)
+            self.rate_limited += 1
+            return
+        self._start(chat_id, model_identifier, is_cloud)
+
+    def _start(self, chat_id: int, model_identifier: str, is_cloud: bool):
+        self._last_started[chat_id] = time.monotonic()
+        task = asyncio.create_task(self._run(chat_id, model_identifier, is_cloud))
+        self._jobs[chat_id] = task
+        task.add_done_callback(lambda _: self._finished(chat_id))
+
+    def _start_deferred(self, chat_id: int):
+        self._deferred.pop(chat_id, None)
+        rerun = self._rerun.pop(chat_id, None)
+        if rerun is not None:
+            self._start(chat_id, *rerun)
+
+    def _finished(self, chat_id: int):
+        self._jobs.pop(chat_id, None)
+        rerun = self._rerun.pop(chat_id, None)
+        if rerun is not None:
+            # Subject to the interval like any reply, so it may be deferred
+            self.schedule(chat_id, *rerun)
+
+    async def _run(self, chat_id: int, model_identifier: str, is_cloud: bool):
+        try:
+            async with self._semaphore:
+                await self._summarize(chat_id, model_identifier, is_cloud)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            print(f"Summary job for chat_id={chat_id} failed: {e}")
+
+    async def _summarize(self, chat_id: int, model_identifier: str, is_cloud: bool):
+        pool = get_pool()
+        async with pool.acquire() as db:
+            current = await self.get_summary(db, chat_id)
+            until_id = current.summarized_until_id if current else 0
+            rows = await db.fetch(PENDING_TURNS_SQL, chat_id, until_id, SUMMARY_KEEP_RECENT_TOKENS)
+
+        # Oldest pending turns first, up to the per-job input cap
+        turns, tokens = [], 0
+        for row in rows:
+            if turns and tokens + row["tokens"] > SUMMARY_MAX_INPUT_TOKENS:
+                break
+            turns.append(row)
+            tokens += row["tokens"]
+        if tokens < SUMMARY_MIN_NEW_TOKENS:
+            self.skipped += 1
+            return
+
+        print(f"Summarizing {len(turns)} older messages of chat_id={chat_id} (~{tokens} tokens)")
+        lines = []
+        for row in turns:
+            content = history_text(row["content"], row["code"], row["code_blocks"])
+            lines.append(f"- **{row['role'].capitalize()}**: {content}")
+        prompt = SUMMARY_PROMPT.format(
+            summary=current.summary if current else "No summary yet.",
+            turns="\n".join(lines),
+        )
+
+        llm_client = llm_service.get_llm_client(model_identifier, is_cloud)
+        # Summaries queue for the model like any user, so they cannot crowd out live chats
+        backend = llm_service.backend_for(model_identifier, is_cloud)
+        async with llm_scheduler.slot(backend, model_identifier, "summarizer"):
+            summary_text = (await generate_text(llm_client, model_identifier, prompt)).strip()
+        if not summary_text:
+            self.failed += 1
+            return
+
+        summary = ChatSummary(summary_text, turns[-1]["id"], count_tokens(summary_text))
+        async with pool.acquire() as db:
+            await db.execute(
+                """
+                INSERT INTO chat_summaries (chat_id, summary, summarized_until_id, token_count, updated_at)
+                VALUES ($1, $2, $3, $4, now())
+                ON CONFLICT (chat_id) DO UPDATE
+                SET summary = EXCLUDED.summary,
+                    summarized_until_id = EXCLUDED.summarized_until_id,
+                    token_count = EXCLUDED.token_count,
+                    updated_at = EXCLUDED.updated_at
+                """,
+                chat_id, *summary
+            )
+        self._remember(chat_id, summary)
+        self.completed += 1
+
+    async def shutdown(self):
+        """Cancels running jobs; unfinished summaries are simply redone later."""
+        tasks = list(self._jobs.values())
+        self._rerun.clear()
+        for deferred in self._deferred.values():
+            deferred.cancel()
+        self._deferred.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": SUMMARY_ENABLED,
+            "running": len(self._jobs),
+            "deferred": len(self._deferred),
+            "completed": self.completed,
+            "skipped": self.skipped,
+            "deduplicated": self.deduplicated,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+        }
+
+
+summarizer = ConversationSummarizer()
@@ -0,0 +1,29 @@
+from typing import Optional
+
+# Average characters per token used by count_tokens()
+CHARS_PER_TOKEN = 4
+# Tokens a chat template wraps around each message (role markers, separators), on top of its text
+MESSAGE_FRAMING_TOKENS = 4
+# Appended where truncate_to_tokens() cut a text
+TRUNCATION_MARKER = " [...]"
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """
+    Approximate token count of a text. We do not ship a tokenizer per model, so
+    this uses the usual ~4 characters per token rule; it is computed once per
+    message and stored in messages.token_count.
+    """
+    if not text:
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cuts a text to at most max_tokens (as count_tokens counts them), marking the cut."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    keep = max(0, (max_tokens - 1) * CHARS_PER_TOKEN - len(TRUNCATION_MARKER))
+    return text[:keep] + TRUNCATION_MARKER
@@ -1,7 +1,13 @@
 import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import jwt, ExpiredSignatureError, JWTError
-from passlib.context import CryptContext
+import bcrypt
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
@@ -14,30 +20,137 @@ SECRET_KEY = os.getenv("SECRET_KEY", "supersecret")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+# Maximum number of verified tokens remembered by the token cache
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", "10000"))
+
 # OAuth2 scheme used by FastAPI to extract the bearer token from requests
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
-# Password hashing context configured to use bcrypt
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost factor for new hashes. Stored hashes with a lower cost are
+# rehashed on the next login (see _verify_and_update).
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# bcrypt is CPU bound and deliberately slow, so it runs on its own small thread
+# pool instead of the event loop or the shared threadpool used by sync routes.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hashing requests allowed to be queued or running at once; the rest wait on the semaphore
+PASSWORD_HASH_MAX_CONCURRENCY = int(os.getenv("PASSWORD_HASH_MAX_CONCURRENCY", str(PASSWORD_HASH_WORKERS * 4)))
+
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_semaphore = asyncio.Semaphore(PASSWORD_HASH_MAX_CONCURRENCY)
+
+# Queue-time metrics for the hashing pool, reported through get_password_hash_stats()
+_hash_stats = {
+    "calls": 0,
+    "in_flight": 0,
+    "rehashed": 0,
+    "queue_seconds_total": 0.0,
+    "queue_seconds_max": 0.0,
+    "hash_seconds_total": 0.0,
+}
 
 
 def hash_password(password: str) -> str:
     """
-    Hash a plaintext password using the configured password context.
-    Returns the hashed password string (bcrypt).
+    Hash a plaintext password with bcrypt at BCRYPT_ROUNDS.
+    Returns the hashed password string.
     """
-    # Encode as UTF-8 and truncate to 72 bytes
+    # bcrypt only uses the first 72 bytes and rejects longer input, so truncate
     password_bytes = password.encode("utf-8")[:72]
-    return pwd_context.hash(password_bytes)
+    return bcrypt.hashpw(password_bytes, bcrypt.gensalt(BCRYPT_ROUNDS)).decode("ascii")
 
 
 
 def verify_password(plain_password: str, hashed: str) -> bool:
     """
     Verify a plaintext password against a stored hashed password.
-    Returns True if the password matches, False otherwise.
+    Returns True if the password matches, False otherwise (also for a malformed hash).
+    """
+    try:
+        return bcrypt.checkpw(plain_password.encode("utf-8")[:72], hashed.encode("ascii"))
+    except ValueError:
+        return False
+
+
+def _hash_rounds(hashed: str) -> int:
+    # A bcrypt hash reads $2b$<cost>$<salt and checksum>
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _verify_and_update(plain_password: str, hashed: str):
+    """
+    Verify a password and, if the stored hash uses a lower cost than BCRYPT_ROUNDS, return a fresh hash.
+    Returns (matches, new_hash_or_None).
+    """
+    if not verify_password(plain_password, hashed):
+        return False, None
+    if _hash_rounds(hashed) < BCRYPT_ROUNDS:
+        return True, hash_password(plain_password)
+    return True, None
+
+
+async def _run_hashing(func, *args):
+    """
+    Run a bcrypt operation on the dedicated hashing pool, recording how long
+    the call waited for a slot and how long the hashing itself took.
+    """
+    queued_at = time.perf_counter()
+    async with _hash_semaphore:
+        loop = asyncio.get_running_loop()
+        _hash_stats["in_flight"] += 1
+
+        def timed_call():
+            started = time.perf_counter()
+            result = func(*args)
+            return started, time.perf_counter() - started, result
+
+        try:
+            started, duration, result = await loop.run_in_executor(_hash_executor, timed_call)
+        finally:
+            _hash_stats["in_flight"] -= 1
+
+    # Queue time covers both the semaphore wait and the wait for a free worker thread
+    waited = started - queued_at
+    _hash_stats["calls"] += 1
+    _hash_stats["queue_seconds_total"] += waited
+    _hash_stats["queue_seconds_max"] = max(_hash_stats["queue_seconds_max"], waited)
+    _hash_stats["hash_seconds_total"] += duration
+    return result
+
+
+async def hash_password_async(password: str) -> str:
+    """
+    Hash a plaintext password on the hashing pool without blocking the event loop.
+    """
+    return await _run_hashing(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed: str):
+    """
+    Verify a password on the hashing pool without blocking the event loop.
+    Returns (matches, new_hash_or_None); new_hash is set when the stored hash
+    should be replaced because it was made with an older cost factor.
     """
-    return pwd_context.verify(plain_password.encode("utf-8")[:72], hashed)
+    matches, new_hash = await _run_hashing(_verify_and_update, plain_password, hashed)
+    if matches and new_hash:
+        _hash_stats["rehashed"] += 1
+    return matches, new_hash
+
+
+def get_password_hash_stats() -> dict:
+    """
+    Returns a snapshot of the hashing pool counters.
+    """
+    stats = dict(_hash_stats)
+    stats.update({
+        "workers": PASSWORD_HASH_WORKERS,
+        "max_concurrency": PASSWORD_HASH_MAX_CONCURRENCY,
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+    })
+    return stats
 
 
 def create_access_token(data: dict) -> str:
@@ -52,6 +165,122 @@ def create_access_token(data: dict) -> str:
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+class TokenCache:
+    """
+    Bounded LRU of already verified JWTs, keyed by a SHA-256 digest of the token.
+
+    Each entry remembers the user id and the token's 'exp' claim, so an entry
+    stops being served the moment its token expires. Revoked digests are kept
+    on a deny list until their own expiry so a revoked token cannot be re-verified.
+    Lookups happen from the threadpool used by sync dependencies, hence the lock.
+    """
+    def __init__(self, max_size: int = TOKEN_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self._by_user: dict[str, set[str]] = {}
+        self._revoked: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, digest: str):
+        """Returns the cached user id for a token digest, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            user_id, expires_at = entry
+            if expires_at <= now:
+                self._drop(digest)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return user_id
+
+    def put(self, digest: str, user_id: str, expires_at: float):
+        """Remembers a verified token until its expiry time (epoch seconds)."""
+        with self._lock:
+            self._entries[digest] = (user_id, expires_at)
+            self._entries.move_to_end(digest)
+            self._by_user.setdefault(user_id, set()).add(digest)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def is_revoked(self, digest: str) -> bool:
+        with self._lock:
+            expires_at = self._revoked.get(digest)
+            if expires_at is None:
+                return False
+            if expires_at <= time.time():
+                del self._revoked[digest]
+                return False
+            return True
+
+    def revoke_token(self, token: str, expires_at: float | None = None):
+        """Drops a token from the cache and rejects it until it expires."""
+        digest = self.digest(token)
+        with self._lock:
+            self._prune_revoked()
+            entry = self._entries.get(digest)
+            if entry is not None:
+                expires_at = entry[1]
+                self._drop(digest)
+            if digest not in self._revoked:
+                self._revoked[digest] = expires_at or time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+    def revoke_user(self, user_id: str):
+        """Drops and rejects every cached token issued to a user."""
+        with self._lock:
+            self._prune_revoked()
+            for digest in list(self._by_user.get(user_id, ())):
+                self._revoked[digest] = self._entries[digest][1]
+                self._drop(digest)
+
+    def _prune_revoked(self):
+        # Caller must hold the lock. Revocations are rare, so a full scan is fine.
+        now = time.time()
+        for digest in [d for d, expires_at in self._revoked.items() if expires_at <= now]:
+            del self._revoked[digest]
+
+    def _drop(self, digest: str):
+        # Caller must hold the lock
+        user_id, _ = self._entries.pop(digest)
+        digests = self._by_user.get(user_id)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[user_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "revoked": len(self._revoked),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+token_cache = TokenCache()
+
+
 def verify_token(token: str):
     """
     Verify the JWT token and check if it has expired.
@@ -59,12 +288,24 @@ def verify_token(token: str):
     Returns the user ID if the token is valid and has not expired.
     Raises an HTTPException if the token is invalid or has expired.
     """
+    digest = TokenCache.digest(token)
+    if token_cache.is_revoked(digest):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+    # Tokens already verified by this worker skip the decode and HMAC check
+    user_id = token_cache.get(digest)
+    if user_id is not None:
+        return user_id
+
     try:
         # Decode the token
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+        expires_at = payload.get("exp")
+        if expires_at is not None:
+            token_cache.put(digest, user_id, float(expires_at))
         return user_id
     except ExpiredSignatureError:
         # Token has expired
@@ -1,15 +1,353 @@
 import os
-import psycopg2
+import time
+import asyncio
+import asyncpg
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from app.utils.metrics import CallbackMetric, observe_query, db_acquire_seconds
 
 load_dotenv()
 
-def get_db():
-    conn = psycopg2.connect(
+# Connection pool sizing. The pool is created once at application startup
+# and every request borrows a connection from it instead of opening its own.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Seconds a request may wait for a free connection before we give up with a 503
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5"))
+# Idle connections above min_size are closed after this many seconds
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+
+# Arbitrary constant used as the advisory lock key while applying migrations,
+# so several workers starting at once do not race on the same DDL.
+MIGRATION_LOCK_KEY = 727_001
+
+# Arbitrary constant used as the advisory lock key of the worker that runs the background migrations
+BACKGROUND_MIGRATION_LOCK_KEY = 727_002
+
+# Characters of a message (content and code) or chat title that full-text search covers.
+# A tsvector is limited to 1 MB, so vectors are built from a prefix of the text and any
+# answer can be stored.
+SEARCH_INDEXED_CHARS = 100_000
+
+# Idempotent schema changes applied at startup, in order. Only append to this list.
+SCHEMA_MIGRATIONS = [
+    # Full-text search over chat titles and message content/code (see app.utils.search).
+    # Plain columns kept current by the triggers below: adding one does not rewrite the table.
+    # Rows stored before the triggers get their vectors from BACKGROUND_BACKFILLS, and the GIN
+    # indexes are built by BACKGROUND_INDEXES, both after startup.
+    "ALTER TABLE chats ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    # Keyset pagination on (created_at, id) for chat lists and message history
+    "CREATE INDEX IF NOT EXISTS chats_created_at_id_idx ON chats (created_at DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS messages_chat_created_at_id_idx ON messages (chat_id, created_at, id)",
+    # Assistant answers cut short because the client disconnected mid-stream
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS truncated BOOLEAN NOT NULL DEFAULT FALSE",
+    # Approximate token count of content + code, computed once at insert (see chat_utils.count_tokens)
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS token_count INTEGER",
+    # Rolling summary of the turns that fell out of the context window (see app.utils.assistant.summarizer)
+    """
+    CREATE TABLE IF NOT EXISTS chat_summaries (
+        chat_id INTEGER PRIMARY KEY REFERENCES chats(id) ON DELETE CASCADE,
+        summary TEXT NOT NULL,
+        summarized_until_id INTEGER NOT NULL,
+        token_count INTEGER NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    # Model that produced an assistant message, which may be a fallback of the requested one
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS model TEXT",
+    # Every fenced code block of an assistant message: [{language, code, position}], see parser.CodeBlock
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS code_blocks JSONB",
+    # Uploaded documents are stored once per distinct file (sha256 of its bytes); every upload
+    # gets its own documents row pointing at the shared content (see app.routes.files)
+    """
+    CREATE TABLE IF NOT EXISTS document_contents (
+        content_hash TEXT PRIMARY KEY,
+        size BIGINT NOT NULL,
+        content_type TEXT NOT NULL,
+        page_count INTEGER NOT NULL,
+        character_count BIGINT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    # Extracted text, one row per page
+    """
+    CREATE TABLE IF NOT EXISTS document_pages (
+        content_hash TEXT NOT NULL REFERENCES document_contents(content_hash) ON DELETE CASCADE,
+        page_number INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (content_hash, page_number)
+    )
+    """,
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "CREATE INDEX IF NOT EXISTS documents_content_hash_idx ON documents (content_hash)",
+    # Document text cut into chunks for retrieval, once per content (see app.utils.assistant.retrieval)
+    """
+    CREATE TABLE IF NOT EXISTS document_chunks (
+        content_hash TEXT NOT NULL REFERENCES document_contents(content_hash) ON DELETE CASCADE,
+        chunk_number INTEGER NOT NULL,
+        page_number INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (content_hash, chunk_number)
+    )
+    """,
+    # Databases that ran the first search migration have generated search_vector columns, which
+    # fail every insert whose vector goes over the tsvector limit. Dropping the expression keeps
+    # the stored vectors and does not rewrite the table; the triggers below take over.
+    "ALTER TABLE chats ALTER COLUMN search_vector DROP EXPRESSION IF EXISTS",
+    "ALTER TABLE messages ALTER COLUMN search_vector DROP EXPRESSION IF EXISTS",
+    f"""
+    CREATE OR REPLACE FUNCTION chats_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector('simple', left(coalesce(NEW.title, ''), {SEARCH_INDEXED_CHARS}));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION messages_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector(
+            'simple', left(coalesce(NEW.content, '') || ' ' || coalesce(NEW.code, ''), {SEARCH_INDEXED_CHARS})
+        );
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER chats_search_vector_update BEFORE INSERT OR UPDATE OF title ON chats
+        FOR EACH ROW EXECUTE FUNCTION chats_search_vector_update()
+    """,
+    """
+    CREATE OR REPLACE TRIGGER messages_search_vector_update BEFORE INSERT OR UPDATE OF content, code ON messages
+        FOR EACH ROW EXECUTE FUNCTION messages_search_vector_update()
+    """,
+]
+
+# Work on existing rows that would hold locks for too long during startup. It runs in the
+# background once the app is serving (see run_background_migrations), in short steps that
+# neither block writes nor delay queries.
+
+# Rows stored before the search_vector triggers get their vectors by setting the given column
+# to itself, which fires the trigger, BACKFILL_BATCH_SIZE ids at a time
+BACKFILL_BATCH_SIZE = 1000
+BACKGROUND_BACKFILLS = {
+    "chats": "title",
+    "messages": "content",
+}
+# Indexes built with CREATE INDEX CONCURRENTLY, by name
+BACKGROUND_INDEXES = {
+    "chats_search_vector_idx": "ON chats USING GIN (search_vector)",
+    "messages_search_vector_idx": "ON messages USING GIN (search_vector)",
+}
+
+_pool: asyncpg.Pool | None = None
+
+# Usage counters, reported through get_pool_stats()
+_stats = {
+    "acquired": 0,
+    "released": 0,
+    "acquire_timeouts": 0,
+    "acquire_wait_seconds_total": 0.0,
+    "acquire_wait_seconds_max": 0.0,
+}
+
+
+def record_query(record):
+    """
+    asyncpg query logger: records the latency of every statement run on a pooled
+    connection in the db_query_duration_seconds metric. asyncpg calls it with
+    call_soon after the statement finished, so it adds nothing to the query itself.
+    """
+    observe_query(record.query, record.elapsed, record.exception is not None)
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    conn.add_query_logger(record_query)
+
+
+async def init_db_pool() -> asyncpg.Pool:
+    """
+    Create the shared asyncpg connection pool. Called once from the app lifespan.
+    """
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    _pool = await asyncpg.create_pool(
         host=os.getenv("PGHOST"),
         database=os.getenv("PGNAME"),
         user=os.getenv("PGUSER"),
         password=os.getenv("PGPASS"),
-        port=os.getenv("PGPORT")
+        port=os.getenv("PGPORT"),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        init=_init_connection,
     )
-    return conn
+    print(f"Database pool initialized (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+    await apply_migrations(_pool)
+    return _pool
+
+
+async def apply_migrations(pool: asyncpg.Pool):
+    """
+    Apply SCHEMA_MIGRATIONS. Every statement is idempotent, so this is safe on every start.
+    """
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+        try:
+            for statement in SCHEMA_MIGRATIONS:
+                await conn.execute(statement)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
+    print(f"Applied {len(SCHEMA_MIGRATIONS)} schema migrations")
+
+
+async def run_background_migrations():
+    """
+    Runs BACKGROUND_BACKFILLS where rows are left, then builds the missing BACKGROUND_INDEXES.
+    Started in the background from the app lifespan; only one worker runs them while the
+    others skip. An interrupted index build leaves an invalid index, which is built again.
+    """
+    async with get_pool().acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", BACKGROUND_MIGRATION_LOCK_KEY):
+            return
+        # Held until the connection goes back to the pool, whose reset releases every advisory
+        # lock, also when this is cancelled at shutdown
+        for table, column in BACKGROUND_BACKFILLS.items():
+            if not await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {table} WHERE search_vector IS NULL)"):
+                continue
+            started = time.perf_counter()
+            last_id = await conn.fetchval(f"SELECT max(id) FROM {table}")
+            for first_id in range(0, last_id, BACKFILL_BATCH_SIZE):
+                await conn.execute(
+                    f"UPDATE {table} SET {column} = {column} "
+                    f"WHERE id > $1 AND id <= $2 AND search_vector IS NULL",
+                    first_id, first_id + BACKFILL_BATCH_SIZE
+                )
+            print(f"Backfilled {table}.search_vector in {time.perf_counter() - started:.1f}s")
+
+        for name, definition in BACKGROUND_INDEXES.items():
+            valid = await conn.fetchval(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = $1 AND pg_table_is_visible(c.oid)",
+                name
+            )
+            if valid:
+                continue
+            started = time.perf_counter()
+            try:
+                if valid is False:
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+            except asyncpg.PostgresError as e:
+                print(f"Building index {name} failed: {e}")
+                continue
+            print(f"Built index {name} in {time.perf_counter() - started:.1f}s")
+
+
+async def close_db_pool():
+    """
+    Close the shared pool, waiting for borrowed connections to be released.
+    """
+    global _pool
+    if _pool is None:
+        return
+    await _pool.close()
+    _pool = None
+    print("Database pool closed")
+
+
+def get_pool() -> asyncpg.Pool:
+    """
+    Returns the shared pool, for code that runs outside a request (background jobs).
+    """
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialized. Was init_db_pool() called at startup?")
+    return _pool
+
+
+@asynccontextmanager
+async def acquire_db():
+    """
+    Borrows a connection from the pool for the duration of the block and always
+    hands it back afterwards. For routes that must not hold a connection for the
+    whole request (see get_db).
+
+    Raises HTTPException(503) if no connection frees up within the acquire timeout.
+    """
+    pool = get_pool()
+    started = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _stats["acquire_timeouts"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database is busy, please retry."
+        )
+
+    waited = time.perf_counter() - started
+    _stats["acquired"] += 1
+    _stats["acquire_wait_seconds_total"] += waited
+    _stats["acquire_wait_seconds_max"] = max(_stats["acquire_wait_seconds_max"], waited)
+    db_acquire_seconds.labels().observe(waited)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+        _stats["released"] += 1
+
+
+async def get_db():
+    """
+    FastAPI dependency that borrows a connection from the pool for the
+    duration of the request and always hands it back afterwards.
+
+    Raises HTTPException(503) if no connection frees up within the acquire timeout.
+    """
+    async with acquire_db() as conn:
+        yield conn
+
+
+def get_pool_stats() -> dict:
+    """
+    Returns a snapshot of pool utilisation and acquire counters.
+    """
+    stats = dict(_stats)
+    if _pool is None:
+        stats.update({"size": 0, "idle": 0, "in_use": 0,
+                      "min_size": DB_POOL_MIN_SIZE, "max_size": DB_POOL_MAX_SIZE})
+        return stats
+
+    size = _pool.get_size()
+    idle = _pool.get_idle_size()
+    stats.update({
+        "size": size,
+        "idle": idle,
+        "in_use": size - idle,
+        "min_size": _pool.get_min_size(),
+        "max_size": _pool.get_max_size(),
+    })
+    return stats
+
+
+def _pool_connection_samples():
+    stats = get_pool_stats()
+    return [(("in_use",), stats["in_use"]), (("idle",), stats["idle"])]
+
+
+# Pool utilisation for /metrics, read from get_pool_stats() when scraped
+CallbackMetric(
+    "db_pool_connections", "Pooled database connections by state.", "gauge", ("state",), _pool_connection_samples
+)
+CallbackMetric(
+    "db_pool_max_connections", "Largest size the pool may grow to.", "gauge", (),
+    lambda: [((), get_pool_stats()["max_size"])]
+)
+CallbackMetric(
+    "db_pool_acquire_timeouts_total", "Requests that gave up waiting for a connection.", "counter", (),
+    lambda: [((), _stats["acquire_timeouts"])]
+)
@@ -1,55 +1,337 @@
-from PyPDF2 import PdfReader
-from docx import Document
-import io # To handle the file content in memory
+import os
+import time
+import codecs
+import asyncio
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, NamedTuple, Optional
+from fastapi import HTTPException, Request, status
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import MultipartParseError
+from app.utils.extract import parsers
 
-from app.models.schemas import Document
+# Uploads larger than this are rejected while they are being received
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# Room allowed for multipart boundaries, part headers and other form fields when the
+# Content-Length of an upload is checked against MAX_UPLOAD_BYTES
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# Uploads are spooled here as the request body streams in; defaults to the system temp dir
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Spooled files are read back in pieces of this size
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Worker processes for PDF/DOCX parsing, and how long one file may take in total
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+EXTRACT_TIMEOUT_SECONDS = float(os.getenv("EXTRACT_TIMEOUT_SECONDS", "60"))
+# PDF pages parsed per worker call; each call yields its pages as soon as it returns
+PDF_PAGES_PER_TASK = 32
+# DOCX paragraphs per section (DOCX has no pages)
+DOCX_PARAGRAPHS_PER_SECTION = 50
+# Sections parsed by the first DOCX worker call. Each call reads the document from its
+# start, so every further call takes twice as many, up to DOCX_MAX_SECTIONS_PER_TASK:
+# the document is read a few times over rather than once per call.
+DOCX_SECTIONS_PER_TASK = 64
+DOCX_MAX_SECTIONS_PER_TASK = 256
+# Plain text is split into pages of about this many characters, on line boundaries
+TEXT_PAGE_CHARS = 16 * 1024
 
-async def extract_text_from_file(file: Document) -> str:
+PDF_TYPE = "application/pdf"
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class SpooledUpload(NamedTuple):
+    path: str
+    size: int
+    filename: str
+    content_type: str
+    # Hex sha256 of the file's bytes, which identifies its content (see document_contents)
+    sha256: str
+
+
+class ExtractionTimeout(Exception):
+    """Raised when a document takes longer than EXTRACT_TIMEOUT_SECONDS to parse."""
+
+
+def _spool_chunk(spool, digest, chunk: bytes):
+    # Runs in a thread: hashlib releases the GIL on large buffers, so both stay off the event loop
+    digest.update(chunk)
+    spool.write(chunk)
+
+
+class _FilePart:
     """
-    Intelligently extracts text content based on the file's MIME type.
+    Callbacks for python-multipart's streaming parser that pick the `field` file part
+    out of a multipart/form-data body. They run inside parser.write(), so they only
+    collect the file's bytes; the caller hashes and writes them off the event loop.
     """
-    
-    # Read the file content bytes into an in-memory buffer
-    file_bytes = await file.read()
-    
-    # Wrap the bytes in a BytesIO object so libraries can read it like a real file
-    file_like_object = io.BytesIO(file_bytes)
-    
-    mime_type = file.content_type
-    extracted_text = ""
+    def __init__(self, field: str, max_bytes: int):
+        self.field = field.encode("latin-1")
+        self.max_bytes = max_bytes
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.size = 0
+        self.pending: list[bytes] = []
+        self._headers: dict[bytes, bytes] = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._in_file = False
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        # Only the first part of the field that carries a filename is the upload
+        if self.filename is None and options.get(b"name") == self.field and b"filename" in options:
+            self._in_file = True
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            content_type = self._headers.get(b"content-type")
+            self.content_type = content_type.decode("latin-1").strip() if content_type else None
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_file:
+            return
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise _too_large(self.max_bytes)
+        self.pending.append(data[start:end])
 
+    def on_part_end(self):
+        self._in_file = False
+
+    def take_pending(self) -> bytes:
+        data = b"".join(self.pending)
+        self.pending.clear()
+        return data
+
+
+def _too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File is larger than the {max_bytes // (1024 * 1024)} MB limit."
+    )
+
+
+async def spool_upload(request: Request, field: str = "file", max_bytes: int = MAX_UPLOAD_BYTES) -> SpooledUpload:
+    """
+    Streams the `field` file of a multipart/form-data request body to a temporary
+    file as it arrives, hashing it on the way, so the upload is never held in memory
+    and is written to disk once. Raises HTTPException(413) up front when Content-Length
+    is over the limit, and otherwise as soon as the file grows past max_bytes.
+    The caller removes the file (see remove_spooled).
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        raise _too_large(max_bytes)
+    media_type, params = parse_options_header(request.headers.get("content-type"))
+    if media_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a multipart/form-data upload.")
+
+    part = _FilePart(field, max_bytes)
+    parser = MultipartParser(params[b"boundary"], part.callbacks())
+    fd, path = tempfile.mkstemp(prefix="upload-", dir=UPLOAD_SPOOL_DIR)
+    digest = hashlib.sha256()
     try:
-        if mime_type == "text/plain":
-            # Simple text file
-            extracted_text = file_bytes.decode('utf-8')
-            
-        elif mime_type == "application/pdf":
-            # PDF file (requires PyPDF2/pypdf)
-            # reader = PdfReader(file_like_object)
-            # for page in reader.pages:
-            #     extracted_text += page.extract_text() + "\n"
-            extracted_text = f"// PDF Content from {file.filename} //\n\n[PDF extraction logic would run here.]"
-            
-        elif mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            # DOCX file (requires python-docx)
-            # document = Document(file_like_object)
-            # for paragraph in document.paragraphs:
-            #     extracted_text += paragraph.text + "\n"
-            extracted_text = f"// DOCX Content from {file.filename} //\n\n[DOCX extraction logic would run here.]"
-            
-        elif mime_type.startswith("image/"):
-            # Image file (requires pytesseract and Pillow/PIL for OCR)
-            extracted_text = f"// Image OCR Content from {file.filename} //\n\n[OCR logic using Tesseract would run here.]"
+        with os.fdopen(fd, "wb") as spool:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if part.pending:
+                    await asyncio.to_thread(_spool_chunk, spool, digest, part.take_pending())
+            parser.finalize()
+        if part.filename is None:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Missing file field '{field}'."
+            )
+    except MultipartParseError as e:
+        remove_spooled(path)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Malformed multipart body: {e}")
+    except BaseException:
+        remove_spooled(path)
+        raise
+    return SpooledUpload(
+        path, part.size, part.filename or "upload", part.content_type or "application/octet-stream", digest.hexdigest()
+    )
 
-        else:
-            extracted_text = f"Unsupported file type: {mime_type}. Metadata: {file.filename}"
 
-    except Exception as e:
-        # Handle cases where the file might be corrupted or the library fails
-        extracted_text = f"Error processing file {file.filename}: {str(e)}"
+def remove_spooled(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+# Worker processes of pools retired after a timeout, terminated once their grace period is over
+_retired: set = set()
+
 
-    # IMPORTANT: Reset the file pointer for subsequent reads if needed, 
-    # though in FastAPI's UploadFile context, we typically consume the stream once.
-    # We use file_bytes.decode() or io.BytesIO() to work with the content safely.
-    
-    return extracted_text
\ No newline at end of file
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return _executor
+
+
+def _retire_executor():
+    """
+    Replaces the pool after a parse timed out. A single worker cannot be stopped
+    without breaking the pool for every file in it, so new parses go to a fresh pool
+    while the old one finishes what it is running. Its processes are terminated
+    EXTRACT_TIMEOUT_SECONDS later, by when every other parse it held has met its own
+    deadline, so only the stuck parse is cut off.
+    """
+    global _executor
+    executor, _executor = _executor, None
+    if executor is None:
+        return
+    processes = list((getattr(executor, "_processes", None) or {}).values())
+    executor.shutdown(wait=False)
+    _retired.update(processes)
+    asyncio.get_running_loop().call_later(EXTRACT_TIMEOUT_SECONDS, _terminate, processes)
+
+
+def _terminate(processes: list):
+    for process in processes:
+        _retired.discard(process)
+        if process.is_alive():
+            process.terminate()
+
+
+def shutdown_extraction():
+    """Stops the worker processes. Called from the app lifespan."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _terminate(list(_retired))
+
+
+async def _await_parser(future: asyncio.Future, deadline: float):
+    remaining = deadline - time.monotonic()
+    try:
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        return await asyncio.wait_for(future, timeout=remaining)
+    except asyncio.TimeoutError:
+        _retire_executor()
+        raise ExtractionTimeout()
+
+
+async def _run_parser(deadline: float, function, *args):
+    loop = asyncio.get_running_loop()
+    return await _await_parser(loop.run_in_executor(_get_executor(), function, *args), deadline)
+
+
+async def _iter_pdf_pages(path: str, deadline: float) -> AsyncIterator[str]:
+    loop = asyncio.get_running_loop()
+    page_count = await _run_parser(deadline, parsers.count_pdf_pages, path)
+    # Keep every worker busy on the next page ranges while earlier ones are yielded in order
+    ranges = iter(range(0, page_count, PDF_PAGES_PER_TASK))
+    in_flight: deque[asyncio.Future] = deque()
+    try:
+        while True:
+            while len(in_flight) < EXTRACT_WORKERS and (start := next(ranges, None)) is not None:
+                in_flight.append(loop.run_in_executor(
+                    _get_executor(), parsers.extract_pdf_pages, path, start, start + PDF_PAGES_PER_TASK
+                ))
+            if not in_flight:
+                return
+            for page in await _await_parser(in_flight.popleft(), deadline):
+                yield page
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+async def _iter_docx_sections(path: str, deadline: float) -> AsyncIterator[str]:
+    # Like _iter_pdf_pages, but the section count is only known once a call comes back short
+    loop = asyncio.get_running_loop()
+    start, size = 0, DOCX_SECTIONS_PER_TASK
+    in_flight: deque[tuple[asyncio.Future, int]] = deque()
+    try:
+        while True:
+            while len(in_flight) < EXTRACT_WORKERS:
+                in_flight.append((loop.run_in_executor(
+                    _get_executor(), parsers.extract_docx_sections, path, DOCX_PARAGRAPHS_PER_SECTION, start, start + size
+                ), size))
+                start, size = start + size, min(size * 2, DOCX_MAX_SECTIONS_PER_TASK)
+            future, expected = in_flight.popleft()
+            sections = await _await_parser(future, deadline)
+            for section in sections:
+                yield section
+            if len(sections) < expected:
+                return
+    finally:
+        for future, _ in in_flight:
+            future.cancel()
+
+
+async def _iter_text_pages(path: str) -> AsyncIterator[str]:
+    # Decoded incrementally, so multi-byte characters split across chunks survive
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    with open(path, "rb") as source:
+        while chunk := await asyncio.to_thread(source.read, UPLOAD_CHUNK_BYTES):
+            pending += decoder.decode(chunk)
+            while len(pending) >= TEXT_PAGE_CHARS:
+                cut = pending.rfind("\n", 0, TEXT_PAGE_CHARS) + 1 or TEXT_PAGE_CHARS
+                yield pending[:cut]
+                pending = pending[cut:]
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def iter_document_pages(upload: SpooledUpload, timeout: float = EXTRACT_TIMEOUT_SECONDS) -> AsyncIterator[str]:
+    """
+    Yields the text of a spooled upload page by page. PDF and DOCX files are parsed
+    in worker processes, off the event loop; the whole file must be parsed within
+    timeout seconds or ExtractionTimeout is raised.
+    """
+    deadline = time.monotonic() + timeout
+    content_type = upload.content_type
+    try:
+        if content_type == "text/plain":
+            async for page in _iter_text_pages(upload.path):
+                yield page
+        elif content_type == PDF_TYPE:
+            async for page in _iter_pdf_pages(upload.path, deadline):
+                yield page
+        elif content_type == DOCX_TYPE:
+            async for section in _iter_docx_sections(upload.path, deadline):
+                yield section
+        elif content_type.startswith("image/"):
+            # Image file (requires pytesseract and Pillow/PIL for OCR)
+            yield f"// Image OCR Content from {upload.filename} //\n\n[OCR logic using Tesseract would run here.]"
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail=f"Unsupported file type: {content_type}."
+            )
+    except BrokenProcessPool:
+        # A worker died (crashed or ran out of memory) and took the pool down with this file in it
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Document parser restarted, please retry.")
@@ -0,0 +1,81 @@
+"""
+Document parsers that run inside the extraction process pool (see file_extract.py).
+
+Everything here is a plain top-level function so it can be sent to a worker
+process, and takes a file path rather than bytes so uploads never cross the
+process boundary. The parser libraries are imported in the worker only.
+"""
+
+
+def count_pdf_pages(path: str) -> int:
+    from PyPDF2 import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> list[str]:
+    """Returns the text of pages start..stop-1."""
+    from PyPDF2 import PdfReader
+    reader = PdfReader(path)
+    return [(reader.pages[number].extract_text() or "") for number in range(start, min(stop, len(reader.pages)))]
+
+
+# WordprocessingML namespace of the elements read from word/document.xml
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    # The same text python-docx's Paragraph.text gives: runs, tabs and line breaks
+    return "".join(
+        element.text or "" if element.tag == f"{_W}t" else "\t" if element.tag == f"{_W}tab" else "\n"
+        for element in paragraph.iter(f"{_W}t", f"{_W}tab", f"{_W}br", f"{_W}cr")
+    )
+
+
+def _iter_docx_lines(path: str):
+    """
+    Yields the body paragraphs and table rows (cells joined by tabs) of a DOCX in
+    document order. document.xml is parsed as a stream and each element is freed
+    once read, so memory does not grow with the size of the document.
+    """
+    from zipfile import ZipFile
+    from lxml import etree
+    body = f"{_W}body"
+    with ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+        for _, element in etree.iterparse(xml, tag=(f"{_W}p", f"{_W}tbl")):
+            if element.getparent().tag != body:
+                # Paragraphs in table cells are read with their row
+                continue
+            if element.tag == f"{_W}p":
+                yield _docx_paragraph_text(element)
+            else:
+                for row in element.iterchildren(f"{_W}tr"):
+                    yield "\t".join(
+                        "\n".join(_docx_paragraph_text(paragraph) for paragraph in cell.iterchildren(f"{_W}p"))
+                        for cell in row.iterchildren(f"{_W}tc")
+                    )
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def extract_docx_sections(path: str, paragraphs_per_section: int, start: int, stop: int) -> list[str]:
+    """
+    DOCX files have no fixed pages, so paragraphs (and table rows) are grouped
+    into sections of paragraphs_per_section that are handled like pages.
+    Returns sections start..stop-1; fewer than that once the document ends.
+    """
+    sections = []
+    section = []
+    skip = start * paragraphs_per_section
+    for number, line in enumerate(_iter_docx_lines(path)):
+        if number < skip:
+            continue
+        section.append(line)
+        if len(section) == paragraphs_per_section:
+            sections.append("\n".join(section))
+            section = []
+            if start + len(sections) >= stop:
+                return sections
+    if section:
+        sections.append("\n".join(section))
+    return sections
@@ -0,0 +1,75 @@
+import os
+import time
+from decimal import Decimal
+from typing import AsyncIterator, Callable
+import orjson
+from fastapi.responses import StreamingResponse
+from app.utils.metrics import observe_query
+
+# Rows fetched from the server-side cursor per round-trip
+STREAM_PREFETCH = int(os.getenv("STREAM_PREFETCH", "100"))
+
+
+def _default(obj):
+    # orjson handles datetime, UUID and dataclasses natively; numeric columns may come back as Decimal
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    """
+    Encodes obj with orjson, including datetime and Decimal values from the database.
+    """
+    return orjson.dumps(obj, default=_default)
+
+
+async def iter_rows(db, query: str, *args, prefetch: int = STREAM_PREFETCH) -> AsyncIterator:
+    """
+    Yields rows from a server-side cursor, so only `prefetch` rows are held in memory at a time.
+    """
+    # asyncpg cursors only exist inside a transaction
+    async with db.transaction():
+        rows = db.cursor(query, *args, prefetch=prefetch).__aiter__()
+        # Cursor fetches bypass asyncpg's query loggers, so the time spent waiting on the
+        # server is recorded here, without the time the caller spends on each row
+        waited = 0.0
+        failed = False
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    row = await rows.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    waited += time.perf_counter() - started
+                yield row
+        finally:
+            observe_query(query, waited, failed)
+
+
+async def encode_object_stream(key: str, rows: AsyncIterator[dict], trailer: Callable[[], dict]) -> AsyncIterator[bytes]:
+    """
+    Streams {"<key>": [row, ...], **trailer()} one encoded row at a time.
+    trailer() runs after the last row, so it can describe the rows that were sent.
+    """
+    yield b'{' + dumps(key) + b':['
+    first = True
+    async for row in rows:
+        yield dumps(row) if first else b',' + dumps(row)
+        first = False
+    yield b']'
+    for name, value in trailer().items():
+        yield b',' + dumps(name) + b':' + dumps(value)
+    yield b'}'
+
+
+def streaming_json_response(key: str, rows: AsyncIterator[dict], trailer: Callable[[], dict]) -> StreamingResponse:
+    """
+    Wraps encode_object_stream in a StreamingResponse with a JSON media type.
+    """
+    return StreamingResponse(encode_object_stream(key, rows, trailer), media_type="application/json")
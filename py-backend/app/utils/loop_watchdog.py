@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from bisect import bisect_left
+from typing import Optional
+
+# Turn the watchdog off entirely with LOOP_WATCHDOG_ENABLED=false
+LOOP_WATCHDOG_ENABLED = os.getenv("LOOP_WATCHDOG_ENABLED", "true").lower() == "true"
+# The loop is pinged this often; a ping that runs late by the lag measures how long
+# other code kept the loop from running
+LOOP_WATCHDOG_INTERVAL_MS = float(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "100"))
+# Lag at which the loop counts as blocked: the blocking code's stack is sampled and the stall logged
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))
+# Call sites reported in the stats, worst first
+LOOP_WATCHDOG_TOP_SITES = int(os.getenv("LOOP_WATCHDOG_TOP_SITES", "10"))
+# Frames kept of the example stack of each call site
+STACK_DEPTH = 12
+# Upper bounds of the lag histogram buckets, in milliseconds
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _describe(frame: traceback.FrameSummary) -> str:
+    path = os.path.relpath(frame.filename, os.path.dirname(_APP_DIR)) if frame.filename.startswith(_APP_DIR) \
+        else frame.filename
+    return f"{path}:{frame.lineno} in {frame.name}"
+
+
+class _Site:
+    def __init__(self, blocking_in: str, stack: list[str]):
+        self.blocking_in = blocking_in
+        self.stack = stack
+        self.samples = 0
+        self.stalled_ms = 0.0
+
+
+class LoopWatchdog:
+    """
+    Measures how long the event loop is kept from running, and by what.
+
+    A heartbeat task sleeps for LOOP_WATCHDOG_INTERVAL_MS at a time and records how
+    late it wakes up in a histogram. A sampler thread checks that heartbeat; while the
+    loop is stuck for longer than LOOP_LAG_THRESHOLD_MS it reads the loop thread's
+    current stack (sys._current_frames) and charges the stalled time to the innermost
+    frame in the app's own code, so blocking calls show up by call site. When nothing
+    blocks, the cost is one timer on the loop and one sleeping thread.
+    """
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = 0.0
+        self._sites: dict[str, _Site] = {}
+        self.buckets = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.beats = 0
+        self.lag_ms_total = 0.0
+        self.lag_ms_max = 0.0
+        self.stalls = 0
+        self.stalled_ms_total = 0.0
+
+    def start(self):
+        """Starts the heartbeat and the sampler thread. Called from the app lifespan."""
+        if not LOOP_WATCHDOG_ENABLED or self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._sample, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._thread.join()
+        self._thread = None
+
+    async def _heartbeat(self):
+        interval = LOOP_WATCHDOG_INTERVAL_MS / 1000
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self._last_beat = now
+            self._record(max(0.0, (now - started - interval) * 1000))
+
+    def _record(self, lag_ms: float):
+        self.beats += 1
+        self.lag_ms_total += lag_ms
+        self.lag_ms_max = max(self.lag_ms_max, lag_ms)
+        self.buckets[bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+        if lag_ms >= LOOP_LAG_THRESHOLD_MS:
+            self.stalls += 1
+            self.stalled_ms_total += lag_ms
+            print(f"Event loop blocked for {lag_ms:.0f} ms")
+
+    def _sample(self):
+        # Sampling four times per threshold charges each stall to its call sites within a quarter of it
+        period = LOOP_LAG_THRESHOLD_MS / 4000
+        stuck_after = (LOOP_WATCHDOG_INTERVAL_MS + LOOP_LAG_THRESHOLD_MS) / 1000
+        while not self._stop.wait(period):
+            if time.monotonic() - self._last_beat < stuck_after:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._charge(traceback.extract_stack(frame), period * 1000)
+
+    def _charge(self, stack: traceback.StackSummary, stalled_ms: float):
+        # The innermost frame in the app's own code is the call site to fix; the innermost
+        # frame overall shows what it was blocked in (a socket read, bcrypt, ...)
+        app_frames = [frame for frame in stack if frame.filename.startswith(_APP_DIR)]
+        site = _describe(app_frames[-1] if app_frames else stack[-1])
+        with self._lock:
+            entry = self._sites.get(site)
+            if entry is None:
+                entry = self._sites[site] = _Site(
+                    _describe(stack[-1]), [_describe(frame) for frame in stack[-STACK_DEPTH:]]
+                )
+            entry.samples += 1
+            entry.stalled_ms += stalled_ms
+
+    def stats(self) -> dict:
+        with self._lock:
+            sites = sorted(self._sites.items(), key=lambda item: item[1].stalled_ms, reverse=True)
+            top_sites = [
+                {
+                    "site": site,
+                    "blocking_in": entry.blocking_in,
+                    "samples": entry.samples,
+                    "stalled_ms": round(entry.stalled_ms, 1),
+                    "stack": entry.stack,
+                }
+                for site, entry in sites[:LOOP_WATCHDOG_TOP_SITES]
+            ]
+        histogram = {f"le_{bound}": count for bound, count in zip(LAG_BUCKETS_MS, self.buckets)}
+        histogram["le_inf"] = self.buckets[-1]
+        return {
+            "enabled": LOOP_WATCHDOG_ENABLED,
+            "interval_ms": LOOP_WATCHDOG_INTERVAL_MS,
+            "threshold_ms": LOOP_LAG_THRESHOLD_MS,
+            "beats": self.beats,
+            "avg_lag_ms": self.lag_ms_total / self.beats if self.beats else 0.0,
+            "max_lag_ms": self.lag_ms_max,
+            "lag_histogram_ms": histogram,
+            "stalls": self.stalls,
+            "stalled_ms_total": self.stalled_ms_total,
+            "top_sites": top_sites,
+        }
+
+
+loop_watchdog = LoopWatchdog()
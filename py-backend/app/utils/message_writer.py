@@ -0,0 +1,191 @@
+import os
+import time
+import asyncio
+from typing import Optional
+from app.utils.database import get_pool
+
+# Messages are written in batches: a batch goes out when it holds MESSAGE_WRITE_BATCH_SIZE
+# rows or its oldest row has waited MESSAGE_WRITE_MAX_DELAY_MS, whichever comes first.
+# With the default of 0 a batch goes out as soon as the previous one is written, so
+# batches grow with load by themselves and a quiet server adds no delay.
+MESSAGE_WRITE_BATCH_SIZE = int(os.getenv("MESSAGE_WRITE_BATCH_SIZE", "200"))
+MESSAGE_WRITE_MAX_DELAY_MS = float(os.getenv("MESSAGE_WRITE_MAX_DELAY_MS", "0"))
+
+# One array parameter per column. id and created_at are left to the database, so ids follow
+# insert order across workers and the id boundaries in history and summaries hold. Ids are
+# drawn in the order of the batch and matched back to their rows by position.
+INSERT_MESSAGES_SQL = """
+    WITH batch AS (
+        SELECT nextval(pg_get_serial_sequence('messages', 'id')) AS id, ordered.*
+        FROM (
+            SELECT *
+            FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::text[], $6::bool[], $7::int[], $8::text[])
+                 WITH ORDINALITY AS rows (chat_id, role, content, code, code_blocks, truncated, token_count, model, position)
+            ORDER BY position
+        ) ordered
+    ),
+    inserted AS (
+        INSERT INTO messages (id, chat_id, role, content, code, code_blocks, truncated, token_count, model)
+        SELECT id, chat_id, role, content, code, code_blocks::jsonb, truncated, token_count, model FROM batch
+        RETURNING id
+    )
+    SELECT batch.position, batch.id FROM batch JOIN inserted USING (id)
+"""
+
+
+class _PendingMessage:
+    def __init__(self, record: tuple):
+        loop = asyncio.get_running_loop()
+        self.record = record
+        self.saved = loop.create_future()
+        self.queued_at = loop.time()
+
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages.
+
+    submit() returns a future that resolves to the message id once the row is
+    committed. A background task inserts the queued rows of all chats in one
+    statement per batch; the database assigns id and created_at as the batch is
+    written, so both follow insert order on every worker. If a batch fails (for
+    example a chat was deleted meanwhile), its rows are retried one by one so only
+    the offending message fails.
+    """
+    def __init__(self):
+        self._queue: list[_PendingMessage] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.largest_batch = 0
+        self.write_seconds_total = 0.0
+
+    def start(self):
+        """Starts the background writer. Called from the app lifespan."""
+        if self._task is None:
+            self._closing = False
+            # A fresh event each start, as an event stays bound to the loop it first waited on
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Writes everything still queued, then stops. Called before the pool closes."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        print(f"Message writer stopped after writing {self.rows_written} messages")
+
+    def submit(
+        self,
+        chat_id: int,
+        role: str,
+        content: str,
+        code: Optional[str] = None,
+        code_blocks: Optional[str] = None,
+        truncated: bool = False,
+        token_count: Optional[int] = None,
+        model: Optional[str] = None,
+    ) -> asyncio.Future:
+        """
+        Queues a message. Returns a future that resolves to its id once the row is
+        committed, or raises the error that kept it from being written.
+        """
+        if self._task is None or self._closing:
+            raise RuntimeError("Message writer is not running. Was start() called at startup?")
+        pending = _PendingMessage((chat_id, role, content, code, code_blocks, truncated, token_count, model))
+        self._queue.append(pending)
+        if len(self._queue) == 1 or len(self._queue) >= MESSAGE_WRITE_BATCH_SIZE:
+            self._wakeup.set()
+        return pending.saved
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        max_delay = MESSAGE_WRITE_MAX_DELAY_MS / 1000
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Give concurrent turns until the oldest queued row is due to join the batch,
+            # unless it is already full. Rows that queued during the last write are due at once.
+            remaining = self._queue[0].queued_at + max_delay - loop.time()
+            if remaining > 0 and len(self._queue) < MESSAGE_WRITE_BATCH_SIZE and not self._closing:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._queue[:MESSAGE_WRITE_BATCH_SIZE]
+            del self._queue[:MESSAGE_WRITE_BATCH_SIZE]
+            await self._write(batch)
+
+    async def _write(self, batch: list[_PendingMessage]):
+        started = time.perf_counter()
+        try:
+            async with get_pool().acquire() as conn:
+                try:
+                    ids = await self._insert(conn, batch)
+                    failed = []
+                except Exception as e:
+                    print(f"Batch write of {len(batch)} messages failed ({e}), retrying row by row")
+                    ids, failed = await self._write_rows(conn, batch)
+        except Exception as e:
+            # No connection at all: every message of the batch fails
+            ids, failed = {}, [(pending, e) for pending in batch]
+
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.write_seconds_total += time.perf_counter() - started
+        self.rows_failed += len(failed)
+        self.rows_written += len(batch) - len(failed)
+        errors = {id(pending): error for pending, error in failed}
+        for pending in batch:
+            if pending.saved.done():
+                continue
+            error = errors.get(id(pending))
+            if error is None:
+                pending.saved.set_result(ids[id(pending)])
+            else:
+                pending.saved.set_exception(error)
+
+    @staticmethod
+    async def _insert(conn, batch: list[_PendingMessage]) -> dict[int, int]:
+        """Inserts the batch in one statement; returns the new message ids keyed by id(pending)."""
+        columns = list(zip(*(pending.record for pending in batch)))
+        rows = await conn.fetch(INSERT_MESSAGES_SQL, *columns)
+        positions = {row["position"]: row["id"] for row in rows}
+        return {id(pending): positions[position] for position, pending in enumerate(batch, start=1)}
+
+    async def _write_rows(
+        self, conn, batch: list[_PendingMessage]
+    ) -> tuple[dict[int, int], list[tuple[_PendingMessage, Exception]]]:
+        ids = {}
+        failed = []
+        for pending in batch:
+            try:
+                ids.update(await self._insert(conn, [pending]))
+            except Exception as e:
+                failed.append((pending, e))
+        return ids, failed
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "largest_batch": self.largest_batch,
+            "avg_batch_size": self.rows_written / self.batches if self.batches else 0.0,
+            "write_seconds_total": self.write_seconds_total,
+        }
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,304 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+# Distinct label values a bounded label (model, SQL statement) takes on; later ones are
+# reported as "other", so request input cannot grow the number of series without bound
+METRICS_MAX_MODELS = int(os.getenv("METRICS_MAX_MODELS", "50"))
+METRICS_MAX_STATEMENTS = int(os.getenv("METRICS_MAX_STATEMENTS", "200"))
+# Content type of the Prometheus text exposition format served at /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram bucket upper bounds
+STREAM_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKENS_PER_SECOND_BUCKETS = (1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+QUERY_SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+OTHER = "other"
+
+
+class _Shards:
+    """
+    A fixed number of float slots, kept once per thread. A thread only ever adds to
+    its own slots, so recording takes no lock; a scrape adds up the slots of all threads.
+    """
+    __slots__ = ("_size", "_local", "_shards", "_lock")
+
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        self._shards: list[list[float]] = []
+        self._lock = threading.Lock()
+
+    def local(self) -> list[float]:
+        values = getattr(self._local, "values", None)
+        if values is None:
+            values = self._local.values = [0.0] * self._size
+            # Once per thread; threads that exit keep their shard, so counters never go back
+            with self._lock:
+                self._shards.append(values)
+        return values
+
+    def totals(self) -> list[float]:
+        with self._lock:
+            shards = list(self._shards)
+        totals = [0.0] * self._size
+        for values in shards:
+            for index, value in enumerate(values):
+                totals[index] += value
+        return totals
+
+
+class _Value:
+    __slots__ = ("_shards",)
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount: float = 1.0):
+        self._shards.local()[0] += amount
+
+    def dec(self, amount: float = 1.0):
+        self._shards.local()[0] -= amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        yield f"{name}{labels} {_format_value(self._shards.totals()[0])}"
+
+
+class _HistogramValue:
+    __slots__ = ("_buckets", "_shards")
+
+    def __init__(self, buckets: tuple):
+        self._buckets = buckets
+        # One slot per bucket, one for +Inf, and the sum of the observed values
+        self._shards = _Shards(len(buckets) + 2)
+
+    def observe(self, value: float):
+        values = self._shards.local()
+        values[bisect_left(self._buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        totals = self._shards.totals()
+        prefix = labels[:-1] + "," if labels else "{"
+        cumulative = 0.0
+        for bound, count in zip(self._buckets + (float("inf"),), totals):
+            cumulative += count
+            yield f'{name}_bucket{prefix}le="{_format_value(bound)}"}} {_format_value(cumulative)}'
+        yield f"{name}_sum{labels} {_format_value(totals[-1])}"
+        yield f"{name}_count{labels} {_format_value(cumulative)}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values: str):
+        """The series for these label values; callers on a hot path keep the result."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        return _Value()
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, _format_labels(self.labelnames, values))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+
+class Gauge(_Metric):
+    """A gauge that is moved with inc()/dec(), such as a count of streams in flight."""
+    kind = "gauge"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = STREAM_SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+
+class CallbackMetric:
+    """
+    A counter or gauge whose samples are read from existing stats when scraped, e.g. the
+    database pool's. collect returns (label values, value) pairs.
+    """
+    def __init__(self, name: str, documentation: str, kind: str, labelnames: tuple,
+                 collect: Callable[[], Iterable[tuple[tuple, float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self._collect = collect
+        registry.register(self)
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, value in self._collect():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """The current value of every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class _BoundedLabel:
+    """Maps raw values to label values, admitting the first `limit` distinct ones."""
+    def __init__(self, limit: int, normalize: Callable[[str], str] = str):
+        self._limit = limit
+        self._normalize = normalize
+        self._labels: dict[str, str] = {}
+
+    def __call__(self, value: str) -> str:
+        label = self._labels.get(value)
+        if label is None:
+            label = self._normalize(value)
+            if len(self._labels) < self._limit:
+                self._labels[value] = label
+            else:
+                label = OTHER
+        return label
+
+
+registry = Registry()
+
+# Upstream model streams, per model identifier (see stream_utils.stream_text)
+llm_first_chunk_seconds = Histogram(
+    "llm_stream_first_chunk_seconds", "Time from the model request to its first text chunk.", ("model",)
+)
+llm_stream_seconds = Histogram(
+    "llm_stream_duration_seconds", "Time from the model request to the end of its stream, by outcome.",
+    ("model", "outcome")
+)
+llm_tokens_per_second = Histogram(
+    "llm_stream_tokens_per_second",
+    "Output tokens per second after the first chunk; chunks stand in for tokens the model did not report.",
+    ("model",), TOKENS_PER_SECOND_BUCKETS
+)
+llm_tokens = Counter("llm_stream_output_tokens_total", "Output tokens streamed.", ("model",))
+llm_characters = Counter("llm_stream_output_characters_total", "Output characters streamed.", ("model",))
+llm_streams = Counter(
+    "llm_streams_total", "Model streams by outcome: completed, cancelled (the reader stopped early) or error.",
+    ("model", "outcome")
+)
+# Answers being sent to clients as server-sent events (see assistant_routes.send_chat_stream)
+sse_streams_in_flight = Gauge("sse_streams_in_flight", "Server-sent event responses currently streaming.")
+
+# Database statements, labelled with their SQL text (see database.record_query)
+db_query_seconds = Histogram(
+    "db_query_duration_seconds", "Time the database took per statement.", ("statement",), QUERY_SECONDS_BUCKETS
+)
+db_query_errors = Counter("db_query_errors_total", "Statements that raised an error.", ("statement",))
+db_acquire_seconds = Histogram(
+    "db_pool_acquire_wait_seconds", "Time a request waited for a pooled connection.", (), QUERY_SECONDS_BUCKETS
+)
+
+model_label = _BoundedLabel(METRICS_MAX_MODELS)
+statement_label = _BoundedLabel(METRICS_MAX_STATEMENTS, lambda query: " ".join(query.split()))
+
+
+def observe_query(query: str, seconds: float, failed: bool = False):
+    statement = statement_label(query)
+    db_query_seconds.labels(statement).observe(seconds)
+    if failed:
+        db_query_errors.labels(statement).inc()
+
+
+class StreamTimer:
+    """
+    Times one upstream model stream. chunk() is called per text chunk, finish() once
+    with the outcome. Ollama streams roughly one token per chunk, so the chunk count
+    stands in for the token count when the stream ends before the model reports it.
+    """
+    __slots__ = ("model", "started_at", "first_chunk_at", "chunks", "characters", "tokens", "_finished")
+
+    def __init__(self, model_identifier: str):
+        self.model = model_label(model_identifier)
+        self.started_at = time.perf_counter()
+        self.first_chunk_at: Optional[float] = None
+        self.chunks = 0
+        self.characters = 0
+        # Output tokens as reported by the model, if it did
+        self.tokens: Optional[int] = None
+        self._finished = False
+
+    def chunk(self, text: str):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+            llm_first_chunk_seconds.labels(self.model).observe(self.first_chunk_at - self.started_at)
+        self.chunks += 1
+        self.characters += len(text)
+
+    def finish(self, outcome: str):
+        if self._finished:
+            return
+        self._finished = True
+        ended_at = time.perf_counter()
+        llm_streams.labels(self.model, outcome).inc()
+        llm_stream_seconds.labels(self.model, outcome).observe(ended_at - self.started_at)
+        if self.first_chunk_at is None:
+            return
+        tokens = self.tokens or self.chunks
+        llm_tokens.labels(self.model).inc(tokens)
+        llm_characters.labels(self.model).inc(self.characters)
+        generating = ended_at - self.first_chunk_at
+        if generating > 0 and tokens > 1:
+            # The first token arrives at first_chunk_at; the rest took `generating` seconds
+            llm_tokens_per_second.labels(self.model).observe((tokens - 1) / generating)
+
+
+def render() -> str:
+    return registry.render()
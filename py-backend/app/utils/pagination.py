@@ -0,0 +1,63 @@
+import base64
+from datetime import datetime
+from typing import AsyncIterator
+from fastapi import HTTPException
+
+# Page sizes for cursor-paginated lists, and the largest page a client may ask for
+CHAT_PAGE_SIZE = 50
+CHAT_MAX_PAGE_SIZE = 100
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """
+    Encodes the (created_at, id) keyset position of a row into an opaque cursor string.
+    """
+    raw = f"{created_at.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Decodes a cursor produced by encode_cursor back into (created_at, id).
+    Raises HTTPException(400) if the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = base64.urlsafe_b64decode(padded).decode("utf-8").rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class PageTracker:
+    """
+    Trims a streamed page query to `limit` rows and remembers where it ended.
+
+    Page queries select one row more than the page size, plus a `rn` column
+    numbering the rows in keyset order. Rows past `limit` only tell us that
+    another page exists; the row numbered `limit` is where the next page starts.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.has_more = False
+        self.last_row = None
+
+    async def rows(self, records) -> AsyncIterator[dict]:
+        async for record in records:
+            row = dict(record)
+            rn = row.pop("rn")
+            if rn > self.limit:
+                self.has_more = True
+                continue
+            if rn == self.limit:
+                self.last_row = row
+            yield row
+
+    @property
+    def next_cursor(self) -> str | None:
+        """Cursor for the following page, or None if this was the last one."""
+        if not self.has_more or self.last_row is None:
+            return None
+        return encode_cursor(self.last_row["created_at"], self.last_row["id"])
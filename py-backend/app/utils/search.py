@@ -0,0 +1,79 @@
+import os
+import re
+from app.utils.json_stream import iter_rows
+
+# Results per page for /api/chat/search, and the largest page a client may ask for
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "100"))
+
+# Words of the query that are turned into search terms
+TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+# Matches on the chat title rank above matches inside a single message
+TITLE_RANK_BOOST = 2.0
+
+SEARCH_SQL = f"""
+    WITH q AS (SELECT to_tsquery('simple', $1) AS query),
+    matches AS (
+        SELECT m.chat_id, m.id AS message_id, ts_rank_cd(m.search_vector, q.query) AS rank
+        FROM messages m, q
+        WHERE m.search_vector @@ q.query
+        UNION ALL
+        SELECT c.id, NULL, ts_rank_cd(c.search_vector, q.query) * {TITLE_RANK_BOOST}
+        FROM chats c, q
+        WHERE c.search_vector @@ q.query
+    ),
+    best AS (
+        -- Keep only the best hit of every chat
+        SELECT DISTINCT ON (chat_id) chat_id, message_id, rank
+        FROM matches
+        ORDER BY chat_id, rank DESC
+    ),
+    page AS (
+        SELECT chat_id, message_id, rank
+        FROM best
+        ORDER BY rank DESC, chat_id DESC
+        LIMIT $2 OFFSET $3
+    )
+    -- Snippets are only built for the rows of the requested page
+    SELECT c.id, c.title, c.created_at, p.rank, p.message_id,
+           row_number() OVER (ORDER BY p.rank DESC, c.id DESC) AS rn,
+           ts_headline(
+               'simple',
+               coalesce(m.content || ' ' || coalesce(m.code, ''), c.title),
+               q.query,
+               'MaxFragments=2, MaxWords=20, MinWords=5, StartSel=<<, StopSel=>>'
+           ) AS snippet
+    FROM page p
+    JOIN chats c ON c.id = p.chat_id
+    LEFT JOIN messages m ON m.id = p.message_id
+    CROSS JOIN q
+    ORDER BY p.rank DESC, c.id DESC
+"""
+
+
+def build_search_query(text: str) -> str | None:
+    """
+    Turns free text into a prefix-matching tsquery ("foo bar" -> "foo:* & bar:*"),
+    so results update while the user is still typing a word.
+    Returns None if the text contains no searchable words.
+    """
+    terms = TERM_RE.findall(text.lower())
+    if not terms:
+        return None
+    return " & ".join(f"{term}:*" for term in terms)
+
+
+async def iter_search_rows(db, text: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    """
+    Relevance-ranked search over chat titles, message content and code.
+
+    Streams up to limit + 1 rows (see PageTracker) holding id, title, created_at,
+    rank, message_id (None for title-only matches), a highlighted snippet and rn.
+    """
+    tsquery = build_search_query(text)
+    if tsquery is None:
+        return
+
+    async for row in iter_rows(db, SEARCH_SQL, tsquery, limit + 1, offset):
+        yield row
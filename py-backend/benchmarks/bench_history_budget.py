@@ -0,0 +1,150 @@
+"""
+How closely the history sent to the model follows its token budget, before and after
+the fixed ten-message history was replaced by a per-model budget (chat_utils).
+
+Synthetic chats mix short turns, answers with code blocks and the odd pasted log. For
+each budget and chat the question is sized as users size them and the history is
+picked as the route picks it:
+- before: the last ten messages, whatever their size,
+- after: get_chat_history with the budget left after the question, PROMPT_OVERHEAD_TOKENS
+  and the question's framing, from the database (scratch schema) and again from the cache.
+What is measured is the text of the Ollama messages built from that history
+(stream_utils._to_ollama_messages), counted with count_tokens, plus --framing tokens
+per message for the chat template (MESSAGE_FRAMING_TOKENS by default). Reported: the
+mean share of the budget used, how often and by how much the prompt went over, and
+whether the database and cache paths picked the same messages.
+
+count_tokens is a ~4 characters per token estimate; no model tokenizer ships with the
+app, so how far the estimate is from a real tokenizer is not measured here.
+
+Needs PostgreSQL (PG* variables); creates and drops the schema bench_history.
+
+    python -m benchmarks.bench_history_budget [--chats 200] [--budgets 1000 3000 8000]
+"""
+import os
+import random
+import asyncio
+import argparse
+import statistics
+import asyncpg
+import orjson
+from app.utils.assistant.chat_utils import (
+    MESSAGE_FRAMING_TOKENS, PROMPT_OVERHEAD_TOKENS, count_tokens, get_chat_history, history_text, message_token_count, truncate_to_tokens,
+)
+from app.utils.assistant.history_cache import history_cache
+from app.utils.assistant.parser import parse_markdown
+from app.utils.assistant.stream_utils import _to_ollama_messages
+from app.models.schemas import Message
+
+WORDS = "the a query index table row lock token budget model answer code test value list".split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choices(WORDS, k=words)).capitalize() + "."
+
+
+def make_message(rng: random.Random, role: str) -> str:
+    kind = rng.random()
+    if role == "user":
+        if kind < 0.05:
+            # A pasted log or file
+            return "Here is the log:\n" + "\n".join(sentence(rng, 12) for _ in range(rng.randrange(200, 700)))
+        return sentence(rng, rng.randrange(4, 60))
+    if kind < 0.5:
+        code = "\n".join(f"    value_{line} = compute({line})" for line in range(rng.randrange(5, 60)))
+        return f"{sentence(rng, 40)}\n```python\n{code}\n```\n{sentence(rng, 20)}"
+    return "\n\n".join(sentence(rng, rng.randrange(10, 40)) for _ in range(rng.randrange(1, 8)))
+
+
+def make_chat(rng: random.Random, turns: int) -> list[tuple[str, str]]:
+    return [(role, make_message(rng, role)) for _ in range(turns) for role in ("user", "assistant")]
+
+
+def sent_tokens(history: list, question: str, framing: int) -> int:
+    messages = _to_ollama_messages(history, question)
+    return sum(count_tokens(message["content"]) + framing for message in messages)
+
+
+async def load(conn, chats: list[list[tuple[str, str]]]):
+    await conn.execute("DROP SCHEMA IF EXISTS bench_history CASCADE; CREATE SCHEMA bench_history")
+    await conn.execute("""
+        CREATE TABLE messages (
+            id SERIAL PRIMARY KEY, chat_id INT, role TEXT, content TEXT, code TEXT, code_blocks JSONB,
+            token_count INTEGER, created_at TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    records = []
+    for chat_id, chat in enumerate(chats, 1):
+        for role, text in chat:
+            # Stored the way the route stores an answer: prose and code blocks apart
+            parsed = parse_markdown(text)
+            blocks = [block._asdict() for block in parsed.blocks]
+            records.append((
+                chat_id, role, parsed.content, parsed.code, orjson.dumps(blocks).decode(),
+                message_token_count(parsed.content, "".join(block.code for block in parsed.blocks)),
+            ))
+    await conn.copy_records_to_table(
+        "messages", records=records, columns=("chat_id", "role", "content", "code", "code_blocks", "token_count")
+    )
+
+
+def summarize(name: str, budget: int, used: list[int]):
+    over = [tokens - budget for tokens in used if tokens > budget]
+    print(f"{name:<14} {budget:>7} {statistics.mean(used) / budget:>10.0%} {len(over) / len(used):>9.0%} "
+          f"{statistics.median(over) if over else 0:>14.0f} {max(over) if over else 0:>9}")
+
+
+async def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--chats", type=int, default=200)
+    arguments.add_argument("--turns", type=int, default=20)
+    arguments.add_argument("--budgets", type=int, nargs="+", default=[1000, 3000, 8000])
+    arguments.add_argument("--framing", type=int, default=MESSAGE_FRAMING_TOKENS,
+                           help="chat template tokens per message")
+    options = arguments.parse_args()
+    rng = random.Random(10)
+    chats = [make_chat(rng, options.turns) for _ in range(options.chats)]
+    questions = [make_message(rng, "user") for _ in chats]
+
+    conn = await asyncpg.connect(
+        host=os.getenv("PGHOST"), port=os.getenv("PGPORT"), user=os.getenv("PGUSER"), password=os.getenv("PGPASS"),
+        database=os.getenv("PGNAME"), server_settings={"search_path": "bench_history"},
+    )
+    try:
+        await load(conn, chats)
+        print(f"{options.chats} chats of {options.turns * 2} messages, {options.framing} framing tokens per message\n")
+        print(f"{'':<14} {'budget':>7} {'mean used':>10} {'over':>9} {'over by p50':>14} {'max':>9}")
+        for budget in options.budgets:
+            before, after = [], []
+            differing = 0
+            for chat_id, question in enumerate(questions, 1):
+                rows = await conn.fetch(
+                    "SELECT role, content, code, code_blocks FROM messages WHERE chat_id = $1 "
+                    "ORDER BY created_at DESC, id DESC LIMIT 10", chat_id
+                )
+                last_ten = [
+                    Message.model_construct(chat_id=chat_id, role=role, content=history_text(content, code, blocks))
+                    for role, content, code, blocks in reversed(rows)
+                ]
+                before.append(sent_tokens(last_ten, question, options.framing))
+
+                # As the route does it: the question first, then the history gets what is left
+                reserved = PROMPT_OVERHEAD_TOKENS + MESSAGE_FRAMING_TOKENS
+                cut = truncate_to_tokens(question, max(32, budget - reserved))
+                available = max(0, budget - reserved - count_tokens(cut))
+                history_cache.invalidate(chat_id)
+                from_database = await get_chat_history(conn, chat_id, available)
+                from_cache = await get_chat_history(conn, chat_id, available)
+                differing += [m.content for m in from_database] != [m.content for m in from_cache]
+                after.append(sent_tokens(from_database, cut, options.framing))
+            summarize("last ten", budget, before)
+            summarize("token budget", budget, after)
+            if differing:
+                print(f"{'':<14} database and cache picked different messages in {differing} chats")
+    finally:
+        await conn.execute("DROP SCHEMA IF EXISTS bench_history CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+"""
+Message insert throughput under concurrent chat turns, before and after inserts went
+through the write-behind MessageWriter (app.utils.message_writer).
+
+Each turn saves a user message and then the assistant answer, waiting for each to be
+committed as the route does, and many turns run at once over a pool of --pool
+connections:
+- per-row: one INSERT ... RETURNING id per message on a pooled connection (before),
+- writer: message_writer.submit() and await its future (after).
+Reported for each number of concurrent turns: rows per second, the p50 and p99 wait for
+a commit, and for the writer its mean batch size.
+
+Needs PostgreSQL (PG* variables); builds the app's tables with its migrations in the
+scratch schema bench_writer and drops it afterwards.
+
+    python -m benchmarks.bench_message_writer [--rows 4000] [--turns 16 64 256] [--pool 10]
+"""
+import os
+import time
+import asyncio
+import argparse
+import statistics
+import asyncpg
+from app.utils import database
+from app.utils.message_writer import MessageWriter
+
+SCHEMA = "bench_writer"
+# The tables the migrations build on, as the app's database has them
+BASE_TABLES = """
+CREATE TABLE users (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, email TEXT, imageurl TEXT);
+CREATE TABLE chats (id SERIAL PRIMARY KEY, title TEXT, created_at TIMESTAMPTZ DEFAULT now());
+CREATE TABLE messages (
+    id SERIAL PRIMARY KEY, chat_id INT REFERENCES chats(id) ON DELETE CASCADE, role TEXT, content TEXT,
+    code TEXT, created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE TABLE documents (id TEXT PRIMARY KEY, user_id TEXT, file_name TEXT, file_path TEXT, content TEXT);
+"""
+QUESTION = "How do I keep a connection pool from running dry while answers stream?"
+ANSWER = "Return the connection before the stream starts. " * 20
+CODE = "async with acquire_db() as db:\n    rows = await db.fetch(query)\n"
+
+
+async def per_row(pool, chat_id: int, role: str, waits: list[float]):
+    started = time.perf_counter()
+    async with pool.acquire() as db:
+        if role == "user":
+            await db.fetchval(
+                "INSERT INTO messages (chat_id, role, content, token_count) VALUES ($1, $2, $3, $4) RETURNING id",
+                chat_id, role, QUESTION, 18,
+            )
+        else:
+            await db.fetchval(
+                """INSERT INTO messages (chat_id, role, content, code, code_blocks, truncated, token_count, model)
+                   VALUES ($1, $2, $3, $4, $5::jsonb, $6, $7, $8) RETURNING id""",
+                chat_id, role, ANSWER, CODE, '[{"language": "python", "code": "", "position": 0}]', False, 260,
+                "ollama:bench",
+            )
+    waits.append(time.perf_counter() - started)
+
+
+async def through_writer(writer: MessageWriter, chat_id: int, role: str, waits: list[float]):
+    started = time.perf_counter()
+    if role == "user":
+        await writer.submit(chat_id, role, QUESTION, token_count=18)
+    else:
+        await writer.submit(
+            chat_id, role, ANSWER, CODE, '[{"language": "python", "code": "", "position": 0}]', False, 260,
+            "ollama:bench",
+        )
+    waits.append(time.perf_counter() - started)
+
+
+async def run(save, rows: int, turns: int, chat_ids: list[int]) -> tuple[float, list[float]]:
+    waits: list[float] = []
+    per_turn = rows // turns // 2
+
+    async def turn(number: int):
+        chat_id = chat_ids[number % len(chat_ids)]
+        for _ in range(per_turn):
+            await save(chat_id, "user", waits)
+            await save(chat_id, "assistant", waits)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(turn(number) for number in range(turns)))
+    return len(waits) / (time.perf_counter() - started), waits
+
+
+async def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--rows", type=int, default=4000)
+    arguments.add_argument("--turns", type=int, nargs="+", default=[16, 64, 256])
+    arguments.add_argument("--pool", type=int, default=10)
+    options = arguments.parse_args()
+
+    connect = dict(
+        host=os.getenv("PGHOST"), port=os.getenv("PGPORT"), user=os.getenv("PGUSER"), password=os.getenv("PGPASS"),
+        database=os.getenv("PGNAME"), server_settings={"search_path": SCHEMA},
+    )
+    admin = await asyncpg.connect(**connect)
+    await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    await admin.execute(BASE_TABLES)
+    for statement in database.SCHEMA_MIGRATIONS:
+        await admin.execute(statement)
+    chat_ids = [row["id"] for row in await admin.fetch(
+        "INSERT INTO chats (title) SELECT 'bench ' || n FROM generate_series(1, 256) n RETURNING id"
+    )]
+    # The writer takes its connections from the app's pool
+    pool = database._pool = await asyncpg.create_pool(min_size=options.pool, max_size=options.pool, **connect)
+    try:
+        print(f"{options.rows} rows per run, pool of {options.pool}\n")
+        print(f"{'turns':>6} {'':<8} {'rows/s':>8} {'commit wait p50 ms':>19} {'p99 ms':>8} {'mean batch':>11}")
+        for turns in options.turns:
+            rows_per_second, waits = await run(
+                lambda chat_id, role, waits: per_row(pool, chat_id, role, waits), options.rows, turns, chat_ids
+            )
+            quantiles = statistics.quantiles(waits, n=100)
+            print(f"{turns:>6} {'per-row':<8} {rows_per_second:>8.0f} {statistics.median(waits) * 1000:>19.1f} "
+                  f"{quantiles[98] * 1000:>8.1f} {'':>11}")
+
+            writer = MessageWriter()
+            writer.start()
+            rows_per_second, waits = await run(
+                lambda chat_id, role, waits: through_writer(writer, chat_id, role, waits), options.rows, turns, chat_ids
+            )
+            await writer.close()
+            quantiles = statistics.quantiles(waits, n=100)
+            print(f"{turns:>6} {'writer':<8} {rows_per_second:>8.0f} {statistics.median(waits) * 1000:>19.1f} "
+                  f"{quantiles[98] * 1000:>8.1f} {writer.stats()['avg_batch_size']:>11.1f}")
+    finally:
+        database._pool = None
+        await pool.close()
+        await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await admin.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
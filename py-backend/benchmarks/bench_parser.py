@@ -0,0 +1,69 @@
+"""
+Parse cost of StreamingMarkdownParser on long answers with many code blocks, fed in
+small chunks the way a model streams them.
+
+Reports the total time, the cost per chunk and the slowest chunk for a few answer
+sizes, so a parser that rescans what it has already seen (cost growing with the
+answer) shows up as a per-chunk cost that grows with the size. Checks on the way
+that the streamed parse matches a single-pass parse and that render_markdown gives
+the answer back.
+
+    python -m benchmarks.bench_parser [--chunk 4] [--blocks 50 200 800]
+"""
+import argparse
+import time
+from app.utils.assistant.parser import StreamingMarkdownParser, parse_markdown, render_markdown
+
+
+def make_answer(blocks: int) -> str:
+    """A model-like answer: prose paragraphs and fenced blocks of a few languages, one after the other."""
+    parts = []
+    for number in range(blocks):
+        parts.append(f"Step {number}: this paragraph explains what the next block does and why.\n")
+        language = ("python", "js", "", "sql")[number % 4]
+        code = "\n".join(f"    value_{number}_{line} = compute({line}, '`quoted`')" for line in range(20))
+        parts.append(f"```{language}\n{code}\n```\n")
+    parts.append("That is all.")
+    return "".join(parts)
+
+
+def stream_parse(answer: str, chunk: int):
+    parser = StreamingMarkdownParser()
+    slowest = 0.0
+    started = time.perf_counter()
+    for start in range(0, len(answer), chunk):
+        before = time.perf_counter()
+        parser.feed(answer[start:start + chunk])
+        slowest = max(slowest, time.perf_counter() - before)
+    parser.finish()
+    return parser, time.perf_counter() - started, slowest
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--chunk", type=int, default=4, help="characters per streamed chunk")
+    arguments.add_argument("--blocks", type=int, nargs="+", default=[50, 200, 800], help="code blocks per answer")
+    options = arguments.parse_args()
+
+    print(f"{'blocks':>7} {'MB':>6} {'chunks':>8} {'total ms':>9} {'us/chunk':>9} {'slowest us':>11} {'1-pass ms':>10}")
+    for blocks in options.blocks:
+        answer = make_answer(blocks)
+        parser, total, slowest = stream_parse(answer, options.chunk)
+
+        started = time.perf_counter()
+        whole = parse_markdown(answer)
+        single_pass = time.perf_counter() - started
+
+        assert (parser.content, parser.blocks) == (whole.content, whole.blocks), "streamed parse differs"
+        assert len(parser.blocks) == blocks
+        assert render_markdown(parser.content, parser.blocks) == answer.rstrip("\n"), "render differs"
+
+        chunks = -(-len(answer) // options.chunk)
+        print(
+            f"{blocks:>7} {len(answer) / 1e6:>6.2f} {chunks:>8} {total * 1e3:>9.1f} "
+            f"{total / chunks * 1e6:>9.2f} {slowest * 1e6:>11.1f} {single_pass * 1e3:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
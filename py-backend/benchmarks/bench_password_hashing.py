@@ -0,0 +1,84 @@
+"""
+Password hashing during a login burst: what it costs the logins and every other request.
+
+A burst of concurrent logins verifies bcrypt hashes while a probe coroutine, standing in
+for the app's other requests, wakes every 10 ms and records how late it woke. Run both
+ways:
+- inline: verify_password called on the event loop, as register and login did before,
+- pool: verify_password_async, on the bounded hashing pool (app.utils.auth).
+Reported: login latency and throughput, and how late the probe woke (p50, p99, max).
+
+Needs no database.
+
+    python -m benchmarks.bench_password_hashing [--logins 40] [--rounds 12]
+"""
+import time
+import asyncio
+import argparse
+import statistics
+from app.utils import auth
+
+
+async def probe(stop: asyncio.Event, delays: list[float]):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        delays.append((time.perf_counter() - started - 0.01) * 1000)
+
+
+async def login_inline(password: str, hashed: str):
+    return auth.verify_password(password, hashed)
+
+
+async def login_pool(password: str, hashed: str):
+    matches, _ = await auth.verify_password_async(password, hashed)
+    return matches
+
+
+async def burst(login, logins: int, hashed: str):
+    stop = asyncio.Event()
+    delays: list[float] = []
+    prober = asyncio.create_task(probe(stop, delays))
+    await asyncio.sleep(0.05)
+    latencies = []
+    # Every login arrives at once, so its latency counts from the start of the burst
+    started = time.perf_counter()
+
+    async def one():
+        assert await login("correct horse battery staple", hashed)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(one() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+    return elapsed, latencies, delays
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--logins", type=int, default=40)
+    arguments.add_argument("--rounds", type=int, default=auth.BCRYPT_ROUNDS)
+    options = arguments.parse_args()
+    auth.BCRYPT_ROUNDS = options.rounds
+    hashed = auth.hash_password("correct horse battery staple")
+    started = time.perf_counter()
+    auth.verify_password("correct horse battery staple", hashed)
+    print(f"one verify at cost {options.rounds}: {(time.perf_counter() - started) * 1000:.0f} ms, "
+          f"{options.logins} concurrent logins, {auth.PASSWORD_HASH_WORKERS} hashing workers\n")
+    print(f"{'':<7} {'logins/s':>9} {'login p50 ms':>13} {'p95 ms':>8} "
+          f"{'probe late p50 ms':>18} {'p99 ms':>8} {'max ms':>8}")
+    for name, login in (("inline", login_inline), ("pool", login_pool)):
+        elapsed, latencies, delays = await burst(login, options.logins, hashed)
+        print(f"{name:<7} {options.logins / elapsed:>9.1f} {statistics.median(latencies):>13.0f} "
+              f"{percentile(latencies, 0.95):>8.0f} {statistics.median(delays):>18.1f} "
+              f"{percentile(delays, 0.99):>8.1f} {max(delays):>8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
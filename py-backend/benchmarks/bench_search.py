@@ -0,0 +1,158 @@
+"""
+Full-text search over messages, before and after generated search_vector columns were
+replaced by trigger-maintained ones (see database.SCHEMA_MIGRATIONS).
+
+Loads the same messages into two scratch tables, then adds search to each:
+- before: the generated column and a plain CREATE INDEX, as first shipped,
+- after: the startup migrations (plain column, trigger), then the background backfill
+  and CREATE INDEX CONCURRENTLY of run_background_migrations.
+While that runs a second session keeps inserting rows. Reported for each: how long
+adding search took, how many inserts got through meanwhile and the longest one waited,
+insert throughput afterwards, latency of the ranked search query, and whether an answer
+with more distinct words than a tsvector holds can be stored.
+
+Needs PostgreSQL (PG* variables); creates and drops the schemas bench_before and bench_after.
+
+    python -m benchmarks.bench_search [--rows 100000] [--queries 200]
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import asyncpg
+from app.utils import database
+from app.utils.search import build_search_query
+
+WORDS = [f"{stem}{number}" for stem in ("vector", "index", "query", "table", "lock", "token") for number in range(2000)]
+QUERIES = ["vector1", "index19", "query 7", "table12 lock3", "token199"]
+BEFORE = [
+    """
+    ALTER TABLE messages ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, '') || ' ' || coalesce(code, ''))) STORED
+    """,
+    "CREATE INDEX messages_search_vector_idx ON messages USING GIN (search_vector)",
+]
+AFTER = [statement for statement in database.SCHEMA_MIGRATIONS if "search_vector" in statement and "messages" in statement]
+# The messages half of app.utils.search.SEARCH_SQL
+SEARCH = """
+    SELECT id, ts_rank_cd(search_vector, query) AS rank
+    FROM messages, to_tsquery('simple', $1) AS query
+    WHERE search_vector @@ query
+    ORDER BY rank DESC, id DESC
+    LIMIT 21
+"""
+
+
+def connect(schema: str):
+    return asyncpg.connect(
+        host=os.getenv("PGHOST"), port=os.getenv("PGPORT"), user=os.getenv("PGUSER"),
+        password=os.getenv("PGPASS"), database=os.getenv("PGNAME"), server_settings={"search_path": schema},
+    )
+
+
+def make_rows(count: int, rng: random.Random) -> list[tuple]:
+    return [
+        (number % 500 + 1, "assistant", " ".join(rng.choices(WORDS, k=rng.randrange(20, 200))),
+         " ".join(rng.choices(WORDS, k=10)) if number % 4 == 0 else None)
+        for number in range(count)
+    ]
+
+
+async def add_before(conn):
+    for statement in BEFORE:
+        await conn.execute(statement)
+
+
+async def add_after(conn):
+    # Startup part
+    for statement in AFTER:
+        await conn.execute(statement)
+    # Background part, as run_background_migrations does it
+    last_id = await conn.fetchval("SELECT max(id) FROM messages")
+    for first_id in range(0, last_id, database.BACKFILL_BATCH_SIZE):
+        await conn.execute(
+            "UPDATE messages SET content = content WHERE id > $1 AND id <= $2 AND search_vector IS NULL",
+            first_id, first_id + database.BACKFILL_BATCH_SIZE
+        )
+    await conn.execute(f"CREATE INDEX CONCURRENTLY messages_search_vector_idx {database.BACKGROUND_INDEXES['messages_search_vector_idx']}")
+
+
+async def while_inserting(schema: str, operation) -> tuple[float, int, float]:
+    """Runs operation while another session inserts; returns (seconds, inserts meanwhile, longest insert)."""
+    writer = await connect(schema)
+    inserted = 0
+    longest = 0.0
+    done = asyncio.Event()
+
+    async def write():
+        nonlocal inserted, longest
+        while not done.is_set():
+            started = time.perf_counter()
+            await writer.execute("INSERT INTO messages (chat_id, role, content) VALUES (1, 'user', 'ping vector1')")
+            longest = max(longest, time.perf_counter() - started)
+            inserted += 1
+
+    task = asyncio.create_task(write())
+    started = time.perf_counter()
+    await operation()
+    elapsed = time.perf_counter() - started
+    done.set()
+    await task
+    await writer.close()
+    return elapsed, inserted, longest
+
+
+async def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--rows", type=int, default=100_000)
+    arguments.add_argument("--queries", type=int, default=200)
+    options = arguments.parse_args()
+    rng = random.Random(4)
+    rows = make_rows(options.rows, rng)
+    huge = " ".join(f"word{number}" for number in range(300_000))
+    print(f"{options.rows} messages, {sum(len(row[2]) for row in rows) / 1e6:.0f} MB of text\n")
+    print(f"{'':<7} {'add search s':>12} {'inserts meanwhile':>18} {'longest insert s':>17} "
+          f"{'inserts/s':>10} {'search p50 ms':>14} {'p95 ms':>7} {'huge answer':>26}")
+
+    for schema, add in (("bench_before", add_before), ("bench_after", add_after)):
+        conn = await connect(schema)
+        await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}")
+        try:
+            await conn.execute(
+                "CREATE TABLE messages (id SERIAL PRIMARY KEY, chat_id INT, role TEXT, content TEXT, code TEXT)"
+            )
+            await conn.copy_records_to_table("messages", records=rows, columns=("chat_id", "role", "content", "code"))
+            await conn.execute("VACUUM ANALYZE messages")
+
+            elapsed, inserted, longest = await while_inserting(schema, lambda: add(conn))
+            await conn.execute("VACUUM ANALYZE messages")
+
+            batch = make_rows(5000, rng)
+            started = time.perf_counter()
+            await conn.executemany("INSERT INTO messages (chat_id, role, content, code) VALUES ($1, $2, $3, $4)", batch)
+            inserts_per_second = len(batch) / (time.perf_counter() - started)
+
+            latencies = []
+            for number in range(options.queries):
+                query = build_search_query(QUERIES[number % len(QUERIES)])
+                started = time.perf_counter()
+                await conn.fetch(SEARCH, query)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+            try:
+                await conn.execute("INSERT INTO messages (chat_id, role, content) VALUES (1, 'assistant', $1)", huge)
+                huge_result = "stored"
+            except asyncpg.PostgresError as e:
+                huge_result = type(e).__name__
+
+            print(f"{schema.split('_')[1]:<7} {elapsed:>12.2f} {inserted:>18} {longest:>17.2f} {inserts_per_second:>10.0f} "
+                  f"{statistics.median(latencies):>14.2f} {statistics.quantiles(latencies, n=20)[-1]:>7.2f} {huge_result:>26}")
+        finally:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+Worker start cost of the LLM clients, before and after they were made lazy (model_selector).
+
+Each measurement runs in a fresh interpreter, so nothing is already imported:
+- lazy: importing model_selector, which is all a worker does until a request needs a
+  backend (after),
+- eager: importing it and creating the client of every backend in LLM_BACKENDS, which
+  is what importing it used to do (before),
+- app: importing app.main, the whole app a worker loads.
+Reported: median wall time and peak RSS over --runs interpreters.
+
+The Ollama warm-up (OLLAMA_WARMUP_MODELS) saves the model load on the first request;
+that needs a real Ollama server and model and is not measured here. Needs no database.
+
+    python -m benchmarks.bench_startup [--runs 5]
+"""
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Each prints "<seconds> <peak RSS in kB>"
+SCRIPTS = {
+    "lazy": """
+import time, resource
+started = time.perf_counter()
+import app.utils.assistant.model_selector
+elapsed = time.perf_counter() - started
+""",
+    "eager": """
+import time, resource, asyncio
+started = time.perf_counter()
+from app.utils.assistant.model_selector import llm_service
+
+async def create_all():
+    for backend in llm_service.backends:
+        llm_service._client(backend)
+    llm_service.stop_ollama_probes()
+
+asyncio.run(create_all())
+elapsed = time.perf_counter() - started
+""",
+    "app": """
+import time, resource
+started = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - started
+""",
+}
+REPORT = 'print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n'
+
+
+def measure(script: str) -> tuple[float, int]:
+    result = subprocess.run([sys.executable, "-c", script + REPORT], capture_output=True, text=True, check=True)
+    seconds, rss = result.stdout.strip().splitlines()[-1].split()
+    return float(seconds), int(rss)
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--runs", type=int, default=5)
+    options = arguments.parse_args()
+    print(f"{'':<7} {'import s p50':>13} {'min':>7} {'max':>7} {'peak RSS MB':>12}")
+    for name, script in SCRIPTS.items():
+        runs = [measure(script) for _ in range(options.runs)]
+        seconds = [elapsed for elapsed, _ in runs]
+        print(f"{name:<7} {statistics.median(seconds):>13.3f} {min(seconds):>7.3f} {max(seconds):>7.3f} "
+              f"{statistics.median(rss for _, rss in runs) / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
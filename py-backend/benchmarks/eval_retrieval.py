@@ -0,0 +1,169 @@
+"""
+Recall and latency of document retrieval (app.utils.assistant.retrieval) with the
+hashing embedder, and how long opening a user's index holds up the event loop.
+
+- recall: synthetic documents are chunked and indexed as uploads are; each question is
+  a few words drawn from one chunk, and recall@k is how often that chunk comes back in
+  the top k. The block-wise UserIndex.search is also checked against a full sort.
+- latency: UserIndex.search over indexes of a few sizes (random unit vectors).
+- event loop: the longest gap a 1 ms ticker sees while indexes are opened and
+  refreshed on the loop, as before, and through asyncio.to_thread, as search() does now.
+
+Needs no database or model; the index files go to a temporary directory.
+
+    python -m benchmarks.eval_retrieval [--documents 200] [--questions 500] [--rows 10000 100000]
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import numpy as np
+import orjson
+from app.utils.assistant.retrieval import HashingEmbedder, UserIndex, chunk_page
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list[str]:
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "po", "da", "fi"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(syllables, k=rng.randrange(2, 5))))
+    return sorted(words)
+
+
+def make_document(rng: random.Random, vocabulary: list[str], pages: int) -> list[str]:
+    # Word frequencies fall off like natural text, so chunks share their common words
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return [" ".join(rng.choices(vocabulary, weights, k=rng.randrange(250, 450))) for _ in range(pages)]
+
+
+async def build_corpus(directory: str, embedder: HashingEmbedder, rng: random.Random, documents: int):
+    vocabulary = make_vocabulary(rng, 20_000)
+    index = UserIndex(directory)
+    chunks = []
+    for number in range(documents):
+        texts = [
+            chunk.text for page_number, page in enumerate(make_document(rng, vocabulary, rng.randrange(1, 6)), 1)
+            for chunk in chunk_page(page_number, page)
+        ]
+        vectors = await embedder.embed(texts)
+        index.append(f"document-{number}", vectors)
+        chunks.extend(texts)
+    return index, chunks
+
+
+def evaluate_recall(index: UserIndex, embedder: HashingEmbedder, chunks: list[str], rng: random.Random,
+                    questions: int, words: int) -> dict:
+    matrix = np.asarray(index._matrix)
+    hits = {1: 0, 4: 0, 10: 0}
+    exact = 0
+    for _ in range(questions):
+        target = rng.randrange(len(chunks))
+        question = " ".join(rng.sample(chunks[target].split(), words))
+        query = embedder._vector(question)
+        query = query / (np.linalg.norm(query) or 1.0)
+        results = index.search(query, 10)
+        rows = [int(index.offsets[int(hash_.split("-")[1])] + row) for _, hash_, row in results]
+        for k in hits:
+            hits[k] += target in rows[:k]
+        # The block-wise top k against a sort of every score
+        expected = np.sort(matrix @ query)[::-1][:10]
+        exact += np.allclose([score for score, _, _ in results], expected, atol=1e-6)
+    return {k: count / questions for k, count in hits.items()} | {"exact": exact / questions}
+
+
+def search_latency(directory: str, rows: int, dim: int, searches: int) -> tuple[float, float]:
+    rng = np.random.default_rng(1)
+    index = UserIndex(directory)
+    for start in range(0, rows, 50_000):
+        block = rng.standard_normal((min(50_000, rows - start), dim), dtype=np.float32)
+        index.append(f"block-{start}", block / np.linalg.norm(block, axis=1, keepdims=True))
+    latencies = []
+    for _ in range(searches):
+        query = rng.standard_normal(dim, dtype=np.float32)
+        started = time.perf_counter()
+        index.search(query / np.linalg.norm(query), 4)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return statistics.median(latencies), statistics.quantiles(latencies, n=20)[-1]
+
+
+def write_large_index(directory: str, documents: int, dim: int):
+    """An index of many one-chunk documents, as UserIndex.append leaves it; the vector file is sparse."""
+    os.makedirs(directory, exist_ok=True)
+    segments = [(f"{number:064x}", 1) for number in range(documents)]
+    with open(os.path.join(directory, "segments.json"), "wb") as f:
+        f.write(orjson.dumps({"dim": dim, "segments": segments}))
+    with open(os.path.join(directory, "vectors.f32"), "wb") as f:
+        f.truncate(documents * dim * 4)
+
+
+async def longest_stall(operation) -> float:
+    """Runs operation while a ticker sleeps 1 ms at a time; returns the longest gap it saw, in ms."""
+    done = False
+    longest = 0.0
+
+    async def tick():
+        nonlocal longest
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            longest = max(longest, time.perf_counter() - started)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0.01)
+    await operation()
+    done = True
+    await ticker
+    return longest * 1000
+
+
+async def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arguments.add_argument("--documents", type=int, default=200)
+    arguments.add_argument("--questions", type=int, default=500)
+    arguments.add_argument("--words", type=int, default=4, help="words per question")
+    arguments.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    arguments.add_argument("--searches", type=int, default=50)
+    arguments.add_argument("--users", type=int, default=64, help="indexes opened for the event loop test")
+    arguments.add_argument("--segments", type=int, default=20_000, help="documents in each of those indexes")
+    options = arguments.parse_args()
+    rng = random.Random(7)
+    embedder = HashingEmbedder()
+
+    with tempfile.TemporaryDirectory() as root:
+        index, chunks = await build_corpus(os.path.join(root, "corpus"), embedder, rng, options.documents)
+        recall = evaluate_recall(index, embedder, chunks, rng, options.questions, options.words)
+        print(f"recall, {options.documents} documents, {len(chunks)} chunks, "
+              f"{options.questions} questions of {options.words} words")
+        print(f"  recall@1 {recall[1]:.3f}  recall@4 {recall[4]:.3f}  recall@10 {recall[10]:.3f}  "
+              f"top 10 equal to a full sort {recall['exact']:.3f}\n")
+
+        print(f"{'rows':>8} {'search p50 ms':>14} {'p95 ms':>7}")
+        for rows in options.rows:
+            p50, p95 = search_latency(os.path.join(root, f"latency-{rows}"), rows, embedder.dim, options.searches)
+            print(f"{rows:>8} {p50:>14.2f} {p95:>7.2f}")
+
+        directories = [os.path.join(root, "users", str(user)) for user in range(options.users)]
+        for directory in directories:
+            write_large_index(directory, options.segments, embedder.dim)
+
+        # One open per request: between them the loop runs whatever else is waiting
+        async def on_loop():
+            for directory in directories:
+                UserIndex(directory).refresh()
+                await asyncio.sleep(0)
+
+        async def in_thread():
+            for directory in directories:
+                index = await asyncio.to_thread(UserIndex, directory)
+                await asyncio.to_thread(index.refresh)
+
+        print(f"\nopening {options.users} indexes of {options.segments} documents each, longest event loop stall")
+        for name, operation in (("on the loop (before)", on_loop), ("asyncio.to_thread (after)", in_thread)):
+            print(f"  {name:<26} {await longest_stall(operation):>8.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+import os
+import asyncio
+import asyncpg
+import pytest
+
+# Tests that need PostgreSQL run against this database on the server the PG* variables
+# point at; it is created if missing and its tables are rebuilt for every such test
+TEST_DATABASE = os.getenv("TEST_PGNAME", "chatbot_test")
+
+# The tables the app's SCHEMA_MIGRATIONS build on
+BASE_SCHEMA = """
+DROP TABLE IF EXISTS chat_summaries, document_chunks, document_pages, document_contents,
+    messages, chats, users, documents CASCADE;
+CREATE TABLE users (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, email TEXT, imageurl TEXT);
+CREATE TABLE chats (id SERIAL PRIMARY KEY, title TEXT, created_at TIMESTAMPTZ DEFAULT now());
+CREATE TABLE messages (
+    id SERIAL PRIMARY KEY, chat_id INT REFERENCES chats(id) ON DELETE CASCADE, role TEXT, content TEXT,
+    code TEXT, created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE TABLE documents (id TEXT PRIMARY KEY, user_id TEXT, file_name TEXT, file_path TEXT, content TEXT);
+"""
+
+
+def _connect(database: str):
+    return asyncpg.connect(
+        host=os.getenv("PGHOST"), port=os.getenv("PGPORT"), user=os.getenv("PGUSER"),
+        password=os.getenv("PGPASS"), database=database,
+    )
+
+
+async def _prepare_database():
+    admin = await _connect(os.getenv("PGNAME"))
+    try:
+        if not await admin.fetchval("SELECT 1 FROM pg_database WHERE datname = $1", TEST_DATABASE):
+            await admin.execute(f'CREATE DATABASE "{TEST_DATABASE}"')
+    finally:
+        await admin.close()
+    conn = await _connect(TEST_DATABASE)
+    try:
+        await conn.execute(BASE_SCHEMA)
+    finally:
+        await conn.close()
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    """
+    Points the app at a freshly built test database. The test opens the pool itself
+    (init_db_pool) inside its own event loop. Skipped when no server is reachable.
+    """
+    if not os.getenv("PGHOST"):
+        pytest.skip("PostgreSQL is not configured (PGHOST)")
+    try:
+        asyncio.run(_prepare_database())
+    except (OSError, asyncpg.PostgresError) as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+    monkeypatch.setenv("PGNAME", TEST_DATABASE)
+    return TEST_DATABASE
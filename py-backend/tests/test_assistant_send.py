@@ -0,0 +1,138 @@
+import asyncio
+import orjson
+from app.main import app, lifespan
+from app.utils import database
+from app.utils.auth import create_access_token
+from app.utils.assistant import scheduler
+from app.utils.assistant.model_selector import llm_service
+from app.utils.assistant.scheduler import llm_scheduler
+
+
+class GatedOllama:
+    """An Ollama client whose answers send one chunk, then wait for release() before ending."""
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.started = 0
+
+    def release(self):
+        self.gate.set()
+
+    async def chat(self, model: str, messages: list, stream: bool = False, **kwargs):
+        async def answer():
+            self.started += 1
+            yield {"message": {"content": "Thinking"}}
+            await self.gate.wait()
+            yield {"message": {"content": " done."}}
+        return answer()
+
+
+async def post_stream(path: str, body: dict, token: str):
+    """
+    Sends a request straight to the ASGI app. Returns the running request and a queue of
+    the ASGI messages it sends, so a test can look at the server while the response streams.
+    """
+    payload = orjson.dumps(body)
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [
+            (b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode()),
+            (b"authorization", f"Bearer {token}".encode()),
+        ],
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+    sent: asyncio.Queue = asyncio.Queue()
+    delivered = False
+
+    async def receive():
+        nonlocal delivered
+        if not delivered:
+            delivered = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        # The client stays connected
+        await asyncio.Event().wait()
+
+    task = asyncio.create_task(app(scope, receive, sent.put))
+    return task, sent
+
+
+async def next_body(sent: asyncio.Queue) -> bytes:
+    while True:
+        message = await asyncio.wait_for(sent.get(), 10)
+        if message["type"] == "http.response.body" and message.get("body"):
+            return message["body"]
+
+
+def test_streaming_answers_give_their_connection_back(postgres, monkeypatch):
+    # Fewer connections than open streams: a stream holding one would starve the rest
+    monkeypatch.setattr(database, "DB_POOL_MIN_SIZE", 1)
+    monkeypatch.setattr(database, "DB_POOL_MAX_SIZE", 2)
+    monkeypatch.setattr(database, "DB_POOL_ACQUIRE_TIMEOUT", 2)
+    fake = GatedOllama()
+    monkeypatch.setattr(llm_service, "get_llm_client", lambda *args, **kwargs: fake)
+
+    async def scenario():
+        async with lifespan(app):
+            async with database.acquire_db() as db:
+                chat_id = await db.fetchval("INSERT INTO chats (title) VALUES ('pool') RETURNING id")
+            token = create_access_token({"sub": "1"})
+            streams = []
+            # Two answers generate (the local Ollama limit) and the third waits in the queue
+            for number in range(3):
+                task, sent = await post_stream("/api/assistant/send", {
+                    "chat_id": chat_id, "message": f"question {number}", "model": "ollama:test", "is_cloud": False,
+                }, token)
+                first = await next_body(sent)
+                streams.append((task, sent, first))
+
+            in_use_while_streaming = database.get_pool_stats()["in_use"]
+            # Other routes still get a connection at once
+            async with database.acquire_db() as db:
+                await db.fetchval("SELECT 1")
+
+            fake.release()
+            bodies = []
+            for task, sent, _ in streams:
+                await asyncio.wait_for(task, 10)
+                chunks = []
+                while not sent.empty():
+                    message = sent.get_nowait()
+                    chunks.append(message.get("body", b""))
+                bodies.append(b"".join(chunks))
+            return in_use_while_streaming, [first for _, _, first in streams], bodies
+
+    in_use, firsts, bodies = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert in_use == 0
+    assert b'"queued"' in firsts[2]
+    assert all(b"[DONE]" in body and b'"db_saved":true' in body for body in bodies)
+
+
+def test_full_model_queue_answers_429(postgres, monkeypatch):
+    # Two answers generate, one waits, and the next finds the queue full
+    monkeypatch.setattr(scheduler, "LLM_QUEUE_MAX_DEPTH", 1)
+    fake = GatedOllama()
+    monkeypatch.setattr(llm_service, "get_llm_client", lambda *args, **kwargs: fake)
+
+    async def scenario():
+        async with lifespan(app):
+            async with database.acquire_db() as db:
+                chat_id = await db.fetchval("INSERT INTO chats (title) VALUES ('busy') RETURNING id")
+            token = create_access_token({"sub": "1"})
+            streams = []
+            for number in range(4):
+                task, sent = await post_stream("/api/assistant/send", {
+                    "chat_id": chat_id, "message": f"question {number}", "model": "ollama:test", "is_cloud": False,
+                }, token)
+                start = await asyncio.wait_for(sent.get(), 10)
+                streams.append((task, sent, start))
+                if number < 3:
+                    await next_body(sent)
+            fake.release()
+            for task, _, _ in streams:
+                await asyncio.wait_for(task, 10)
+            return [start for _, _, start in streams], llm_scheduler.stats()
+
+    starts, stats = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert [start["status"] for start in starts] == [200, 200, 200, 429]
+    assert (b"retry-after", b"5") in starts[3]["headers"]
+    assert stats["rejected"] >= 1
@@ -0,0 +1,80 @@
+import asyncio
+from app.utils.assistant import cancellation
+from app.utils.assistant.cancellation import GenerationState, stop_on_disconnect
+
+
+class FakeRequest:
+    """A request whose client goes away once disconnect() is called."""
+    def __init__(self):
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+    async def is_disconnected(self) -> bool:
+        return self.disconnected
+
+
+class SlowUpstream:
+    """Yields the given chunks, then goes quiet until it is closed, like a model that stalls."""
+    def __init__(self, *chunks: str):
+        self.chunks = chunks
+        self.closed = False
+
+    async def stream(self):
+        try:
+            for chunk in self.chunks:
+                yield chunk
+            await asyncio.Event().wait()
+        finally:
+            self.closed = True
+
+
+def test_quiet_upstream_is_cancelled_when_the_client_disconnects(monkeypatch):
+    monkeypatch.setattr(cancellation, "DISCONNECT_POLL_INTERVAL_MS", 5)
+
+    async def scenario():
+        request = FakeRequest()
+        upstream = SlowUpstream("Hello", " there")
+        state = GenerationState("ollama:test")
+        received = []
+        async for chunk in stop_on_disconnect(request, upstream.stream(), state):
+            received.append(chunk)
+            if len(received) == 2:
+                # The client leaves while the model is still thinking about the next chunk
+                asyncio.get_running_loop().call_later(0.02, request.disconnect)
+        return received, state, upstream
+
+    received, state, upstream = asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert received == ["Hello", " there"]
+    assert state.disconnected
+    assert state.text == "Hello there"
+    assert upstream.closed
+
+
+def test_finished_upstream_passes_through():
+    async def scenario():
+        async def upstream():
+            for chunk in ("a", "b", "c"):
+                yield chunk
+
+        state = GenerationState("ollama:test")
+        received = [chunk async for chunk in stop_on_disconnect(FakeRequest(), upstream(), state)]
+        return received, state
+
+    received, state = asyncio.run(scenario())
+    assert received == ["a", "b", "c"]
+    assert not state.disconnected
+    assert state.chunks == 3
+
+
+def test_closing_the_response_closes_the_upstream():
+    async def scenario():
+        upstream = SlowUpstream("a")
+        chunks = stop_on_disconnect(FakeRequest(), upstream.stream(), GenerationState("ollama:test"))
+        assert await anext(chunks) == "a"
+        # What the server does when it notices the disconnect on its own
+        await chunks.aclose()
+        return upstream
+
+    assert asyncio.run(scenario()).closed
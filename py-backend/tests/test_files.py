@@ -0,0 +1,33 @@
+import asyncio
+import httpx
+from app.main import app, lifespan
+from app.routes import files
+from app.utils.auth import create_access_token
+from app.utils.assistant import retrieval
+
+
+def test_upload_response_does_not_say_whether_anyone_stored_the_file_before(postgres, monkeypatch):
+    monkeypatch.setattr(retrieval, "RETRIEVAL_ENABLED", False)
+    monkeypatch.setattr(files, "_stats", {"uploads": 0, "deduplicated": 0, "extracted": 0})
+    document = ("notes.txt", b"Quarterly numbers\n" * 100, "text/plain")
+
+    async def scenario():
+        async with lifespan(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                responses = []
+                for user in ("1", "2"):
+                    response = await client.post(
+                        "/api/assistant/upload-document", files={"file": document},
+                        headers={"Authorization": f"Bearer {create_access_token({'sub': user})}"},
+                    )
+                    responses.append(response)
+                return responses
+
+    first, second = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert first.status_code == second.status_code == 200
+    first, second = first.json(), second.json()
+    assert first.keys() == second.keys() == {"document_id", "file_name", "pages", "characters"}
+    assert (first["pages"], first["characters"]) == (second["pages"], second["characters"])
+    # The second upload reused the stored content, which only the server-wide stats show
+    assert files.get_upload_stats() == {"uploads": 2, "deduplicated": 1, "extracted": 1}
@@ -0,0 +1,192 @@
+import time
+import socket
+import asyncio
+import threading
+from types import SimpleNamespace
+import orjson
+import pytest
+import uvicorn
+from google.genai import errors
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from app.utils.assistant import model_selector, stream_utils
+from app.utils.assistant.model_selector import LLMService
+from app.utils.assistant.stream_utils import stream_text
+
+
+class FakeGeminiClient:
+    """
+    Stands in for genai.Client: only client.aio.models.generate_content_stream is used.
+    Each call takes the next outcome: an exception to raise, or the chunk texts to stream.
+    """
+    def __init__(self, *outcomes, chunk_delay: float = 0.0):
+        self.outcomes = list(outcomes)
+        self.chunk_delay = chunk_delay
+        self.requests = []
+        self.streams_closed = 0
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content_stream=self.generate_content_stream))
+
+    async def generate_content_stream(self, model: str, contents, config=None):
+        self.requests.append(SimpleNamespace(model=model, contents=contents, config=config))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return self._stream(outcome)
+
+    async def _stream(self, texts):
+        try:
+            for text in texts:
+                await asyncio.sleep(self.chunk_delay)
+                yield SimpleNamespace(text=text, usage_metadata=None)
+        finally:
+            self.streams_closed += 1
+
+
+@pytest.fixture
+def gemini_server():
+    """
+    A local stand-in for the Gemini API, serving streamGenerateContent as server-sent events
+    on its own thread and event loop. Yields its base URL. Every answer is four chunks, sent
+    SLOW_CHUNK_SECONDS apart.
+    """
+    async def generate(request):
+        async def events():
+            for number in range(4):
+                await asyncio.sleep(SLOW_CHUNK_SECONDS)
+                chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": f"part{number} "}]}}]}
+                yield b"data: " + orjson.dumps(chunk) + b"\r\n\r\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    app = Starlette(routes=[Route("/v1beta/models/{rest:path}", generate, methods=["POST"])])
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off", ws="none"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+    server.should_exit = True
+    thread.join(5)
+    sock.close()
+
+
+SLOW_CHUNK_SECONDS = 0.3
+
+
+def unavailable() -> errors.APIError:
+    return errors.ServerError(503, {"error": {"message": "overloaded", "status": "UNAVAILABLE"}})
+
+
+async def answer(client, summary=None) -> str:
+    return "".join([chunk async for chunk in stream_text(client, "gemini:gemini-2.5-flash", [], "hi", summary)])
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(stream_utils, "GEMINI_RETRY_BASE_DELAY_SECONDS", 0.001)
+
+
+def test_answer_streams_through_the_async_client():
+    client = FakeGeminiClient(["Hello", "", " world"])
+
+    assert asyncio.run(answer(client, summary="Earlier they talked about cats.")) == "Hello world"
+    request = client.requests[0]
+    assert request.model == "gemini-2.5-flash"
+    assert request.contents[-1].parts[0].text == "hi"
+    assert "cats" in request.config.system_instruction
+    assert client.streams_closed == 1
+
+
+def test_transient_error_before_the_first_chunk_is_retried():
+    client = FakeGeminiClient(unavailable(), ["recovered"])
+
+    assert asyncio.run(answer(client)) == "recovered"
+    assert len(client.requests) == 2
+
+
+def test_retries_give_up_after_the_limit(monkeypatch):
+    monkeypatch.setattr(stream_utils, "GEMINI_MAX_RETRIES", 1)
+    client = FakeGeminiClient(unavailable(), unavailable(), ["never"])
+
+    with pytest.raises(errors.ServerError):
+        asyncio.run(answer(client))
+    assert len(client.requests) == 2
+
+
+def test_request_errors_are_not_retried():
+    client = FakeGeminiClient(errors.ClientError(400, {"error": {"message": "bad", "status": "INVALID_ARGUMENT"}}))
+
+    with pytest.raises(errors.ClientError):
+        asyncio.run(answer(client))
+    assert len(client.requests) == 1
+
+
+def test_slow_first_chunk_times_out(monkeypatch):
+    monkeypatch.setattr(stream_utils, "GEMINI_FIRST_CHUNK_TIMEOUT_SECONDS", 0.05)
+    # A slow model is not retried: another attempt would be just as slow
+    client = FakeGeminiClient(["late"], ["late"], chunk_delay=1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(answer(client))
+    assert len(client.requests) == 1
+    assert client.streams_closed == 1
+
+
+def test_stream_is_closed_when_the_reader_stops_early():
+    async def scenario(client):
+        chunks = stream_text(client, "gemini:gemini-2.5-flash", [], "hi")
+        assert await anext(chunks) == "one"
+        await chunks.aclose()
+
+    client = FakeGeminiClient(["one", "two", "three"])
+    asyncio.run(scenario(client))
+    assert client.streams_closed == 1
+
+
+def test_slow_gemini_stream_does_not_hold_up_ollama_chunks(gemini_server, monkeypatch):
+    monkeypatch.setattr(model_selector, "GEMINI_API_KEY", "test-key")
+    monkeypatch.setattr(model_selector, "GEMINI_BASE_URL", gemini_server)
+    # The real SDK client, talking HTTP to the local server
+    gemini = LLMService(["gemini"])._client("gemini")
+
+    class TickingOllama:
+        """An Ollama client whose answer sends a chunk every 10 ms."""
+        async def chat(self, model: str, messages: list, stream: bool = False, **kwargs):
+            async def answer():
+                for number in range(150):
+                    await asyncio.sleep(0.01)
+                    yield {"message": {"content": f"{number} "}}
+            return answer()
+
+    async def ollama_gaps(gemini_done: asyncio.Event) -> list[float]:
+        gaps = []
+        last = time.perf_counter()
+        async for _ in stream_text(TickingOllama(), "ollama:test", [], "hi"):
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+            if gemini_done.is_set():
+                break
+        return gaps
+
+    async def scenario():
+        gemini_done = asyncio.Event()
+
+        async def gemini_answer():
+            try:
+                return "".join([chunk async for chunk in stream_text(gemini, "gemini:gemini-slow", [], "hi")])
+            finally:
+                gemini_done.set()
+
+        started = time.perf_counter()
+        text, gaps = await asyncio.gather(gemini_answer(), ollama_gaps(gemini_done))
+        return text, gaps, time.perf_counter() - started
+
+    text, gaps, elapsed = asyncio.run(asyncio.wait_for(scenario(), 20))
+    assert text == "part0 part1 part2 part3 "
+    assert elapsed >= 4 * SLOW_CHUNK_SECONDS
+    # Ollama kept streaming the whole time Gemini was waiting on the network
+    assert len(gaps) > 50
+    assert max(gaps) < SLOW_CHUNK_SECONDS / 2
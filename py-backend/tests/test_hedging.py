@@ -0,0 +1,58 @@
+import asyncio
+from app.utils.assistant import hedging
+from app.utils.assistant.hedging import AnsweredBy, ModelChoice, fallback_for, hedged_stream
+from app.utils.assistant.scheduler import LLMScheduler, holding_slot
+
+
+def test_fallback_runs_where_the_requested_ollama_model_runs(monkeypatch):
+    monkeypatch.setattr(hedging, "MODEL_FALLBACKS", {
+        "ollama:big": "ollama:small",
+        "gemini:gemini-2.5-pro": "ollama:small",
+        "ollama:small": "gemini:gemini-2.5-flash",
+    })
+    monkeypatch.setattr(hedging.llm_service, "backends", ["ollama_local", "ollama_cloud", "gemini"])
+    assert fallback_for("ollama:big", True) == ModelChoice("ollama:small", True)
+    assert fallback_for("ollama:big", False) == ModelChoice("ollama:small", False)
+    assert fallback_for("gemini:gemini-2.5-pro", True) == ModelChoice("ollama:small", False)
+    assert fallback_for("ollama:small", False) == ModelChoice("gemini:gemini-2.5-flash", True)
+    assert fallback_for("ollama:unknown", False) is None
+
+    # Without a local Ollama the fallback moves to the cloud one, without Gemini there is none
+    monkeypatch.setattr(hedging.llm_service, "backends", ["ollama_cloud"])
+    assert fallback_for("ollama:big", False) == ModelChoice("ollama:small", True)
+    assert fallback_for("ollama:small", False) is None
+
+
+def test_primary_slot_is_released_once_the_fallback_wins():
+    async def scenario():
+        scheduler = LLMScheduler()
+        primary_closed = []
+
+        async def silent_primary():
+            try:
+                await asyncio.Event().wait()
+                yield "never"
+            finally:
+                primary_closed.append(True)
+
+        async def fallback_text():
+            yield "from the fallback"
+            await asyncio.sleep(0.05)
+            yield " still streaming"
+
+        ticket = scheduler.reserve("ollama_local", "ollama:slow", "user")
+        chunks = hedged_stream(
+            lambda: holding_slot(ticket, silent_primary()),
+            ModelChoice("gemini:gemini-2.5-flash", True), fallback_text, 0.01,
+        )
+        assert await anext(chunks) == AnsweredBy("gemini:gemini-2.5-flash")
+        assert await anext(chunks) == "from the fallback"
+        # The answer is still streaming from the fallback, but the primary no longer holds a slot
+        held_while_fallback_streams = scheduler.stats()["backends"].get("ollama_local", 0)
+        rest = [chunk async for chunk in chunks]
+        return held_while_fallback_streams, primary_closed, rest
+
+    held, primary_closed, rest = asyncio.run(scenario())
+    assert held == 0
+    assert primary_closed == [True]
+    assert rest == [" still streaming"]
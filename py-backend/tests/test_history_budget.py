@@ -0,0 +1,58 @@
+from app.utils.assistant.history_cache import CachedMessage, ChatHistoryCache, take_within_budget
+from app.utils.assistant.tokens import MESSAGE_FRAMING_TOKENS, TRUNCATION_MARKER, count_tokens, truncate_to_tokens
+
+
+def message(id: int, content: str) -> CachedMessage:
+    return CachedMessage(id, "user", content, count_tokens(content))
+
+
+def test_truncated_text_fits_the_token_count():
+    text = "word " * 1000
+    for max_tokens in (2, 10, 100, 999):
+        cut = truncate_to_tokens(text, max_tokens)
+        assert count_tokens(cut) <= max_tokens
+        assert cut.endswith(TRUNCATION_MARKER)
+    assert truncate_to_tokens("short", 100) == "short"
+
+
+def test_long_message_is_cut_instead_of_ending_the_history():
+    messages = [message(1, "old " * 10), message(2, "long " * 4000), message(3, "new " * 10)]
+    selected, exhausted = take_within_budget(messages, 500)
+
+    assert exhausted
+    assert [m.id for m in selected] == [2, 3]
+    assert selected[0].content.endswith(TRUNCATION_MARKER)
+    assert sum(m.token_count for m in selected) <= 500
+
+
+def test_newest_message_alone_over_the_budget_is_still_sent():
+    selected, _ = take_within_budget([message(1, "older"), message(2, "x" * 40000)], 1000)
+    assert [m.id for m in selected] == [2]
+    assert 900 < selected[0].token_count <= 1000
+
+
+def test_too_little_left_for_a_useful_part_drops_the_message():
+    messages = [message(1, "long " * 4000), message(2, "x" * 3990)]
+    selected, exhausted = take_within_budget(messages, 1010)
+    assert exhausted
+    assert [m.id for m in selected] == [2]
+
+
+def test_cache_cuts_the_same_way_and_keeps_the_whole_message():
+    cache = ChatHistoryCache()
+    messages = [message(1, "long " * 4000), message(2, "new")]
+    cache.fill(7, messages, complete=True)
+
+    selected = cache.get(7, 300)
+    assert [m.id for m in selected] == [1, 2]
+    assert selected[0].token_count <= 300 - messages[1].token_count
+    # A larger budget later still sees the full text
+    assert cache.get(7, 100000)[0] == messages[0]
+
+
+def test_each_message_is_charged_its_framing():
+    messages = [message(id, "short question") for id in range(1, 101)]
+    selected, exhausted = take_within_budget(messages, 200)
+    assert exhausted
+    assert sum(m.token_count + MESSAGE_FRAMING_TOKENS for m in selected) <= 200
+    assert len(selected) == 200 // (messages[0].token_count + MESSAGE_FRAMING_TOKENS)
@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timezone
+from decimal import Decimal
+import orjson
+from app.utils import database
+from app.utils.json_stream import encode_object_stream, iter_rows
+
+
+async def collect(stream) -> list[bytes]:
+    return [part async for part in stream]
+
+
+async def aiter(items):
+    for item in items:
+        yield item
+
+
+def test_streamed_object_is_the_same_json_as_encoding_it_whole():
+    rows = [
+        {"id": 1, "title": "first", "created_at": datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)},
+        {"id": 2, "title": 'quotes " and \\ backslashes', "score": Decimal("0.25")},
+    ]
+    seen = []
+
+    async def tracked():
+        async for row in aiter(rows):
+            seen.append(row["id"])
+            yield row
+
+    parts = asyncio.run(collect(encode_object_stream("chats", tracked(), lambda: {"next_cursor": len(seen)})))
+    # Each row is encoded on its own, right after the opening
+    assert [orjson.loads(part.lstrip(b","))["id"] for part in parts[1:3]] == [1, 2]
+    assert parts[0] == b'{"chats":[' and parts[3] == b"]"
+    assert orjson.loads(b"".join(parts)) == {
+        "chats": [
+            {"id": 1, "title": "first", "created_at": "2026-01-02T03:04:05+00:00"},
+            {"id": 2, "title": 'quotes " and \\ backslashes', "score": 0.25},
+        ],
+        # The trailer is built after the last row went out
+        "next_cursor": 2,
+    }
+
+
+def test_empty_list_is_valid_json():
+    parts = asyncio.run(collect(encode_object_stream("messages", aiter([]), lambda: {"next_cursor": None})))
+    assert orjson.loads(b"".join(parts)) == {"messages": [], "next_cursor": None}
+
+
+def test_rows_come_from_a_cursor_while_they_are_sent(postgres):
+    async def scenario():
+        await database.init_db_pool()
+        try:
+            async with database.acquire_db() as db:
+                await db.execute("INSERT INTO chats (title) SELECT 'chat ' || n FROM generate_series(1, 1000) n")
+                titles = []
+                open_cursors = []
+                async for row in iter_rows(db, "SELECT title FROM chats ORDER BY id", prefetch=50):
+                    titles.append(row["title"])
+                    if len(titles) % 100 == 0:
+                        # The cursor is still open on the server while rows are handed out
+                        open_cursors.append(await db.fetchval("SELECT statement FROM pg_cursors WHERE name <> ''"))
+                return titles, open_cursors, db.is_in_transaction()
+        finally:
+            await database.close_db_pool()
+
+    titles, open_cursors, in_transaction_after = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert titles == [f"chat {n}" for n in range(1, 1001)]
+    assert open_cursors == ["SELECT title FROM chats ORDER BY id"] * 10
+    # The transaction the cursor needed ends with the rows
+    assert not in_transaction_after
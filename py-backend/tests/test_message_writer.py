@@ -0,0 +1,101 @@
+import asyncio
+import asyncpg
+import pytest
+from app.utils import database
+from app.utils.message_writer import MessageWriter
+
+MISSING_CHAT_ID = 999999
+
+
+async def settle(futures: list[asyncio.Future]) -> list:
+    """The id or the error each future ends with."""
+    return await asyncio.gather(*futures, return_exceptions=True)
+
+
+def test_batch_writes_every_message_in_order(postgres):
+    async def scenario():
+        await database.init_db_pool()
+        try:
+            async with database.acquire_db() as db:
+                chat_ids = [await db.fetchval("INSERT INTO chats (title) VALUES ('batch') RETURNING id") for _ in range(2)]
+            writer = MessageWriter()
+            writer.start()
+            # Submitted before the writer runs, so they go out as one batch
+            futures = [writer.submit(chat_ids[number % 2], "user", f"message {number}", token_count=number)
+                       for number in range(6)]
+            ids = await settle(futures)
+            await writer.close()
+            async with database.acquire_db() as db:
+                rows = await db.fetch("SELECT id, chat_id, content, token_count FROM messages ORDER BY id")
+            return chat_ids, ids, rows, writer.stats()
+        finally:
+            await database.close_db_pool()
+
+    chat_ids, ids, rows, stats = asyncio.run(asyncio.wait_for(scenario(), 30))
+    # Ids follow the order the messages were submitted in
+    assert ids == sorted(ids)
+    assert [(row["id"], row["chat_id"], row["content"], row["token_count"]) for row in rows] == [
+        (ids[number], chat_ids[number % 2], f"message {number}", number) for number in range(6)
+    ]
+    assert stats["batches"] == 1 and stats["largest_batch"] == 6
+    assert stats["rows_written"] == 6 and stats["rows_failed"] == 0
+
+
+def test_failed_row_fails_only_its_own_message(postgres):
+    async def scenario():
+        await database.init_db_pool()
+        try:
+            async with database.acquire_db() as db:
+                chat_id = await db.fetchval("INSERT INTO chats (title) VALUES ('retry') RETURNING id")
+            writer = MessageWriter()
+            writer.start()
+            futures = [
+                writer.submit(chat_id, "user", "before"),
+                # The chat is gone (deleted while the answer streamed), so the batch insert fails
+                writer.submit(MISSING_CHAT_ID, "assistant", "orphan"),
+                writer.submit(chat_id, "assistant", "after"),
+            ]
+            results = await settle(futures)
+            await writer.close()
+            async with database.acquire_db() as db:
+                contents = await db.fetch("SELECT content FROM messages ORDER BY id")
+            return results, [row["content"] for row in contents], writer.stats()
+        finally:
+            await database.close_db_pool()
+
+    (before, orphan, after), contents, stats = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert isinstance(orphan, asyncpg.ForeignKeyViolationError)
+    # The other messages of the batch were written on the row-by-row retry
+    assert isinstance(before, int) and isinstance(after, int) and before < after
+    assert contents == ["before", "after"]
+    assert stats["rows_written"] == 2 and stats["rows_failed"] == 1
+
+
+def test_every_message_fails_without_a_connection(monkeypatch):
+    monkeypatch.setattr(database, "_pool", None)
+
+    async def scenario():
+        writer = MessageWriter()
+        writer.start()
+        futures = [writer.submit(1, "user", f"message {number}") for number in range(3)]
+        results = await settle(futures)
+        await writer.close()
+        return results, writer.stats()
+
+    results, stats = asyncio.run(asyncio.wait_for(scenario(), 10))
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert stats["rows_written"] == 0 and stats["rows_failed"] == 3
+
+
+def test_submit_needs_a_running_writer():
+    async def scenario():
+        writer = MessageWriter()
+        with pytest.raises(RuntimeError):
+            writer.submit(1, "user", "too early")
+        writer.start()
+        await writer.close()
+        with pytest.raises(RuntimeError):
+            writer.submit(1, "user", "too late")
+
+    asyncio.run(asyncio.wait_for(scenario(), 10))
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import httpx
+from app.main import app, lifespan
+from app.utils import database, metrics
+from app.utils.assistant.stream_utils import stream_text
+from app.utils.metrics import CONTENT_TYPE, Counter, Histogram, Registry, _BoundedLabel
+
+
+def sample(text: str, line_start: str) -> float:
+    """The value of the first sample in text whose line starts with line_start."""
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"no sample {line_start!r} in:\n{text}")
+
+
+def test_counts_from_every_thread_add_up(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", Registry())
+    requests = Counter("requests_total", "Requests.", ("path",))
+    series = requests.labels("/api")
+
+    def count():
+        for _ in range(1000):
+            series.inc()
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    series.inc(0.5)
+
+    assert metrics.registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{path="/api"} 4000.5',
+    ]
+
+
+def test_histogram_buckets_are_cumulative(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", Registry())
+    latency = Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 3):
+        latency.labels('say "hi"\n').observe(seconds)
+
+    assert metrics.registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{route="say \\"hi\\"\\n",le="0.1"} 2',
+        'latency_seconds_bucket{route="say \\"hi\\"\\n",le="1"} 3',
+        'latency_seconds_bucket{route="say \\"hi\\"\\n",le="+Inf"} 4',
+        'latency_seconds_sum{route="say \\"hi\\"\\n"} 3.65',
+        'latency_seconds_count{route="say \\"hi\\"\\n"} 4',
+    ]
+
+
+def test_labels_past_the_limit_are_other():
+    label = _BoundedLabel(2, lambda query: " ".join(query.split()))
+
+    assert label("SELECT  1\n") == "SELECT 1"
+    assert label("SELECT 2") == "SELECT 2"
+    assert label("SELECT 3") == metrics.OTHER
+    # Values admitted earlier keep their own label
+    assert label("SELECT  1\n") == "SELECT 1"
+
+
+class ScriptedOllama:
+    """An Ollama client that streams the given chunks, each a token, and then reports the count."""
+    def __init__(self, chunks: list[str]):
+        self.chunks = chunks
+
+    async def chat(self, model: str, messages: list, stream: bool = False, **kwargs):
+        async def answer():
+            for text in self.chunks:
+                await asyncio.sleep(0.01)
+                yield {"message": {"content": text}}
+            yield {"message": {"content": ""}, "done": True, "eval_count": len(self.chunks)}
+        return answer()
+
+
+def test_streams_are_timed_per_model_and_outcome():
+    client = ScriptedOllama(["one ", "two ", "three ", "four"])
+
+    async def scenario():
+        completed = [chunk async for chunk in stream_text(client, "ollama:metrics-test", [], "count")]
+        # A reader that stops after the first chunk cancels the stream
+        stream = stream_text(client, "ollama:metrics-test", [], "count")
+        await stream.__anext__()
+        await stream.aclose()
+        return completed
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 10)) == ["one ", "two ", "three ", "four"]
+    text = metrics.render()
+    model = 'model="ollama:metrics-test"'
+    assert sample(text, f'llm_streams_total{{{model},outcome="completed"}}') == 1
+    assert sample(text, f'llm_streams_total{{{model},outcome="cancelled"}}') == 1
+    assert sample(text, f"llm_stream_first_chunk_seconds_count{{{model}}}") == 2
+    # The completed stream reported its tokens; the cancelled one counts its single chunk
+    assert sample(text, f"llm_stream_output_tokens_total{{{model}}}") == 4 + 1
+    assert sample(text, f"llm_stream_output_characters_total{{{model}}}") == len("one two three four") + len("one ")
+    # Three tokens after the first in about 30 ms
+    tokens_per_second = sample(text, f"llm_stream_tokens_per_second_sum{{{model}}}")
+    assert 10 < tokens_per_second < 300
+    assert sample(text, f"llm_stream_tokens_per_second_count{{{model}}}") == 1
+
+
+def test_metrics_endpoint_reports_statements_and_the_pool(postgres):
+    statement = "SELECT count(*) FROM chats WHERE title = $1"
+
+    async def scenario():
+        async with lifespan(app):
+            async with database.acquire_db() as db:
+                for _ in range(3):
+                    await db.fetchval(statement, "metrics")
+            # asyncpg hands statements to the query logger with call_soon
+            await asyncio.sleep(0)
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return await client.get("/metrics")
+
+    response = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert response.status_code == 200
+    assert response.headers["content-type"] == CONTENT_TYPE
+    text = response.text
+    assert sample(text, f'db_query_duration_seconds_count{{statement="{statement}"}}') >= 3
+    assert sample(text, "db_pool_acquire_wait_seconds_count") >= 1
+    assert sample(text, "db_pool_max_connections") == database.DB_POOL_MAX_SIZE
+    assert "# TYPE sse_streams_in_flight gauge" in text
@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+from ollama import ResponseError
+from app.utils.assistant.ollama_pool import OllamaHostPool
+
+
+class FakeClient:
+    """Stands in for one host's Ollama client: answers with chunks, or fails after `fail_after` of them."""
+    def __init__(self, chunks=("Hello", " world"), error: Exception = None, fail_after: int = 0):
+        self.chunks = chunks
+        self.error = error
+        self.fail_after = fail_after
+        self.calls = 0
+
+    async def chat(self, model: str, messages: list, stream: bool = False, **kwargs):
+        self.calls += 1
+        if self.error is not None and self.fail_after == 0:
+            raise self.error
+        return self._stream()
+
+    async def _stream(self):
+        for index, chunk in enumerate(self.chunks):
+            if self.error is not None and index == self.fail_after:
+                raise self.error
+            yield {"message": {"content": chunk}}
+
+    async def embed(self, model: str, input, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return {"embeddings": [[1.0, 0.0]]}
+
+
+def make_pool(*clients: FakeClient) -> OllamaHostPool:
+    pool = OllamaHostPool([f"http://host{index}:11434" for index in range(len(clients))])
+    for host, client in zip(pool.hosts, clients):
+        host.client = client
+    return pool
+
+
+async def answer(pool: OllamaHostPool) -> str:
+    stream = await pool.chat(model="llama3", messages=[], stream=True)
+    return "".join([chunk["message"]["content"] async for chunk in stream])
+
+
+def test_host_that_fails_before_its_first_chunk_hands_over_to_the_next():
+    broken, working = FakeClient(error=ConnectionError("refused")), FakeClient()
+    pool = make_pool(broken, working)
+
+    assert asyncio.run(answer(pool)) == "Hello world"
+    assert (broken.calls, working.calls) == (1, 1)
+    assert pool.failovers == 1
+    assert not pool.hosts[0].healthy
+    assert all(host.outstanding == 0 for host in pool.hosts)
+    # The next request goes to the healthy host first
+    assert pool.candidates("llama3")[0] is pool.hosts[1]
+
+
+def test_failure_mid_stream_is_not_retried_elsewhere():
+    # Text already reached the client, so another host would repeat it
+    failing = FakeClient(error=ConnectionError("reset"), fail_after=1)
+    spare = FakeClient()
+    pool = make_pool(failing, spare)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(answer(pool))
+    assert spare.calls == 0
+    assert pool.failovers == 0
+
+
+def test_missing_model_moves_on_without_marking_the_host_unhealthy():
+    pool = make_pool(FakeClient(error=ResponseError("model not found", 404)), FakeClient())
+    pool.hosts[0].installed = {"llama3:latest"}
+
+    assert asyncio.run(answer(pool)) == "Hello world"
+    assert pool.hosts[0].healthy
+    assert pool.hosts[0].installed == set()
+
+
+def test_request_errors_are_not_retried():
+    spare = FakeClient()
+    pool = make_pool(FakeClient(error=ResponseError("invalid options", 400)), spare)
+
+    with pytest.raises(ResponseError):
+        asyncio.run(answer(pool))
+    assert spare.calls == 0
+
+
+def test_non_streaming_calls_fail_over_too():
+    pool = make_pool(FakeClient(error=ResponseError("overloaded", 503)), FakeClient())
+
+    response = asyncio.run(pool.embed(model="nomic-embed-text", input=["text"]))
+    assert response["embeddings"] == [[1.0, 0.0]]
+    assert pool.failovers == 1
+
+
+def test_every_host_failing_raises_the_last_error():
+    pool = make_pool(FakeClient(error=ConnectionError("first")), FakeClient(error=ConnectionError("second")))
+
+    with pytest.raises(ConnectionError, match="second"):
+        asyncio.run(answer(pool))
@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timezone
+import httpx
+import pytest
+from fastapi import HTTPException
+from app.main import app, lifespan
+from app.utils import database
+from app.utils.auth import create_access_token
+from app.utils.pagination import decode_cursor, encode_cursor
+
+# Several rows share a timestamp, so pages must break ties on id
+SAME_TIME = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 3, 4, 5, 6, 7, 891011, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+def test_malformed_cursor_is_a_bad_request():
+    for cursor in ("not a cursor", encode_cursor(SAME_TIME, 1)[:-4], "bm8gc2VwYXJhdG9y"):
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor)
+        assert error.value.status_code == 400
+
+
+async def walk(client: httpx.AsyncClient, path: str, key: str, **params) -> tuple[list[list[int]], list[dict]]:
+    """Follows next_cursor from the first page to the last; returns the ids of every page and the bodies."""
+    pages, bodies = [], []
+    cursor = None
+    while True:
+        response = await client.get(path, params={**params, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        body = response.json()
+        pages.append([row["id"] for row in body[key]])
+        bodies.append(body)
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return pages, bodies
+
+
+def run_with_client(setup, requests):
+    """Runs setup(db) inside the app's lifespan, then requests(client, what setup returned)."""
+    async def run():
+        async with lifespan(app):
+            async with database.acquire_db() as db:
+                prepared = await setup(db)
+            transport = httpx.ASGITransport(app=app)
+            headers = {"Authorization": f"Bearer {create_access_token({'sub': '1'})}"}
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver", headers=headers) as client:
+                return prepared, await requests(client, prepared)
+
+    return asyncio.run(asyncio.wait_for(run(), 30))
+
+
+def test_chat_pages_cover_every_chat_once_newest_first(postgres):
+    async def setup(db):
+        ids = []
+        for number in range(8):
+            created_at = SAME_TIME if number < 5 else datetime(2026, 1, 1 + number, tzinfo=timezone.utc)
+            title = f"{'report' if number % 2 else 'notes'} {number}"
+            ids.append(await db.fetchval(
+                "INSERT INTO chats (title, created_at) VALUES ($1, $2) RETURNING id", title, created_at
+            ))
+        return ids
+
+    async def requests(client, ids):
+        everything = await walk(client, "/api/chat/", "chats", limit=3)
+        reports = await walk(client, "/api/chat/", "chats", limit=2, q="report")
+        return everything, reports
+
+    ids, ((pages, _), (report_pages, _)) = run_with_client(setup, requests)
+    # Newest first: the three later chats by date, then the tied ones by id, highest first
+    assert [len(page) for page in pages] == [3, 3, 2]
+    assert sum(pages, []) == ids[5:][::-1] + ids[:5][::-1]
+    assert sum(report_pages, []) == [ids[7], ids[5], ids[3], ids[1]]
+
+
+def test_message_pages_walk_back_and_forth(postgres):
+    async def setup(db):
+        chat_id = await db.fetchval("INSERT INTO chats (title) VALUES ('history') RETURNING id")
+        ids = []
+        for number in range(10):
+            created_at = SAME_TIME if number < 6 else datetime(2026, 1, 1, 0, number, tzinfo=timezone.utc)
+            ids.append(await db.fetchval(
+                "INSERT INTO messages (chat_id, role, content, created_at) VALUES ($1, 'user', $2, $3) RETURNING id",
+                chat_id, f"message {number}", created_at,
+            ))
+        return chat_id, ids
+
+    async def requests(client, prepared):
+        chat_id, ids = prepared
+        path = f"/api/message/messages/{chat_id}"
+        older, bodies = await walk(client, path, "messages", limit=4)
+        # From the second oldest message, walk forward again
+        newer = await client.get(path, params={
+            "limit": 4, "direction": "newer", "cursor": encode_cursor(SAME_TIME, ids[1]),
+        })
+        invalid = await client.get(path, params={"cursor": "garbage"})
+        return older, bodies, newer, invalid
+
+    (_, ids), (older, bodies, newer, invalid) = run_with_client(setup, requests)
+    # Without a cursor the most recent messages come first; every page reads oldest to newest
+    assert older == [ids[6:10], ids[2:6], ids[0:2]]
+    assert all(body["direction"] == "older" for body in bodies)
+    assert [row["id"] for row in newer.json()["messages"]] == ids[2:6]
+    assert newer.json()["next_cursor"] is not None
+    assert invalid.status_code == 400
@@ -0,0 +1,73 @@
+import asyncio
+from app.utils import database
+from app.utils.json_stream import dumps
+from app.utils.assistant.parser import StreamingMarkdownParser, parse_markdown, render_markdown
+from app.utils.assistant.chat_utils import get_chat_history, build_context_prompt
+from app.utils.assistant.history_cache import history_cache
+from app.utils.assistant.stream_utils import _to_ollama_messages
+
+ANSWER = """Intro text.
+
+```python
+print(1)
+```
+Middle part
+```js
+x()
+
+y()
+```
+```
+plain
+```
+End."""
+
+
+def test_blocks_are_put_back_where_they_were():
+    parsed = parse_markdown(ANSWER)
+    assert [block.code for block in parsed.blocks] == ["print(1)", "x()\n\ny()", "plain"]
+    assert render_markdown(parsed.content, parsed.blocks) == ANSWER
+
+    nested = "Show it:\n````md\n```py\nx = 1\n```\n````\nDone."
+    parsed = parse_markdown(nested)
+    assert render_markdown(parsed.content, parsed.blocks) == nested
+
+
+def test_streamed_chunks_parse_like_the_whole_answer():
+    parser = StreamingMarkdownParser()
+    for start in range(0, len(ANSWER), 3):
+        parser.feed(ANSWER[start:start + 3])
+    parser.finish()
+    whole = parse_markdown(ANSWER)
+    assert (parser.content, parser.blocks) == (whole.content, whole.blocks)
+
+
+def test_history_sends_every_code_block_back(postgres):
+    parsed = parse_markdown(ANSWER)
+
+    async def scenario():
+        await database.init_db_pool()
+        try:
+            async with database.acquire_db() as db:
+                chat_id = await db.fetchval("INSERT INTO chats (title) VALUES ('blocks') RETURNING id")
+                await db.execute(
+                    "INSERT INTO messages (chat_id, role, content, code, code_blocks) VALUES ($1, 'assistant', $2, $3, $4::jsonb)",
+                    chat_id, parsed.content, parsed.code, dumps([block._asdict() for block in parsed.blocks]).decode(),
+                )
+                # Written before code_blocks existed: only the first block was kept
+                await db.execute(
+                    "INSERT INTO messages (chat_id, role, content, code) VALUES ($1, 'assistant', 'Legacy', 'old()')",
+                    chat_id,
+                )
+                history_cache.invalidate(chat_id)
+                return await get_chat_history(db, chat_id, 10000)
+        finally:
+            await database.close_db_pool()
+
+    history = asyncio.run(scenario())
+    assert history[0].content == ANSWER
+    assert history[1].content == "Legacy\n```\nold()\n```"
+    messages = _to_ollama_messages(history, "next")
+    assert all(f"\n{block.code}\n" in messages[0]["content"] for block in parsed.blocks)
+    prompt = build_context_prompt(history, "next")
+    assert all(block.code in prompt for block in parsed.blocks)
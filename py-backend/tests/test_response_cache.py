@@ -0,0 +1,133 @@
+import asyncio
+import orjson
+from app.main import app, lifespan
+from app.models.schemas import Message
+from app.utils import database
+from app.utils.auth import create_access_token
+from app.utils.assistant import response_cache as response_cache_module
+from app.utils.assistant.history_cache import history_cache
+from app.utils.assistant.model_selector import llm_service
+from app.utils.assistant.response_cache import ResponseCache, replay_text, response_cache
+from test_assistant_send import post_stream
+
+
+def history(*contents: str) -> list[Message]:
+    return [Message.model_construct(chat_id=1, role="user", content=content) for content in contents]
+
+
+def test_key_ignores_whitespace_but_not_the_prompt():
+    key = ResponseCache.make_key("ollama:llama3", history("first  question"), "and now?", None)
+
+    assert ResponseCache.make_key("ollama:llama3", history("first question\n"), " and  now? ", None) == key
+    assert ResponseCache.make_key("gemini:gemini-2.5-flash", history("first question"), "and now?", None) != key
+    assert ResponseCache.make_key("ollama:llama3", history("other question"), "and now?", None) != key
+    assert ResponseCache.make_key("ollama:llama3", history("first question"), "and now?", "a summary") != key
+    assert ResponseCache.make_key("ollama:llama3", history("first question"), "and now?", None, ["excerpt"]) != key
+
+
+def test_entries_expire(monkeypatch):
+    monkeypatch.setattr(response_cache_module, "RESPONSE_CACHE_TTL_SECONDS", 0)
+    cache = ResponseCache()
+    cache.put("key", "answer")
+
+    assert cache.get("key") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_go_first(monkeypatch):
+    monkeypatch.setattr(response_cache_module, "RESPONSE_CACHE_MAX_ENTRIES", 2)
+    cache = ResponseCache()
+    cache.put("a", "answer a")
+    cache.put("b", "answer b")
+    assert cache.get("a") == "answer a"
+    cache.put("c", "answer c")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "answer a"
+    assert cache.get("c") == "answer c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_cap_bounds_the_cache(monkeypatch):
+    monkeypatch.setattr(response_cache_module, "RESPONSE_CACHE_MAX_BYTES", 1000)
+    cache = ResponseCache()
+    # More than a tenth of the cap is never stored
+    cache.put("huge", "x" * 101)
+    for number in range(20):
+        cache.put(str(number), "y" * 100)
+
+    stats = cache.stats()
+    assert cache.get("huge") is None
+    assert stats["bytes"] <= 1000
+    assert stats["entries"] == 10
+
+
+def test_replay_gives_back_the_whole_answer():
+    text = "é" * (3 * response_cache_module.REPLAY_CHUNK_CHARS + 5)
+
+    async def replay():
+        return [chunk async for chunk in replay_text(text)]
+
+    chunks = asyncio.run(replay())
+    assert "".join(chunks) == text
+    assert len(chunks) == 4
+
+
+class CountingOllama:
+    """An Ollama client that answers every question the same way and counts its calls."""
+    def __init__(self):
+        self.calls = 0
+
+    async def chat(self, model: str, messages: list, stream: bool = False, **kwargs):
+        self.calls += 1
+
+        async def answer():
+            for text in ("The same ", "answer ", "every time."):
+                yield {"message": {"content": text}}
+        return answer()
+
+
+def test_repeated_prompt_is_replayed_from_the_cache(postgres, monkeypatch):
+    monkeypatch.setattr(response_cache_module, "RESPONSE_CACHE_ENABLED", True)
+    fake = CountingOllama()
+    monkeypatch.setattr(llm_service, "get_llm_client", lambda *args, **kwargs: fake)
+
+    async def ask(chat_id: int, token: str, use_cache: bool = True) -> bytes:
+        task, sent = await post_stream("/api/assistant/send", {
+            "chat_id": chat_id, "message": "What is a keyset?", "model": "ollama:test", "is_cloud": False,
+            "use_cache": use_cache,
+        }, token)
+        await asyncio.wait_for(task, 10)
+        body = []
+        while not sent.empty():
+            body.append(sent.get_nowait().get("body", b""))
+        return b"".join(body)
+
+    def done_event(body: bytes) -> dict:
+        for line in body.decode().splitlines():
+            if line.startswith("data: ") and "[DONE]" in line:
+                return orjson.loads(line[len("data: "):])
+
+    async def scenario():
+        async with lifespan(app):
+            async with database.acquire_db() as db:
+                chat_ids = [await db.fetchval("INSERT INTO chats (title) VALUES ('cache') RETURNING id") for _ in range(3)]
+            # Ids start over in the rebuilt test database; forget turns cached under them by earlier tests
+            for chat_id in chat_ids:
+                history_cache.invalidate(chat_id)
+            token = create_access_token({"sub": "1"})
+            # New chats with the same question send the model the same prompt
+            return [await ask(chat_ids[0], token), await ask(chat_ids[1], token),
+                    await ask(chat_ids[2], token, use_cache=False)]
+
+    hits_before = response_cache.hits
+    first, second, fresh = asyncio.run(asyncio.wait_for(scenario(), 30))
+
+    assert done_event(first)["cached"] is False
+    assert done_event(second)["cached"] is True
+    assert done_event(fresh)["cached"] is False
+    assert b"The same" in second and b"every time." in second
+    assert response_cache.hits == hits_before + 1
+    # The cached answer cost no generation
+    assert fake.calls == 2
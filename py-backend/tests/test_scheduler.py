@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+from app.utils.assistant import scheduler as scheduler_module
+from app.utils.assistant.scheduler import LLMScheduler, QueueFullError, holding_slot
+
+
+@pytest.fixture(autouse=True)
+def one_slot(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "LLM_BACKEND_MAX_IN_FLIGHT", {"local": 1})
+    monkeypatch.setattr(scheduler_module, "LLM_MODEL_MAX_IN_FLIGHT", {})
+
+
+def test_users_take_turns_in_the_queue():
+    async def scenario():
+        scheduler = LLMScheduler()
+        running = scheduler.reserve("local", "model", "heavy")
+        tickets = [scheduler.reserve("local", "model", user) for user in ("heavy", "heavy", "heavy", "light", "light", "other")]
+        positions = {(ticket.user_id, ticket.position) for ticket in tickets}
+        order = []
+        current = running
+        for _ in tickets:
+            current.release()
+            current = next(ticket for ticket in tickets if ticket.granted and ticket not in order)
+            order.append(current)
+        current.release()
+        return tickets, order, positions, scheduler.stats()
+
+    tickets, order, positions, stats = asyncio.run(scenario())
+    heavy_1, heavy_2, heavy_3, light_1, light_2, other = tickets
+    # Three queued requests of one user do not hold back the others
+    assert order == [heavy_1, light_1, other, heavy_2, light_2, heavy_3]
+    assert positions == {("heavy", 0), ("heavy", 3), ("heavy", 5), ("light", 1), ("light", 4), ("other", 2)}
+    assert stats["models"] == {} and stats["backends"] == {"local": 0}
+
+
+def test_full_queue_is_rejected(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "LLM_QUEUE_MAX_DEPTH", 2)
+
+    async def scenario():
+        scheduler = LLMScheduler()
+        running = scheduler.reserve("local", "model", "a")
+        queued = [scheduler.reserve("local", "model", user) for user in ("b", "c")]
+        with pytest.raises(QueueFullError):
+            scheduler.reserve("local", "model", "d")
+        # Another model has its own queue
+        other_model = scheduler.reserve("local", "other-model", "d")
+        return scheduler.stats(), running, queued, other_model
+
+    stats, running, queued, other_model = asyncio.run(scenario())
+    assert stats["rejected"] == 1
+    assert stats["models"]["local/model"] == {"limit": 1, "active": 1, "waiting": 2}
+    assert running.granted and not any(ticket.granted for ticket in queued)
+    assert not other_model.granted and stats["models"]["local/other-model"]["waiting"] == 1
+
+
+def test_cancelled_requests_give_their_place_back():
+    async def scenario():
+        scheduler = LLMScheduler()
+        entered = asyncio.Event()
+
+        async def generate(user: str, hold: asyncio.Event):
+            async with scheduler.slot("local", "model", user):
+                entered.set()
+                await hold.wait()
+
+        hold = asyncio.Event()
+        running = asyncio.create_task(generate("a", hold))
+        await entered.wait()
+        waiting = asyncio.create_task(generate("b", asyncio.Event()))
+        await asyncio.sleep(0)
+        queued = scheduler.stats()["models"]["local/model"]["waiting"]
+
+        # Cancelled while queued: leaves the queue
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        after_queued_cancel = scheduler.stats()["models"]["local/model"]
+
+        # Cancelled while generating: frees the slot for the next request
+        entered.clear()
+        follower = asyncio.create_task(generate("c", hold))
+        await asyncio.sleep(0)
+        running.cancel()
+        await asyncio.gather(running, return_exceptions=True)
+        await asyncio.wait_for(entered.wait(), 1)
+        hold.set()
+        await follower
+        return queued, after_queued_cancel, scheduler.stats()
+
+    queued, after_queued_cancel, stats = asyncio.run(scenario())
+    assert queued == 1
+    assert after_queued_cancel == {"limit": 1, "active": 1, "waiting": 0}
+    assert stats["granted"] == 2 and stats["models"] == {} and stats["backends"] == {"local": 0}
+
+
+def test_stream_released_before_its_turn_does_not_generate():
+    async def chunks():
+        yield "generated without a slot"
+
+    async def scenario():
+        scheduler = LLMScheduler()
+        running = scheduler.reserve("local", "model", "a")
+        ticket = scheduler.reserve("local", "model", "b")
+        stream = holding_slot(ticket, chunks())
+        reader = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0)
+        ticket.release()
+        with pytest.raises(StopAsyncIteration):
+            await reader
+        timed_out = await scheduler.reserve("local", "model", "c").wait(timeout=0.01)
+        running.release()
+        return timed_out, scheduler.stats()
+
+    timed_out, stats = asyncio.run(scenario())
+    assert timed_out is False
+    assert stats["granted"] == 2
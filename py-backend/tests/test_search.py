@@ -0,0 +1,90 @@
+import os
+import asyncio
+from app.utils import database
+from app.utils.search import SEARCH_SQL, build_search_query, iter_search_rows
+from conftest import _connect
+
+# Far more distinct words than a 1 MB tsvector holds
+HUGE_ANSWER = " ".join(f"word{number}" for number in range(300_000)) + " needle"
+# The search migration as it was first shipped
+GENERATED_COLUMN = """
+ALTER TABLE messages ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, '') || ' ' || coalesce(code, ''))) STORED
+"""
+
+
+async def search(db, text: str) -> list:
+    return [row async for row in iter_search_rows(db, text)]
+
+
+async def start_app_database(before_migrations: str = None):
+    """Stores a chat with a message before the app's migrations run, then runs them all."""
+    conn = await _connect(os.getenv("PGNAME"))
+    try:
+        if before_migrations:
+            await conn.execute(before_migrations)
+        chat_id = await conn.fetchval("INSERT INTO chats (title) VALUES ('Postgres tuning') RETURNING id")
+        await conn.execute(
+            "INSERT INTO messages (chat_id, role, content, code) VALUES ($1, 'assistant', $2, 'VACUUM ANALYZE')",
+            chat_id, "Run this after a bulk load.",
+        )
+    finally:
+        await conn.close()
+    await database.init_db_pool()
+    await database.run_background_migrations()
+    return chat_id
+
+
+def test_rows_stored_before_the_triggers_are_backfilled_and_indexed(postgres):
+    async def scenario():
+        chat_id = await start_app_database()
+        try:
+            async with database.acquire_db() as db:
+                indexes = await db.fetch(
+                    "SELECT c.relname, i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE c.relname = ANY($1::text[])", list(database.BACKGROUND_INDEXES)
+                )
+                new_chat = await db.fetchval("INSERT INTO chats (title) VALUES ('Other') RETURNING id")
+                # Would fail with "string is too long for tsvector" on a vector of the whole text
+                await db.execute("INSERT INTO messages (chat_id, role, content) VALUES ($1, 'assistant', $2)",
+                                 new_chat, HUGE_ANSWER)
+
+                results = {text: await search(db, text) for text in ("postgres tun", "vacuum", "word17", "needle")}
+                await db.execute("SET enable_seqscan = off")
+                plan = "\n".join(row[0] for row in await db.fetch(
+                    f"EXPLAIN {SEARCH_SQL}", build_search_query("vacuum"), 21, 0
+                ))
+                return indexes, chat_id, new_chat, results, plan
+        finally:
+            await database.close_db_pool()
+
+    indexes, chat_id, new_chat, results, plan = asyncio.run(scenario())
+    assert sorted(indexes) == [("chats_search_vector_idx", True), ("messages_search_vector_idx", True)]
+    assert [row["id"] for row in results["postgres tun"]] == [chat_id]
+    assert [row["id"] for row in results["vacuum"]] == [chat_id]
+    assert "<<VACUUM>>" in results["vacuum"][0]["snippet"]
+    assert [row["id"] for row in results["word17"]] == [new_chat]
+    # Only the first SEARCH_INDEXED_CHARS of a message are searchable
+    assert results["needle"] == []
+    assert "messages_search_vector_idx" in plan and "chats_search_vector_idx" in plan
+
+
+def test_generated_columns_become_trigger_maintained(postgres):
+    async def scenario():
+        chat_id = await start_app_database(GENERATED_COLUMN)
+        try:
+            async with database.acquire_db() as db:
+                generated = await db.fetchval(
+                    "SELECT attgenerated FROM pg_attribute WHERE attrelid = 'messages'::regclass AND attname = 'search_vector'"
+                )
+                await db.execute("INSERT INTO messages (chat_id, role, content) VALUES ($1, 'assistant', $2)",
+                                 chat_id, HUGE_ANSWER)
+                await db.execute("UPDATE messages SET code = 'REINDEX' WHERE code = 'VACUUM ANALYZE'")
+                return generated, await search(db, "vacuum"), await search(db, "reindex")
+        finally:
+            await database.close_db_pool()
+
+    generated, vacuum, reindex = asyncio.run(scenario())
+    assert generated == b"\x00"
+    assert vacuum == []
+    assert len(reindex) == 1
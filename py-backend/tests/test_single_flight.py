@@ -0,0 +1,146 @@
+import asyncio
+import pytest
+from app.utils.assistant.single_flight import SingleFlight
+from app.utils.assistant.scheduler import LLMScheduler, holding_slot
+
+
+class FakeUpstream:
+    """An upstream generation that yields a chunk each time release() is called."""
+    def __init__(self):
+        self.started = 0
+        self.closed = 0
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def release(self, *chunks: str):
+        for chunk in chunks:
+            self._queue.put_nowait(chunk)
+
+    def finish(self):
+        self._queue.put_nowait(None)
+
+    async def stream(self):
+        self.started += 1
+        try:
+            while (chunk := await self._queue.get()) is not None:
+                yield chunk
+        finally:
+            self.closed += 1
+
+
+async def read(stream, count: int) -> list[str]:
+    return [await anext(stream) for _ in range(count)]
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_identical_requests_share_one_upstream():
+    async def scenario():
+        flights = SingleFlight()
+        upstream = FakeUpstream()
+        joined = []
+        first = flights.stream("key", upstream.stream)
+        upstream.release("a", "b")
+        assert await read(first, 2) == ["a", "b"]
+
+        second = flights.stream("key", upstream.stream, on_join=lambda: joined.append(True))
+        upstream.release("c")
+        assert await read(second, 3) == ["a", "b", "c"]
+        upstream.finish()
+        assert [chunk async for chunk in first] == ["c"]
+        assert [chunk async for chunk in second] == []
+        return flights, upstream, joined
+
+    flights, upstream, joined = asyncio.run(scenario())
+    assert upstream.started == 1
+    assert joined == [True]
+    assert flights.stats()["started"] == 1
+    assert flights.stats()["joined"] == 1
+    assert not flights.is_running("key")
+
+
+def test_late_joiner_replays_chunks_from_the_start():
+    async def scenario():
+        flights = SingleFlight()
+        upstream = FakeUpstream()
+        first = flights.stream("key", upstream.stream)
+        upstream.release("one ", "two ", "three")
+        assert await read(first, 3) == ["one ", "two ", "three"]
+
+        late = flights.stream("key", upstream.stream)
+        # The late joiner catches up on everything produced so far before anything new arrives
+        assert await read(late, 3) == ["one ", "two ", "three"]
+        upstream.finish()
+        assert [chunk async for chunk in late] == []
+        await first.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_upstream_is_cancelled_when_the_last_subscriber_leaves():
+    async def scenario():
+        flights = SingleFlight()
+        upstream = FakeUpstream()
+        first = flights.stream("key", upstream.stream)
+        second = flights.stream("key", upstream.stream)
+        upstream.release("a")
+        await read(first, 1)
+        await read(second, 1)
+
+        await first.aclose()
+        await settle()
+        # One subscriber is still reading, so the upstream keeps going
+        assert upstream.closed == 0
+        assert flights.is_running("key")
+
+        await second.aclose()
+        await settle()
+        return flights, upstream
+
+    flights, upstream = asyncio.run(scenario())
+    assert upstream.closed == 1
+    assert flights.stats()["upstream_cancelled"] == 1
+    assert not flights.is_running("key")
+
+
+def test_failed_start_leaves_no_flight_behind():
+    def start():
+        raise RuntimeError("queue full")
+
+    async def scenario():
+        flights = SingleFlight()
+        with pytest.raises(RuntimeError):
+            await anext(flights.stream("key", start))
+        return flights
+
+    assert not asyncio.run(scenario()).is_running("key")
+
+
+def test_slot_is_held_until_the_shared_generation_ends():
+    async def scenario():
+        scheduler = LLMScheduler()
+        flights = SingleFlight()
+        upstream = FakeUpstream()
+
+        def start():
+            return holding_slot(scheduler.reserve("ollama_local", "ollama:test", "starter"), upstream.stream())
+
+        starter = flights.stream("key", start)
+        joiner = flights.stream("key", start)
+        upstream.release("a")
+        await read(starter, 1)
+        await read(joiner, 1)
+
+        # The request that started the generation goes away; the joiner still reads it
+        await starter.aclose()
+        await settle()
+        held_after_starter_left = scheduler.stats()["backends"]["ollama_local"]
+
+        upstream.finish()
+        assert [chunk async for chunk in joiner] == []
+        await settle()
+        return held_after_starter_left, scheduler.stats()["backends"]["ollama_local"]
+
+    assert asyncio.run(scenario()) == (1, 0)
@@ -0,0 +1,52 @@
+import asyncio
+from app.utils.assistant.sse import coalesce_chunks
+
+
+async def tiny_chunks(count: int, text: str = "ab", delay: float = 0.0, pause_after: int = None, pause: float = 0.0):
+    for number in range(count):
+        if delay:
+            await asyncio.sleep(delay)
+        yield text
+        if number == pause_after:
+            await asyncio.sleep(pause)
+
+
+async def collect(chunks, **options) -> list[str]:
+    return [frame async for frame in coalesce_chunks(chunks, **options)]
+
+
+def test_many_tiny_chunks_become_few_frames():
+    frames = asyncio.run(collect(tiny_chunks(2000), max_bytes=512, max_delay_ms=10000))
+
+    # The first chunk alone, then full 512-byte frames, then the rest
+    assert frames[0] == "ab"
+    assert "".join(frames) == "ab" * 2000
+    assert len(frames) == 1 + -(-(2 * 1999) // 512)
+    assert all(len(frame) == 512 for frame in frames[1:-1])
+
+
+def test_buffer_is_flushed_at_the_size_limit():
+    frames = asyncio.run(collect(tiny_chunks(101, "x" * 10), max_bytes=100, max_delay_ms=10000))
+    assert [len(frame) for frame in frames] == [10] + [100] * 10
+
+
+def test_buffer_is_flushed_when_upstream_goes_quiet():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        arrivals = []
+        # Three chunks, then upstream thinks for a second before the last one
+        async for frame in coalesce_chunks(tiny_chunks(4, pause_after=2, pause=1.0), max_bytes=512, max_delay_ms=50):
+            arrivals.append((frame, loop.time()))
+        return arrivals
+
+    arrivals = asyncio.run(scenario())
+    frames = [frame for frame, _ in arrivals]
+    assert frames == ["ab", "abab", "ab"]
+    # The buffered pair went out at the deadline, not a second later with the next chunk
+    assert arrivals[1][1] - arrivals[0][1] < 0.5
+    assert arrivals[2][1] - arrivals[1][1] > 0.5
+
+
+def test_zero_max_bytes_sends_every_chunk():
+    frames = asyncio.run(collect(tiny_chunks(50), max_bytes=0))
+    assert frames == ["ab"] * 50
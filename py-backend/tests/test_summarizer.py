@@ -0,0 +1,105 @@
+import asyncio
+import time
+from app.utils.assistant import summarizer as summarizer_module
+from app.utils.assistant.summarizer import ConversationSummarizer
+
+INTERVAL = 0.3
+
+
+class RecordingSummarizer(ConversationSummarizer):
+    """Records when jobs start and with which model; each job runs until released."""
+    def __init__(self):
+        super().__init__()
+        self.started: list[tuple[float, str]] = []
+        self.release = asyncio.Event()
+
+    async def _summarize(self, chat_id: int, model_identifier: str, is_cloud: bool):
+        self.started.append((time.monotonic(), model_identifier))
+        await self.release.wait()
+
+
+def run(scenario, monkeypatch):
+    monkeypatch.setattr(summarizer_module, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(summarizer_module, "SUMMARY_MODEL", None)
+    monkeypatch.setattr(summarizer_module, "SUMMARY_MIN_INTERVAL_SECONDS", INTERVAL)
+    return asyncio.run(asyncio.wait_for(scenario(), 10))
+
+
+async def settle(summarizer: RecordingSummarizer, seconds: float = 0.0):
+    await asyncio.sleep(seconds)
+    while summarizer._jobs or summarizer._deferred:
+        await asyncio.sleep(0.01)
+
+
+def test_replies_during_a_job_lead_to_one_more_job(monkeypatch):
+    async def scenario():
+        summarizer = RecordingSummarizer()
+        summarizer.schedule(1, "model-a", False)
+        await asyncio.sleep(0)
+        for model in ("model-b", "model-c", "model-d"):
+            summarizer.schedule(1, model, False)
+        summarizer.release.set()
+        await settle(summarizer)
+        return summarizer
+
+    summarizer = run(scenario, monkeypatch)
+    # The rerun uses the latest reply's model
+    assert [model for _, model in summarizer.started] == ["model-a", "model-d"]
+    assert summarizer.deduplicated == 3
+
+
+def test_rerun_waits_for_the_interval(monkeypatch):
+    async def scenario():
+        summarizer = RecordingSummarizer()
+        summarizer.release.set()
+        summarizer.schedule(1, "model", False)
+        await asyncio.sleep(0)
+        # Arrives while the first job runs, which then finishes at once
+        summarizer.schedule(1, "model", False)
+        await settle(summarizer)
+        return summarizer
+
+    summarizer = run(scenario, monkeypatch)
+    (first, _), (second, _) = summarizer.started
+    assert second - first >= INTERVAL * 0.9
+    assert summarizer.rate_limited == 1
+
+
+def test_rate_limited_reply_is_deferred_not_dropped(monkeypatch):
+    async def scenario():
+        summarizer = RecordingSummarizer()
+        summarizer.release.set()
+        summarizer.schedule(1, "model", False)
+        await settle(summarizer)
+        # Within the interval: deferred to its end, and later replies join the same job
+        for _ in range(3):
+            summarizer.schedule(1, "model", False)
+        deferred = summarizer.stats()["deferred"]
+        # Other chats are not held back
+        summarizer.schedule(2, "model", False)
+        await settle(summarizer)
+        return summarizer, deferred
+
+    summarizer, deferred = run(scenario, monkeypatch)
+    assert deferred == 1
+    assert len(summarizer.started) == 3
+    (first, _), (other_chat, _), (second, _) = summarizer.started
+    assert other_chat - first < INTERVAL / 2
+    assert second - first >= INTERVAL * 0.9
+    assert (summarizer.rate_limited, summarizer.deduplicated) == (1, 2)
+
+
+def test_shutdown_drops_deferred_jobs(monkeypatch):
+    async def scenario():
+        summarizer = RecordingSummarizer()
+        summarizer.release.set()
+        summarizer.schedule(1, "model", False)
+        await settle(summarizer)
+        summarizer.schedule(1, "model", False)
+        await summarizer.shutdown()
+        await asyncio.sleep(INTERVAL * 1.5)
+        return summarizer
+
+    summarizer = run(scenario, monkeypatch)
+    assert len(summarizer.started) == 1
+    assert summarizer.stats()["deferred"] == 0
@@ -0,0 +1,118 @@
+import time
+import asyncio
+import httpx
+import pytest
+from fastapi import HTTPException
+from jose import jwt
+from app.main import app, lifespan
+from app.utils import auth, database
+from app.utils.auth import ALGORITHM, SECRET_KEY, TokenCache, create_access_token, token_cache, verify_token
+
+
+@pytest.fixture
+def cache(monkeypatch) -> TokenCache:
+    """A fresh cache behind verify_token, so counts start at zero."""
+    fresh = TokenCache(max_size=3)
+    monkeypatch.setattr(auth, "token_cache", fresh)
+    return fresh
+
+
+def token_for(user_id: str, expires_in: float = 600, **claims) -> str:
+    return jwt.encode({"sub": user_id, "exp": int(time.time() + expires_in), **claims}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def rejected(token: str) -> str:
+    with pytest.raises(HTTPException) as error:
+        verify_token(token)
+    assert error.value.status_code == 401
+    return error.value.detail
+
+
+def test_verified_token_is_served_from_the_cache(cache):
+    token = token_for("7")
+
+    assert verify_token(token) == "7"
+    assert verify_token(token) == "7"
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 1
+
+
+def test_revoked_token_is_rejected_even_though_it_was_cached(cache):
+    token, other = token_for("7"), token_for("7", nonce="other")
+    verify_token(token)
+    verify_token(other)
+
+    cache.revoke_token(token)
+
+    assert cache.get(TokenCache.digest(token)) is None
+    assert rejected(token) == "Token has been revoked"
+    # Another token of the same user is unaffected
+    assert verify_token(other) == "7"
+    assert cache.stats()["revoked"] == 1
+
+
+def test_revoking_a_user_rejects_all_of_their_cached_tokens(cache):
+    tokens = [token_for("7", nonce=str(number)) for number in range(2)]
+    someone_else = token_for("8")
+    for token in tokens + [someone_else]:
+        verify_token(token)
+
+    cache.revoke_user("7")
+
+    assert [rejected(token) for token in tokens] == ["Token has been revoked"] * 2
+    assert verify_token(someone_else) == "8"
+    assert cache.stats()["size"] == 1
+
+
+def test_entries_go_when_their_token_expires(cache):
+    digest = TokenCache.digest("short lived")
+    cache.put(digest, "7", time.time() - 1)
+
+    assert cache.get(digest) is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["size"] == 0
+    # Once the revoked token would have expired anyway, the deny list forgets it
+    cache.revoke_token("short lived", expires_at=time.time() - 1)
+    assert not cache.is_revoked(digest)
+    assert cache.stats()["revoked"] == 0
+
+
+def test_expired_token_is_not_verified(cache):
+    assert rejected(token_for("7", expires_in=-10)) == "Token has expired"
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_tokens_are_evicted(cache):
+    tokens = [token_for("7", nonce=str(number)) for number in range(4)]
+    for token in tokens[:3]:
+        verify_token(token)
+    # Touch the oldest, so the second is the least recently used
+    verify_token(tokens[0])
+    verify_token(tokens[3])
+
+    assert cache.stats()["evictions"] == 1
+    assert cache.get(TokenCache.digest(tokens[1])) is None
+    assert cache.get(TokenCache.digest(tokens[0])) == "7"
+
+
+def test_deleting_the_account_revokes_its_tokens(postgres):
+    async def scenario():
+        async with lifespan(app):
+            async with database.acquire_db() as db:
+                user_id = await db.fetchval(
+                    "INSERT INTO users (username, password, email) VALUES ('leaving', 'x', 'leaving@example.com') RETURNING id"
+                )
+            token = create_access_token({"sub": str(user_id)})
+            headers = {"Authorization": f"Bearer {token}"}
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver", headers=headers) as client:
+                before = await client.get("/api/chat/")
+                deleted = await client.delete("/api/auth/me")
+                after = await client.get("/api/chat/")
+            return token, before, deleted, after
+
+    token, before, deleted, after = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert before.status_code == 200
+    assert deleted.status_code == 204
+    # The token was cached by the first request; the cache must not keep serving it
+    assert after.status_code == 401
+    assert after.json()["detail"] == "Token has been revoked"
+    assert token_cache.is_revoked(TokenCache.digest(token))
@@ -0,0 +1,187 @@
+import os
+import time
+import random
+import zipfile
+import asyncio
+import threading
+import psutil
+import pytest
+from starlette.requests import Request
+from app.utils.extract import file_extract
+from app.utils.extract.file_extract import spool_upload, remove_spooled, iter_document_pages, PDF_TYPE, DOCX_TYPE, DOCX_PARAGRAPHS_PER_SECTION
+
+BOUNDARY = b"test-boundary"
+# Request body pieces, about what a server hands over per receive()
+BODY_CHUNK_BYTES = 64 * 1024
+WORDS = "alpha beta gamma delta epsilon zeta theta kappa lambda sigma omega".split()
+
+
+def random_line(rng: random.Random, words: int = 14) -> str:
+    # Random words with numbers, so the files do not compress to nothing
+    return " ".join(f"{rng.choice(WORDS)}{rng.randrange(100000)}" for _ in range(words))
+
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+DOCX_PARAGRAPHS = 150000
+DOCX_TABLE_EVERY = 25000
+PDF_PAGES = 300
+
+
+@pytest.fixture(scope="module")
+def large_pdf(tmp_path_factory) -> str:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    rng = random.Random(1)
+    path = str(tmp_path_factory.mktemp("uploads") / "large.pdf")
+    pdf = canvas.Canvas(path, pagesize=A4, pageCompression=0)
+    for _ in range(PDF_PAGES):
+        for line in range(60):
+            pdf.drawString(40, 800 - line * 13, random_line(rng))
+        pdf.showPage()
+    pdf.save()
+    return path
+
+
+@pytest.fixture(scope="module")
+def large_docx(tmp_path_factory) -> str:
+    # Written as WordprocessingML directly: python-docx takes minutes to build a document this long
+    rng = random.Random(2)
+    path = str(tmp_path_factory.mktemp("uploads") / "large.docx")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        archive.writestr("_rels/.rels", DOCX_RELATIONSHIPS)
+        with archive.open("word/document.xml", "w") as xml:
+            xml.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                      b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+            for number in range(DOCX_PARAGRAPHS):
+                xml.write(f"<w:p><w:r><w:t>{random_line(rng)}</w:t></w:r></w:p>".encode())
+                if number % DOCX_TABLE_EVERY == 0:
+                    cells = "".join(f"<w:tc><w:p><w:r><w:t>{random_line(rng, 3)}</w:t></w:r></w:p></w:tc>" for _ in range(3))
+                    xml.write(f"<w:tbl><w:tr>{cells}</w:tr><w:tr>{cells}</w:tr></w:tbl>".encode())
+            xml.write(b"</w:body></w:document>")
+    return path
+
+
+def upload_request(path: str, content_type: str) -> Request:
+    """A multipart upload of the file at path whose body is read from disk as the app receives it."""
+    head = (
+        b"--" + BOUNDARY + b"\r\nContent-Disposition: form-data; name=\"file\"; filename=\""
+        + os.path.basename(path).encode() + b"\"\r\nContent-Type: " + content_type.encode() + b"\r\n\r\n"
+    )
+    tail = b"\r\n--" + BOUNDARY + b"--\r\n"
+    size = len(head) + os.path.getsize(path) + len(tail)
+    source = open(path, "rb")
+    pieces = iter([head])
+
+    async def receive():
+        nonlocal pieces
+        piece = next(pieces, None)
+        if piece is None:
+            piece = source.read(BODY_CHUNK_BYTES)
+            if not piece:
+                source.close()
+                pieces = iter([])
+                return {"type": "http.request", "body": tail, "more_body": False}
+        return {"type": "http.request", "body": piece, "more_body": True}
+
+    return Request({
+        "type": "http", "method": "POST", "path": "/assistant/upload-document", "query_string": b"",
+        "headers": [
+            (b"content-type", b"multipart/form-data; boundary=" + BOUNDARY),
+            (b"content-length", str(size).encode()),
+        ],
+    }, receive)
+
+
+class PeakMemory:
+    """Samples the resident memory of this process and of its parser workers from a thread."""
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.baseline = self.process.memory_info().rss
+        self.peak = 0
+        self.peak_worker = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss - self.baseline)
+            for child in self.process.children():
+                try:
+                    self.peak_worker = max(self.peak_worker, child.memory_info().rss)
+                except psutil.NoSuchProcess:
+                    pass
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def spool_and_parse(path: str, content_type: str) -> tuple[int, int, int, float, PeakMemory]:
+    """Spools a generated upload and parses it page by page, keeping only counts."""
+    async def scenario():
+        spooled = await spool_upload(upload_request(path, content_type))
+        try:
+            pages = characters = 0
+            async for text in iter_document_pages(spooled):
+                pages += 1
+                characters += len(text)
+            return spooled.size, pages, characters
+        finally:
+            remove_spooled(spooled.path)
+
+    # Workers are started before the baseline is taken, so only the work is measured
+    file_extract._get_executor().submit(int).result()
+    try:
+        with PeakMemory() as memory:
+            started = time.perf_counter()
+            size, pages, characters = asyncio.run(scenario())
+            elapsed = time.perf_counter() - started
+    finally:
+        file_extract.shutdown_extraction()
+    print(f"{content_type}: {size / 1e6:.1f} MB, {pages} pages, {characters / 1e6:.1f} M characters "
+          f"in {elapsed:.2f} s ({size / 1e6 / elapsed:.1f} MB/s); peak RSS +{memory.peak / 1e6:.0f} MB, "
+          f"worker {memory.peak_worker / 1e6:.0f} MB")
+    return size, pages, characters, elapsed, memory
+
+
+def test_large_pdf_upload_is_parsed_in_bounded_memory(large_pdf):
+    size, pages, characters, elapsed, memory = spool_and_parse(large_pdf, PDF_TYPE)
+    assert size > 3_000_000
+    assert pages == PDF_PAGES
+    # The upload and its text are never held whole by the app process
+    assert memory.peak < min(size, characters) / 2
+    assert memory.peak_worker < 200_000_000
+    assert size / elapsed > 100_000
+
+
+def test_large_docx_upload_is_parsed_in_bounded_memory(large_docx):
+    size, pages, characters, elapsed, memory = spool_and_parse(large_docx, DOCX_TYPE)
+    assert size > 8_000_000
+    lines = DOCX_PARAGRAPHS + 2 * (-(-DOCX_PARAGRAPHS // DOCX_TABLE_EVERY))
+    assert pages == -(-lines // DOCX_PARAGRAPHS_PER_SECTION)
+    # The text is several times the file; the app process never holds all of it
+    assert memory.peak < characters / 2
+    assert memory.peak_worker < 200_000_000
+    assert size / elapsed > 100_000